@@ -0,0 +1,44 @@
+import os
+import time
+
+import numpy as np
+
+from overlay import TintBlender
+
+# 对比 combine_sgmt.py 中高亮蒙版的原浮点实现与整数复用缓冲区实现
+RESOLUTIONS = {'1080p': (1080, 1920), '4K': (2160, 3840)}
+REPEATS = int(os.getenv('BENCH_REPEATS', '30'))
+# combine_sgmt.py 中 good 片段的高亮颜色与默认不透明度
+GOOD_COLOR = (0, 255, 0)
+OPACITY = 0.3
+
+
+def float_blend(frame, color):
+    """原实现：每帧分配 full_like 颜色帧，并以 float64 计算 frame * 0.7 + mask * 0.3"""
+    mask = np.full_like(frame, color, dtype=np.uint8)
+    return (frame * 0.7 + mask * 0.3).astype('uint8')
+
+
+def time_per_frame(fn, frame):
+    fn(frame)  # 预热
+    start = time.perf_counter()
+    for _ in range(REPEATS):
+        fn(frame)
+    return (time.perf_counter() - start) / REPEATS
+
+
+def main():
+    rng = np.random.default_rng(0)
+    blender = TintBlender({'good': GOOD_COLOR}, OPACITY)
+    color = GOOD_COLOR
+    for name, (height, width) in RESOLUTIONS.items():
+        frame = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+        old = time_per_frame(lambda f: float_blend(f, color), frame)
+        new = time_per_frame(lambda f: blender.blend(f, 'good'), frame)
+        max_diff = np.abs(float_blend(frame, color).astype(int) - blender.blend(frame, 'good').astype(int)).max()
+        print(f"{name}: float {old * 1000:.1f} ms/frame, integer {new * 1000:.1f} ms/frame "
+              f"({old / new:.1f}x), max abs diff {max_diff}")
+
+
+if __name__ == "__main__":
+    main()
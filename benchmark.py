@@ -0,0 +1,258 @@
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import time
+import wave
+
+import cv2
+import numpy as np
+
+from main import STAGES
+
+# 合成片段的参数：分辨率、时长、帧率、人数、每分钟字幕条数，以及是否输出 frames/ 目录而不是 mp4
+BENCH_DIR = os.getenv('BENCH_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'segment', 'benchmark'))
+BENCH_WIDTH = int(os.getenv('BENCH_WIDTH', '1280'))
+BENCH_HEIGHT = int(os.getenv('BENCH_HEIGHT', '720'))
+BENCH_SECONDS = float(os.getenv('BENCH_SECONDS', '10'))
+BENCH_FPS = float(os.getenv('BENCH_FPS', '30'))
+BENCH_PERSONS = int(os.getenv('BENCH_PERSONS', '2'))
+BENCH_SUBTITLES_PER_MINUTE = float(os.getenv('BENCH_SUBTITLES_PER_MINUTE', '20'))
+BENCH_AS_FRAMES = os.getenv('BENCH_AS_FRAMES', '0') == '1'
+BENCH_SEED = int(os.getenv('BENCH_SEED', '0'))
+# 需要计时的阶段（逗号分隔，默认全部），以及是否使用检测缓存（默认关闭，测量真实推理）
+BENCH_STAGES = [name for name in os.getenv('BENCH_STAGES', ','.join(stage["name"] for stage in STAGES)).split(',')
+                if name]
+BENCH_DETECTION_CACHE = os.getenv('BENCH_DETECTION_CACHE', '0')
+# 报告路径，以及用于对比的历史报告
+BENCH_REPORT = os.getenv('BENCH_REPORT', 'benchmark_report.json')
+BENCH_COMPARE = os.getenv('BENCH_COMPARE')
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+AUDIO_RATE = 16000
+
+
+def format_srt_time(seconds):
+    milliseconds = int(round(seconds * 1000))
+    hours, milliseconds = divmod(milliseconds, 3600000)
+    minutes, milliseconds = divmod(milliseconds, 60000)
+    seconds, milliseconds = divmod(milliseconds, 1000)
+    return f"{hours:02d}:{minutes:02d}:{seconds:02d},{milliseconds:03d}"
+
+
+def random_intervals(rng, duration, count, min_length, max_length):
+    """在 [0, duration) 内生成 count 个按开始时间排序的区间（可能重叠）"""
+    starts = np.sort(rng.uniform(0, max(duration - min_length, 0), count))
+    lengths = rng.uniform(min_length, max_length, count)
+    return [(float(start), float(min(duration, start + length))) for start, length in zip(starts, lengths)]
+
+
+def generate_clip(base_dir, width=BENCH_WIDTH, height=BENCH_HEIGHT, seconds=BENCH_SECONDS, fps=BENCH_FPS,
+                  persons=BENCH_PERSONS, subtitles_per_minute=BENCH_SUBTITLES_PER_MINUTE, as_frames=BENCH_AS_FRAMES,
+                  seed=BENCH_SEED):
+    """生成一个合成片段：{name}.mp4（或 frames/）、{name}-gaze.json、{name}.srt、{name}_gpt.json、{name}.wav，
+    以及供 combine_sgmt.py 单独计时的 {name}-bbox.mp4（内容与源视频相同）"""
+    rng = np.random.default_rng(seed)
+    name = os.path.basename(base_dir)
+    os.makedirs(base_dir, exist_ok=True)
+    num_frames = int(round(seconds * fps))
+
+    # 背景为带纹理的静态画面，若干彩色物体缓慢移动，每个人有一个头部框，视线随机指向其他人或物体
+    background = cv2.GaussianBlur(rng.integers(0, 256, (height, width, 3), dtype=np.uint8), (0, 0), 3)
+    objects = [(rng.uniform(0.1, 0.8, 2) * (width, height), rng.normal(0, 1.5, 2), rng.integers(40, 255, 3))
+               for _ in range(6)]
+    head_size = max(20, height // 12)
+    heads = rng.uniform((0.05 * width, 0.1 * height), (0.9 * width - head_size, 0.5 * height), (persons, 2))
+    person_ids = [f"person_{k + 1}" for k in range(persons)]
+
+    video_path = os.path.join(base_dir, f'{name}.mp4')
+    bbox_path = os.path.join(base_dir, f'{name}-bbox.mp4')
+    frames_dir = os.path.join(base_dir, 'frames')
+    if as_frames:
+        os.makedirs(frames_dir, exist_ok=True)
+    # frames/ 模式下不生成 {name}.mp4，但 combine_sgmt.py 仍需要 {name}-bbox.mp4
+    writer = cv2.VideoWriter(bbox_path if as_frames else video_path, cv2.VideoWriter_fourcc(*'mp4v'), fps,
+                             (width, height))
+
+    gaze_data = {}
+    targets = rng.integers(0, persons, persons)
+    for number in range(num_frames):
+        image = background.copy()
+        for position, velocity, color in objects:
+            x, y = (position + velocity * number) % (width - 120, height - 120)
+            cv2.rectangle(image, (int(x), int(y)), (int(x) + 120, int(y) + 90), tuple(int(c) for c in color), -1)
+        frame_gaze = {}
+        if number % int(max(1, fps)) == 0:
+            targets = rng.integers(0, persons, persons)
+        for p, person_id in enumerate(person_ids):
+            x0, y0 = heads[p] + rng.normal(0, 0.5, 2)
+            bbox = [float(x0), float(y0), float(x0 + head_size), float(y0 + head_size)]
+            cv2.circle(image, (int(x0 + head_size / 2), int(y0 + head_size / 2)), head_size // 2, (220, 190, 160), -1)
+            # 视线终点为 center - gaze_len * gaze，因此 gaze 为指向目标方向的反向单位向量
+            target = heads[targets[p]] if targets[p] != p else rng.uniform(0, 1, 2) * (width, height)
+            direction = np.asarray(target, dtype=np.float64) - (x0, y0)
+            norm = np.hypot(*direction) or 1.0
+            frame_gaze[person_id] = {"gaze": (-direction / norm).tolist(), "head_bbox": bbox}
+        gaze_data[str(number)] = frame_gaze
+        writer.write(image)
+        if as_frames:
+            cv2.imwrite(os.path.join(frames_dir, f"{number}.jpg"), image)
+    writer.release()
+    if not as_frames:
+        shutil.copyfile(video_path, bbox_path)
+
+    with open(os.path.join(base_dir, f'{name}-gaze.json'), 'w') as f:
+        json.dump(gaze_data, f)
+
+    # 字幕：按密度生成，可能互相重叠
+    subtitles = random_intervals(rng, seconds, max(1, int(round(subtitles_per_minute * seconds / 60))), 0.8, 4.0)
+    with open(os.path.join(base_dir, f'{name}.srt'), 'w') as f:
+        for k, (start, end) in enumerate(subtitles):
+            f.write(f"{k + 1}\n{format_srt_time(start)} --> {format_srt_time(end)}\nSubtitle line {k + 1}\n\n")
+
+    # 共同注意片段
+    segments = {"good_joint_attention_segments": [], "poor_joint_attention_segments": []}
+    for k, (start, end) in enumerate(random_intervals(rng, seconds, max(2, int(seconds // 5)), 1.0, 3.0)):
+        key = "good_joint_attention_segments" if k % 2 == 0 else "poor_joint_attention_segments"
+        segments[key].append({"start_time": format_srt_time(start), "end_time": format_srt_time(end),
+                              "description": f"Synthetic segment {k + 1}"})
+    with open(os.path.join(base_dir, f'{name}_gpt.json'), 'w') as f:
+        json.dump(segments, f, indent=4)
+
+    # 单声道 16 kHz 的正弦音频
+    t = np.arange(int(seconds * AUDIO_RATE)) / AUDIO_RATE
+    samples = (0.2 * 32767 * np.sin(2 * np.pi * 440 * t)).astype(np.int16)
+    with wave.open(os.path.join(base_dir, f'{name}.wav'), 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(AUDIO_RATE)
+        f.writeframes(samples.tobytes())
+    return num_frames
+
+
+# 子进程的 ru_maxrss 从 fork 时父进程的 RSS 算起，exec 也不会清零，直接由基准进程启动阶段时量到的是基准进程
+# 自身（生成片段后）的内存。因此先启动这个只导入了 os/subprocess/time 的小进程，由它启动阶段并用 wait4 取得峰值 RSS，
+# 结果（退出码、墙钟时间、ru_maxrss）写入 argv[1]
+MEASURE_HELPER = """
+import os, subprocess, sys, time
+start = time.perf_counter()
+process = subprocess.Popen(sys.argv[2:])
+_, status, usage = os.wait4(process.pid, 0)
+elapsed = time.perf_counter() - start
+with open(sys.argv[1], 'w') as f:
+    f.write(f"{os.waitstatus_to_exitcode(status)} {elapsed} {usage.ru_maxrss}")
+"""
+
+
+def measure_process(command, log_path, env=None):
+    """运行 command，返回 (returncode, 墙钟时间, 峰值 RSS MB)；输出写入 log_path"""
+    result_path = log_path + '.rusage'
+    with open(log_path, 'w') as log:
+        subprocess.run([sys.executable, '-c', MEASURE_HELPER, result_path] + command, stdout=log,
+                       stderr=subprocess.STDOUT, env=env, check=True)
+    with open(result_path, 'r') as f:
+        returncode, elapsed, max_rss = f.read().split()
+    os.remove(result_path)
+    # Linux 上 ru_maxrss 的单位为 KB，macOS 上为字节
+    peak_rss = int(max_rss) / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+    return int(returncode), float(elapsed), peak_rss
+
+
+def run_stage(script, base_dir, log_path):
+    """以子进程运行一个阶段，返回 (returncode, 墙钟时间, 峰值 RSS MB)"""
+    # frames/ 模式下没有视频可读帧率，由 DEFAULT_FPS 提供
+    env = dict(os.environ, BASE_DIR=base_dir, PYTHONUNBUFFERED='1', DETECTION_CACHE=BENCH_DETECTION_CACHE,
+               DEFAULT_FPS=str(BENCH_FPS))
+    return measure_process([sys.executable, os.path.join(SCRIPT_DIR, script)], log_path, env)
+
+
+def git_commit():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=SCRIPT_DIR, capture_output=True, text=True,
+                                check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=SCRIPT_DIR,
+                               capture_output=True, text=True, check=True).stdout.strip()
+        return commit + ('-dirty' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(bench_dir=BENCH_DIR, stages=BENCH_STAGES):
+    base_dir = os.path.join(bench_dir, 'synthetic')
+    if os.path.exists(base_dir):
+        shutil.rmtree(base_dir)
+    start = time.perf_counter()
+    num_frames = generate_clip(base_dir)
+    print(f"Generated {num_frames} frames at {BENCH_WIDTH}x{BENCH_HEIGHT} in {time.perf_counter() - start:.1f}s")
+
+    results = []
+    for stage in STAGES:
+        if stage["name"] not in stages:
+            continue
+        log_path = os.path.join(bench_dir, f'{stage["name"]}.log')
+        returncode, seconds, peak_rss = run_stage(stage["script"], base_dir, log_path)
+        # combine.py 处理的是事件而不是帧，不计算 frames/sec
+        fps = num_frames / seconds if stage["name"] != 'combine' and returncode == 0 else None
+        results.append({
+            "stage": stage["name"],
+            "returncode": returncode,
+            "wall_seconds": round(seconds, 3),
+            "frames": num_frames,
+            "fps": round(fps, 2) if fps else None,
+            "peak_rss_mb": round(peak_rss, 1),
+            "log": log_path,
+        })
+        print(f"{stage['name']:<14} rc={returncode} {seconds:8.2f}s "
+              f"{(f'{fps:8.2f} fps' if fps else ' ' * 12)} {peak_rss:8.1f} MB")
+    return results
+
+
+def write_report(results, report_path=BENCH_REPORT):
+    report = {
+        "commit": git_commit(),
+        "timestamp": time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "config": {
+            "width": BENCH_WIDTH, "height": BENCH_HEIGHT, "seconds": BENCH_SECONDS, "fps": BENCH_FPS,
+            "persons": BENCH_PERSONS, "subtitles_per_minute": BENCH_SUBTITLES_PER_MINUTE,
+            "as_frames": BENCH_AS_FRAMES, "seed": BENCH_SEED, "detection_cache": BENCH_DETECTION_CACHE == '1',
+        },
+        "stages": results,
+    }
+    with open(report_path, 'w') as f:
+        json.dump(report, f, indent=4)
+    return report
+
+
+def compare_reports(baseline, current):
+    """按阶段对比两份报告的墙钟时间和峰值内存（比值 < 1 表示变快/变小）"""
+    if baseline.get("config") != current.get("config"):
+        print("Warning: benchmark configurations differ, results may not be comparable")
+    before = {stage["stage"]: stage for stage in baseline["stages"]}
+    print(f"Comparing {baseline.get('commit')} -> {current.get('commit')}")
+    print(f"{'stage':<14} {'before s':>9} {'after s':>9} {'time x':>7} {'before MB':>10} {'after MB':>9} {'rss x':>6}")
+    for stage in current["stages"]:
+        old = before.get(stage["stage"])
+        if old is None or old["returncode"] or stage["returncode"]:
+            print(f"{stage['stage']:<14} (not comparable)")
+            continue
+        print(f"{stage['stage']:<14} {old['wall_seconds']:9.2f} {stage['wall_seconds']:9.2f} "
+              f"{stage['wall_seconds'] / max(old['wall_seconds'], 1e-9):7.2f} {old['peak_rss_mb']:10.1f} "
+              f"{stage['peak_rss_mb']:9.1f} {stage['peak_rss_mb'] / max(old['peak_rss_mb'], 1e-9):6.2f}")
+
+
+def main(report_path=BENCH_REPORT, compare_path=BENCH_COMPARE):
+    os.makedirs(BENCH_DIR, exist_ok=True)
+    report = write_report(run_benchmark(), report_path)
+    print(f"Report saved to {report_path}")
+    if compare_path:
+        with open(compare_path, 'r') as f:
+            compare_reports(json.load(f), report)
+
+
+if __name__ == "__main__":
+    main()
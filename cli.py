@@ -0,0 +1,181 @@
+import argparse
+import builtins
+import importlib
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+# 记录 CLI 开始执行的时间，用于 --profile-startup
+CLI_START = time.perf_counter()
+
+# 子命令 -> 阶段模块（只在执行该子命令时才导入）
+STAGE_MODULES = {
+    'segment': 'maskrcnn',
+    'obj-gaze': 'plot_obj_gaze',
+    'head-gaze': 'plot_head_gaze',
+    'align-dialogue': 'combine',
+    'render': 'combine_sgmt',
+}
+
+# 需要加载 Mask R-CNN 的子命令
+MODEL_COMMANDS = ('segment', 'obj-gaze')
+
+
+@contextmanager
+def profile_imports(records):
+    """记录被导入模块直接 import 的各个包的耗时（只统计首次导入）"""
+    original_import = builtins.__import__
+    depth = [0]
+
+    def timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+        top_level = depth[0] == 0 and level == 0 and name not in sys.modules
+        depth[0] += 1
+        start = time.perf_counter()
+        try:
+            return original_import(name, globals, locals, fromlist, level)
+        finally:
+            depth[0] -= 1
+            if top_level:
+                records.append((f"import {name}", time.perf_counter() - start))
+
+    builtins.__import__ = timed_import
+    try:
+        yield
+    finally:
+        builtins.__import__ = original_import
+
+
+def import_stage(module_name, profile):
+    """导入阶段模块；profile 为列表时记录导入耗时"""
+    if profile is None:
+        return importlib.import_module(module_name)
+    start = time.perf_counter()
+    with profile_imports(profile):
+        module = importlib.import_module(module_name)
+    profile.append((f"import {module_name} (total)", time.perf_counter() - start))
+    return module
+
+
+def print_startup_profile(profile):
+    print("Startup profile:", file=sys.stderr)
+    for name, seconds in profile:
+        print(f"  {name:<48} {seconds * 1000:9.1f} ms", file=sys.stderr)
+    print(f"  {'ready to run (since CLI start)':<48} {(time.perf_counter() - CLI_START) * 1000:9.1f} ms",
+          file=sys.stderr)
+
+
+def apply_env_options(args):
+    """命令行参数通过环境变量传给各模块（必须在导入模块之前设置）"""
+    options = {
+        'FRAME_STRIDE': getattr(args, 'stride', None),
+        'START_TIME': getattr(args, 'start_time', None),
+        'END_TIME': getattr(args, 'end_time', None),
+        'BATCH_SIZE': getattr(args, 'batch_size', None),
+        'INFERENCE_BACKEND': getattr(args, 'backend', None),
+    }
+    for name, value in options.items():
+        if value is not None:
+            os.environ[name] = str(value)
+    if getattr(args, 'benchmark', False):
+        os.environ['BENCHMARK'] = '1'
+    if args.trace:
+        os.environ['TRACE'] = '1'
+
+
+def run_stage(args, profile):
+    base_dir = os.path.abspath(args.base_dir or os.getenv('BASE_DIR', '.'))
+    module = import_stage(STAGE_MODULES[args.command], profile)
+
+    if profile is not None and args.command in MODEL_COMMANDS:
+        detection = import_stage('detection', profile)
+        start = time.perf_counter()
+        detection.load_model()
+        profile.append(("load Mask R-CNN weights", time.perf_counter() - start))
+    if profile is not None:
+        print_startup_profile(profile)
+
+    module.run(base_dir)
+
+
+def run_label(args, profile):
+    module_name = 'label_gz_win' if sys.platform == 'win32' else 'label_gz_linux'
+    module = import_stage(module_name, profile)
+    if profile is not None:
+        print_startup_profile(profile)
+    module.main(args.video_path, args.csv)
+
+
+def run_compare_backends(args, profile):
+    module = import_stage('inference_backend', profile)
+    if profile is not None:
+        print_startup_profile(profile)
+    base_dir = os.path.abspath(args.base_dir or os.getenv('BASE_DIR', '.'))
+    backends = args.backends.split(',') if args.backends else module.COMPARE_BACKENDS
+    module.compare_clip(base_dir, backends, args.frames)
+
+
+def run_benchmark(args, profile):
+    module = import_stage('benchmark', profile)
+    if profile is not None:
+        print_startup_profile(profile)
+    module.main(args.report or module.BENCH_REPORT, args.compare or module.BENCH_COMPARE)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Segmentation / gaze analysis pipeline")
+    parser.add_argument('--profile-startup', action='store_true',
+                        help="report import and initialization time before running")
+    parser.add_argument('--trace', action='store_true',
+                        help="record per-frame spans and write a Chrome trace plus a latency summary to $TRACE_DIR")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    help_texts = {
+        'segment': "run Mask R-CNN on every frame (maskrcnn.py)",
+        'obj-gaze': "draw gaze rays and the objects they hit (plot_obj_gaze.py)",
+        'head-gaze': "detect person-to-person gaze events (plot_head_gaze.py)",
+        'align-dialogue': "align gaze events with SRT dialogue (combine.py)",
+        'render': "render highlighted segments and captions (combine_sgmt.py)",
+    }
+    for command, help_text in help_texts.items():
+        sub = subparsers.add_parser(command, help=help_text)
+        sub.add_argument('base_dir', nargs='?', help="clip directory (defaults to $BASE_DIR)")
+        if command in ('segment', 'obj-gaze', 'head-gaze'):
+            sub.add_argument('--stride', type=int, help="process every N-th frame")
+            sub.add_argument('--start-time', type=float, help="start time in seconds")
+            sub.add_argument('--end-time', type=float, help="end time in seconds")
+        if command in MODEL_COMMANDS:
+            sub.add_argument('--backend', help="inference backend: eager, torchscript, onnx, int8-dynamic, int8-static")
+        if command == 'segment':
+            sub.add_argument('--batch-size', type=int, help="frames per forward pass")
+            sub.add_argument('--benchmark', action='store_true', help="report frames/sec for batch sizes 1, 4, 8")
+        sub.set_defaults(handler=run_stage)
+
+    compare = subparsers.add_parser('compare-backends',
+                                    help="compare latency and box agreement of inference backends against eager")
+    compare.add_argument('base_dir', nargs='?', help="clip directory to sample frames from (defaults to $BASE_DIR)")
+    compare.add_argument('--backends', help="comma-separated backends (default: all)")
+    compare.add_argument('--frames', type=int, default=16, help="number of frames to sample")
+    compare.set_defaults(handler=run_compare_backends)
+
+    bench = subparsers.add_parser('benchmark', help="time every stage on a synthetic clip (benchmark.py)")
+    bench.add_argument('--report', help="report path (default: $BENCH_REPORT)")
+    bench.add_argument('--compare', help="earlier report to compare against")
+    bench.set_defaults(handler=run_benchmark)
+
+    label = subparsers.add_parser('label', help="open the frame labeling tool")
+    label.add_argument('video_path', nargs='?', help="video to label")
+    label.add_argument('--csv', help="annotations CSV path")
+    label.set_defaults(handler=run_label)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    apply_env_options(args)
+    profile = [] if args.profile_startup else None
+    args.handler(args, profile)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,93 +1,161 @@
-import re
 import os
 import json
 
-BASE_DIR = os.getenv('BASE_DIR', '/app/Desktop/Dataset/3')
-VIDEO_NAME = os.path.basename(BASE_DIR)
+import numpy as np
 
-# 假设从文本文件加载对话
-dialogue_file_path = os.path.join(BASE_DIR, f'{VIDEO_NAME}.srt')
-gaze_events_json_path = os.path.join(BASE_DIR, f'{VIDEO_NAME}_gaze_events.json')
-output_json_path = os.path.join(BASE_DIR, f'{VIDEO_NAME}_result.json')  # 输出 JSON 文件路径
+from tracing import span
 
-with open(gaze_events_json_path, 'r') as f:
-    gaze_events = json.load(f)
+BASE_DIR = os.getenv('BASE_DIR', '/app/Desktop/Dataset/3')
+VIDEO_NAME = os.path.basename(BASE_DIR)
 
-# 解析对话文件，提取时间戳和文本
+# 流式解析 SRT 对话文件，逐行判断，不对每行做正则匹配
 def parse_dialogue_file(file_path):
     dialogue_lines = []
     block = {}  # 保存一个对话块的信息
 
-    with open(file_path, 'r') as file:
-        for line in file:
-            line = line.strip()
-
-            # 如果是编号行，初始化一个新的对话块
-            if re.match(r'^\d+$', line):
-                if block:  # 如果已经有一个完整的块，保存它
-                    dialogue_lines.append(block)
-                block = {'id': line}
-
-            # 匹配时间戳的行
-            elif re.match(r'\d{2}:\d{2}:\d{2},\d{3} --> \d{2}:\d{2}:\d{2},\d{3}', line):
-                block['time'] = line  # 保存时间戳
+    def flush():
+        if 'time' in block:
+            block.setdefault('text', '')
+            dialogue_lines.append(dict(block))
+        block.clear()
+
+    with open(file_path, 'r', encoding='utf-8-sig') as file:
+        # 向前多读一行：编号行要看下一行是否为时间戳才能确定
+        lines = (line.strip() for line in file)
+        line = next(lines, None)
+        while line is not None:
+            next_line = next(lines, None)
+
+            # 空行表示一个对话块结束
+            if not line:
+                flush()
+
+            # 编号行后紧跟时间戳行时开始一个新的对话块（前一个块之后缺少空行时也能正确分隔）
+            elif line.isdigit() and next_line is not None and '-->' in next_line:
+                flush()
+                block['id'] = line
+
+            # 时间戳的行："00:00:10,759 --> 00:00:12,000"
+            elif '-->' in line and 'time' not in block:
+                start_time, _, end_time = line.partition('-->')
+                block['time'] = line
+                block['start_time'] = start_time.strip()
+                block['end_time'] = end_time.strip().split(' ')[0]  # 去掉可能的位置参数
+
+            # 时间戳之前的编号行
+            elif line.isdigit() and 'time' not in block:
+                block['id'] = line
 
             # 剩下的是对话文本
-            elif line:
+            elif 'time' in block:
                 if 'text' in block:
                     block['text'] += " " + line  # 将多行文本合并
                 else:
                     block['text'] = line
 
+            line = next_line
+
         # 将最后一个块添加到列表中
-        if block:
-            dialogue_lines.append(block)
+        flush()
 
     return dialogue_lines
 
 # 解析时间戳函数，将格式 "00:00:10,759" 转为秒
 def parse_timestamp(timestamp):
-    hours, minutes, seconds, milliseconds = re.match(r"(\d+):(\d+):(\d+),(\d{3})", timestamp).groups()
-    total_seconds = int(hours) * 3600 + int(minutes) * 60 + int(seconds) + int(milliseconds) / 1000.0
-    return total_seconds
-
-# 匹配 gaze 事件和对话时间，按时间线输出
+    hours, minutes, seconds = timestamp.split(':')
+    seconds, _, milliseconds = seconds.replace('.', ',').partition(',')
+    return int(hours) * 3600 + int(minutes) * 60 + int(seconds) + int(milliseconds or 0) / 1000.0
+
+# 注视事件的时间区间：点事件为 frame_time（兼容旧格式中直接存时间的数字）
+def event_bounds(gaze_events):
+    starts = np.empty(len(gaze_events))
+    ends = np.empty(len(gaze_events))
+    for i, event in enumerate(gaze_events):
+        if isinstance(event, dict):
+            starts[i] = event.get('start_time', event.get('frame_time'))
+            ends[i] = event.get('end_time', event.get('frame_time'))
+        else:
+            starts[i] = ends[i] = event
+    return starts, ends
+
+def interval_join(left_starts, left_ends, right_starts, right_ends):
+    """返回所有重叠的 (left, right) 下标对（闭区间），按 left、right 排序"""
+    order = np.argsort(right_starts, kind='stable')
+    sorted_starts = right_starts[order]
+    sorted_ends = right_ends[order]
+    # 前缀最大结束时间单调不减，可以二分找到第一个可能重叠的区间
+    max_ends = np.maximum.accumulate(sorted_ends) if len(sorted_ends) else sorted_ends
+
+    first = np.searchsorted(max_ends, left_starts, side='left')
+    last = np.searchsorted(sorted_starts, left_ends, side='right')
+    counts = np.maximum(last - first, 0)
+
+    # 展开每个 left 的候选区间 [first, last)，再过滤掉提前结束的区间
+    left = np.repeat(np.arange(len(left_starts)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    candidate = np.repeat(first, counts) + offsets
+    keep = sorted_ends[candidate] >= left_starts[left]
+    left, right = left[keep], order[candidate[keep]]
+
+    pairs = np.lexsort((right, left))
+    return left[pairs], right[pairs]
+
+# 将 gaze 事件与所有时间上重叠的对话匹配，返回按时间线的输出和未匹配的事件
 def match_gaze_events_with_dialogue(gaze_events, dialogue_lines):
-    output = []  # 保存最终的输出结果
-    gaze_event_idx = 0  # gaze_events的指针
+    dialogue_starts = np.array([parse_timestamp(d['start_time']) for d in dialogue_lines], dtype=float)
+    dialogue_ends = np.array([parse_timestamp(d['end_time']) for d in dialogue_lines], dtype=float)
+    event_starts, event_ends = event_bounds(gaze_events)
+
+    event_idx, dialogue_idx = interval_join(event_starts, event_ends, dialogue_starts, dialogue_ends)
+
+    output = [{
+        "start_time": dialogue['start_time'],
+        "end_time": dialogue['end_time'],
+        "text": dialogue['text'],
+        "gaze_events": []
+    } for dialogue in dialogue_lines]
+
+    # 按对话分组，组内保持事件的时间顺序；无论是否有匹配的事件，都输出每段对话
+    by_dialogue = np.lexsort((event_starts[event_idx], dialogue_idx))
+    for e, d in zip(event_idx[by_dialogue].tolist(), dialogue_idx[by_dialogue].tolist()):
+        output[d]['gaze_events'].append(gaze_events[e])
+
+    matched = np.zeros(len(gaze_events), dtype=bool)
+    matched[event_idx] = True
+    unmatched = [gaze_events[i] for i in np.flatnonzero(~matched).tolist()]
+    return output, unmatched
+
+def run(base_dir):
+    """将注视事件与对话时间对齐，结果保存到 {VIDEO_NAME}_result.json"""
+    video_name = os.path.basename(base_dir)
 
-    for dialogue in dialogue_lines:
-        start_time, end_time = re.match(r"(\d{2}:\d{2}:\d{2},\d{3}) --> (\d{2}:\d{2}:\d{2},\d{3})", dialogue['time']).groups()
-        start_seconds = parse_timestamp(start_time)
-        end_seconds = parse_timestamp(end_time)
+    # 假设从文本文件加载对话
+    dialogue_file_path = os.path.join(base_dir, f'{video_name}.srt')
+    gaze_events_json_path = os.path.join(base_dir, f'{video_name}_gaze_events.json')
+    output_json_path = os.path.join(base_dir, f'{video_name}_result.json')  # 输出 JSON 文件路径
+    unmatched_json_path = os.path.join(base_dir, f'{video_name}_unmatched_gaze_events.json')  # 不在任何对话内的事件
 
-        dialogue_entry = {
-            "start_time": start_time,
-            "end_time": end_time,
-            "text": dialogue['text'],
-            "gaze_events": []
-        }
+    with open(gaze_events_json_path, 'r') as f:
+        gaze_events = json.load(f)
 
-        # 依次检查 gaze_events 是否在当前对话的时间范围内
-        while gaze_event_idx < len(gaze_events) and gaze_events[gaze_event_idx] <= end_seconds:
-            event_time = gaze_events[gaze_event_idx]
-            if start_seconds <= event_time <= end_seconds:
-                dialogue_entry['gaze_events'].append(event_time)
-            gaze_event_idx += 1
+    # 读取对话文件并解析
+    with span('parse srt'):
+        dialogue_lines = parse_dialogue_file(dialogue_file_path)
 
-        # 无论是否有匹配的 gaze_events，都输出当前的对话
-        output.append(dialogue_entry)
+    # 运行匹配函数，按时间线输出
+    with span('interval join', events=len(gaze_events)):
+        output, unmatched = match_gaze_events_with_dialogue(gaze_events, dialogue_lines)
 
-    return output
+    # 将最终结果保存到 JSON 文件中
+    with span('write json'), open(output_json_path, 'w') as f:
+        json.dump(output, f, indent=4)
 
-# 读取对话文件并解析
-dialogue_lines = parse_dialogue_file(dialogue_file_path)
+    with span('write json'), open(unmatched_json_path, 'w') as f:
+        json.dump(unmatched, f, indent=4)
 
-# 运行匹配函数，按时间线输出
-output = match_gaze_events_with_dialogue(gaze_events, dialogue_lines)
+    print(f"结果已成功保存到 {output_json_path}")
+    print(f"{len(unmatched)}/{len(gaze_events)} 个事件不在任何对话内，已保存到 {unmatched_json_path}")
 
-# 将最终结果保存到 JSON 文件中
-with open(output_json_path, 'w') as f:
-    json.dump(output, f, indent=4)
 
-print(f"结果已成功保存到 {output_json_path}")
+if __name__ == "__main__":
+    run(BASE_DIR)
@@ -1,84 +1,378 @@
 import json
+import bisect
+import hashlib
+import shutil
+import subprocess
+import tempfile
 import numpy as np
-from moviepy.editor import VideoFileClip, TextClip, CompositeVideoClip, AudioFileClip
+from concurrent.futures import ProcessPoolExecutor
+from moviepy.editor import VideoFileClip, TextClip, AudioFileClip
 import os
+import tracing
+from overlay import TintBlender
+from tracing import span
+from video_sink import concat_list_entry
 
 # 定义 base 目录和 pcit 名称
 BASE_DIR = os.getenv('BASE_DIR','/app/Desktop/Dataset/3')
 VIDEO_NAME = os.path.basename(BASE_DIR)
 
-# 定义图片文件夹路径和其他路径
-video_path = os.path.join(BASE_DIR, f'{VIDEO_NAME}-bbox.mp4')
-audio_path = os.path.join(BASE_DIR, f'{VIDEO_NAME}.wav')
-segment_path = os.path.join(BASE_DIR, f'{VIDEO_NAME}_gpt.json')
-output_path = os.path.join(BASE_DIR, f'{VIDEO_NAME}-combine.mp4')
-
-# 加载原始视频
-video = VideoFileClip(video_path)
-
-# 加载外部音频
-audio = AudioFileClip(audio_path)
-
-# 从 key-event.json 读取片段信息
-with open(segment_path, 'r') as f:
-    segments = json.load(f)
-
 # 将时间戳转换为秒，处理格式: "00:03:33,032"
 def time_to_seconds(time_str):
     time_str = time_str.replace(",", ".")  # 将逗号替换为点号处理毫秒
     h, m, s = time_str.split(":")
     return int(h) * 3600 + int(m) * 60 + float(s)
 
+# 高亮状态：重叠时 good 优先于 poor（与原来先检查 good 片段的行为一致）
+NO_HIGHLIGHT, POOR, GOOD = 0, 1, 2
+HIGHLIGHT_COLORS = {GOOD: (0, 255, 0), POOR: (255, 0, 0)}  # good用绿色，poor用红色
+
+class SegmentIndex:
+    """将 _gpt.json 中的片段一次性编译为有序区间索引，每帧只需 O(log n) 查询高亮状态"""
+
+    def __init__(self, segments):
+        intervals = [
+            (time_to_seconds(segment['start_time']), time_to_seconds(segment['end_time']), kind)
+            for key, kind in (('good_joint_attention_segments', GOOD), ('poor_joint_attention_segments', POOR))
+            for segment in segments[key]
+        ]
+        intervals = [interval for interval in intervals if interval[0] <= interval[1]]
+
+        # 所有片段端点排序去重；point[i] 为端点 i 处的状态，gap[i] 为 (端点 i, 端点 i+1) 开区间内的状态
+        self.boundaries = sorted({t for start, end, _ in intervals for t in (start, end)})
+        boundaries = np.array(self.boundaries)
+        point = np.zeros(len(boundaries), dtype=np.int8)
+        gap = np.zeros(len(boundaries), dtype=np.int8)
+        for start, end, kind in intervals:
+            i = np.searchsorted(boundaries, start)
+            j = np.searchsorted(boundaries, end)
+            np.maximum(point[i:j + 1], kind, out=point[i:j + 1])
+            np.maximum(gap[i:j], kind, out=gap[i:j])
+        self.point = point.tolist()
+        self.gap = gap.tolist()
+
+    def label_at(self, t):
+        """返回时刻 t 的高亮状态（片段区间两端都包含在内）"""
+        i = bisect.bisect_right(self.boundaries, t) - 1
+        if i < 0:
+            return NO_HIGHLIGHT
+        if self.boundaries[i] == t:
+            return self.point[i]
+        return self.gap[i]
+
+# 高亮蒙版的不透明度（0~1），默认 0.3
+HIGHLIGHT_OPACITY = float(os.getenv('HIGHLIGHT_OPACITY', '0.3'))
+
 # 创建透明蒙版（good用绿色，poor用红色）
-def add_highlight_mask(frame, t, segments):
-    for segment in segments['good_joint_attention_segments']:
-        start_time_str, end_time_str = segment['start_time'], segment['end_time']
-        start_time = time_to_seconds(start_time_str)
-        end_time = time_to_seconds(end_time_str)
-        if start_time <= t <= end_time:
-            # 添加透明绿色蒙版
-            mask = np.full_like(frame, (0, 255, 0), dtype=np.uint8)  # 绿色蒙版
-            return (frame * 0.7 + mask * 0.3).astype('uint8')  # 50%透明度
-    for segment in segments['poor_joint_attention_segments']:
-        start_time_str, end_time_str = segment['start_time'], segment['end_time']
-        start_time = time_to_seconds(start_time_str)
-        end_time = time_to_seconds(end_time_str)
-        if start_time <= t <= end_time:
-            # 添加透明红色蒙版
-            mask = np.full_like(frame, (255, 0, 0), dtype=np.uint8)  # 红色蒙版
-            return (frame * 0.7 + mask * 0.3).astype('uint8')  # 50%透明度
+def add_highlight_mask(frame, t, segment_index, blender):
+    label = segment_index.label_at(t)
+    if label == NO_HIGHLIGHT:
+        return frame
+    return blender.blend(frame, label)
+
+# 标题样式，与原来的 TextClip 参数一致；作为标题图像缓存键的一部分
+CAPTION_STYLE = {'fontsize': 20, 'color': 'black', 'bg_color': 'yellow', 'method': 'caption', 'font': 'Courier'}
+# 标题图像缓存目录，多次运行之间复用，避免重复调用 ImageMagick
+CAPTION_CACHE_DIR = os.getenv('CAPTION_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'segment', 'captions'))
+
+def caption_sprite(text, style=CAPTION_STYLE, cache_dir=CAPTION_CACHE_DIR):
+    """返回标题的 (RGB 图像, 0~256 的整数 alpha)，按文本 + 字体 + 字号等样式缓存到磁盘"""
+    key = hashlib.blake2b(json.dumps({'text': text, **style}, sort_keys=True).encode(), digest_size=20).hexdigest()
+    path = os.path.join(cache_dir, f"{key}.npz")
+    if os.path.exists(path):
+        with np.load(path) as data:
+            return data['rgb'], data['alpha']
+
+    # 缓存未命中时才用 ImageMagick 渲染一次
+    clip = TextClip(text, **style)
+    rgb = clip.get_frame(0).astype(np.uint8)
+    if clip.mask is not None:
+        alpha = np.round(clip.mask.get_frame(0) * 256).astype(np.uint16)
+    else:
+        alpha = np.full(rgb.shape[:2], 256, dtype=np.uint16)
+    clip.close()
+
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        np.savez_compressed(f, rgb=rgb, alpha=alpha)
+    os.replace(tmp_path, path)
+    return rgb, alpha
+
+class CaptionTrack:
+    """所有片段标题的预渲染图像，以及按时间查找当前显示标题的区间索引"""
+
+    def __init__(self, segments):
+        captions = []
+        for segment in segments['good_joint_attention_segments'] + segments['poor_joint_attention_segments']:
+            start_time = time_to_seconds(segment['start_time'])
+            end_time = time_to_seconds(segment['end_time'])
+            if start_time < end_time:
+                captions.append((start_time, end_time, caption_sprite(segment['description'])))
+        self.sprites = [sprite for _, _, sprite in captions]
+
+        # 与原来叠加图层的顺序一致：同一时刻有多个标题时显示列表中靠后的那个；
+        # 每个标题在 [start, end) 内显示
+        self.boundaries = sorted({t for start, end, _ in captions for t in (start, end)})
+        self.active = [-1] * len(self.boundaries)
+        for i, (start, end, _) in enumerate(captions):
+            lo = bisect.bisect_left(self.boundaries, start)
+            hi = bisect.bisect_left(self.boundaries, end)
+            for j in range(lo, hi):
+                self.active[j] = i
+
+    def sprite_at(self, t):
+        i = bisect.bisect_right(self.boundaries, t) - 1
+        if i < 0 or self.active[i] < 0:
+            return None
+        return self.sprites[self.active[i]]
+
+def blit_caption(frame, sprite):
+    """将标题图像以 alpha 混合的方式贴到帧的顶部居中位置（原地修改）"""
+    rgb, alpha = sprite
+    height = min(rgb.shape[0], frame.shape[0])
+    x = (frame.shape[1] - rgb.shape[1]) // 2
+    src_x = max(0, -x)
+    x = max(0, x)
+    width = min(rgb.shape[1] - src_x, frame.shape[1] - x)
+    rgb = rgb[:height, src_x:src_x + width]
+    alpha = alpha[:height, src_x:src_x + width, None]
+    region = frame[:height, x:x + width]
+    region[...] = (rgb * alpha + region * (256 - alpha)) >> 8
     return frame
 
-# 创建标题叠加函数
-def add_title_clip(clip, segments):
-    # 创建标题视频层
-    clips = [clip]  # 保留原始视频的所有部分
-    for segment in segments['good_joint_attention_segments'] + segments['poor_joint_attention_segments']:
-        start_time_str, end_time_str = segment['start_time'], segment['end_time']
-        start_time = time_to_seconds(start_time_str)
-        end_time = time_to_seconds(end_time_str)
-        
-        # 创建黑色字体的标题文本
-        title_text = TextClip(segment['description'], fontsize=20, color='black', bg_color='yellow', method='caption').set_position('top').set_duration(end_time - start_time)
-        
-        # 创建只有在这个时间段才出现的子视频
-        title_subclip = title_text.set_start(start_time).set_end(end_time)
-        
-        # 将标题层加入列表
-        clips.append(title_subclip)
-    
-    return CompositeVideoClip(clips, size=clip.size)
-
-# 对整个视频应用高亮蒙版，保留音频
-highlighted_video = video.fl(lambda gf, t: add_highlight_mask(gf(t), t, segments))
-
-# 添加标题叠加效果
-annotated_video = add_title_clip(highlighted_video, segments)
-
-# 将外部音频与视频结合
-final_video = annotated_video.set_audio(audio)
-
-# 输出视频，确保音频保留
-final_video.write_videofile(output_path, codec="libx264", audio_codec="aac")
-
-print(f"Annotated video saved to {output_path}")
+class FrameAnnotator:
+    """对每一帧只做一次处理：按区间索引叠加高亮蒙版，再贴上当前显示的标题"""
+
+    def __init__(self, segments):
+        self.segment_index = SegmentIndex(segments)
+        self.blender = TintBlender(HIGHLIGHT_COLORS, HIGHLIGHT_OPACITY)
+        self.captions = CaptionTrack(segments)
+
+    def __call__(self, frame, t):
+        with span('highlight'):
+            highlighted = add_highlight_mask(frame, t, self.segment_index, self.blender)
+        sprite = self.captions.sprite_at(t)
+        if sprite is None:
+            return highlighted
+        with span('caption'):
+            if highlighted is frame:
+                # 解码器给出的帧不能原地修改，复制到复用的输出缓冲区
+                highlighted = self.blender.copy(frame)
+            return blit_caption(highlighted, sprite)
+
+# 渲染方式：moviepy 为单进程整段重新编码；chunked 为按片段边界切分时间线，
+# 无叠加内容的区间直接流复制，有叠加内容的区间由多个进程并行编码，最后拼接并合成音频
+RENDER_MODE = os.getenv('RENDER_MODE', 'moviepy')
+RENDER_WORKERS = int(os.getenv('RENDER_WORKERS', str(os.cpu_count() or 1)))
+FFMPEG_BINARY = os.getenv('FFMPEG_BINARY', 'ffmpeg')
+FFPROBE_BINARY = os.getenv('FFPROBE_BINARY', 'ffprobe')
+
+def ffprobe(video_path, *args):
+    result = subprocess.run([FFPROBE_BINARY, '-v', 'error', '-select_streams', 'v:0', *args, video_path],
+                            capture_output=True, text=True, check=True)
+    return result.stdout.strip()
+
+def probe_video(video_path):
+    """返回 (编码格式, 像素格式, 时长, 关键帧时间列表)"""
+    codec, pix_fmt = ffprobe(video_path, '-show_entries', 'stream=codec_name,pix_fmt', '-of', 'csv=p=0').split(',')[:2]
+    duration = float(ffprobe(video_path, '-show_entries', 'format=duration', '-of', 'csv=p=0'))
+    # 只读取包信息，不解码
+    keyframes = []
+    for line in ffprobe(video_path, '-show_entries', 'packet=pts_time,flags', '-of', 'csv=p=0').splitlines():
+        pts_time, _, flags = line.partition(',')
+        if 'K' in flags and pts_time not in ('', 'N/A'):
+            keyframes.append(float(pts_time))
+    return codec, pix_fmt, duration, sorted(keyframes)
+
+def annotated_intervals(segments):
+    """需要叠加高亮或标题的时间区间（已合并）"""
+    intervals = sorted(
+        (time_to_seconds(segment['start_time']), time_to_seconds(segment['end_time']))
+        for segment in segments['good_joint_attention_segments'] + segments['poor_joint_attention_segments']
+    )
+    merged = []
+    for start, end in intervals:
+        if start > end:
+            continue
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+def split_span(start, end, keyframes, max_length):
+    """在区间内部的关键帧处把 [start, end) 切成长度约为 max_length 的若干段"""
+    pieces = []
+    piece_start = start
+    for t in keyframes[bisect.bisect_right(keyframes, start):bisect.bisect_left(keyframes, end)]:
+        if t - piece_start >= max_length:
+            pieces.append((piece_start, t))
+            piece_start = t
+    pieces.append((piece_start, end))
+    return pieces
+
+def plan_spans(segments, duration, keyframes, max_length=None):
+    """将时间线切分为 (start, end, 是否需要重新编码) 的区间列表。
+
+    需要编码的区间向外对齐到关键帧，使流复制的区间总是从关键帧开始；
+    长于 max_length 的编码区间再在关键帧处切开，分给多个进程并行编码。
+    """
+    spans = []
+    for start, end in annotated_intervals(segments):
+        i = bisect.bisect_right(keyframes, start) - 1
+        j = bisect.bisect_right(keyframes, end)
+        start = keyframes[i] if i >= 0 else 0.0
+        end = keyframes[j] if j < len(keyframes) else duration
+        start, end = max(0.0, start), min(duration, end)
+        if start >= end:
+            continue
+        if spans and start <= spans[-1][1]:
+            spans[-1][1] = max(spans[-1][1], end)
+        else:
+            spans.append([start, end])
+
+    timeline = []
+    position = 0.0
+    for start, end in spans:
+        if start > position:
+            timeline.append((position, start, False))
+        pieces = split_span(start, end, keyframes, max_length) if max_length else [(start, end)]
+        timeline.extend((piece_start, piece_end, True) for piece_start, piece_end in pieces)
+        position = end
+    if position < duration:
+        timeline.append((position, duration, False))
+    return timeline
+
+# 所有区间都先写成 MPEG-TS（Annex-B，SPS/PPS 随关键帧带在码流中），
+# 流复制的区间与重新编码的区间参数集不同，拼接后每段仍能按自己的参数集解码
+def copy_span(video_path, start, end, output_path):
+    """不重新编码，直接复制 [start, end) 区间的视频流"""
+    subprocess.run([FFMPEG_BINARY, '-v', 'error', '-y', '-ss', f"{start:.6f}", '-i', video_path,
+                    '-t', f"{end - start:.6f}", '-map', '0:v:0', '-c', 'copy', '-an',
+                    '-bsf:v', 'h264_mp4toannexb', '-avoid_negative_ts', 'make_zero', '-f', 'mpegts',
+                    output_path], check=True)
+
+def encode_span(video_path, segments, start, end, pix_fmt, output_path):
+    """在工作进程中对 [start, end) 区间叠加高亮和标题并编码"""
+    # 进程池的工作进程退出时不执行 atexit，每个区间单独导出一份 trace
+    tracing.reset()
+    video = VideoFileClip(video_path, audio=False)
+    annotator = FrameAnnotator(segments)
+    clip = video.subclip(start, end)
+    # 子片段内的时间从 0 开始，查询高亮和标题时换算回整段视频的时间
+    annotated = clip.fl(lambda gf, t: annotator(gf(t), t + start))
+    annotated.write_videofile(output_path, codec="libx264", audio=False, fps=video.fps,
+                              ffmpeg_params=['-pix_fmt', pix_fmt, '-f', 'mpegts'], logger=None)
+    video.close()
+    tracing.export(f"combine_sgmt-span{start:.3f}")
+    return output_path
+
+def stream_duration(video_path):
+    return float(ffprobe(video_path, '-show_entries', 'stream=duration', '-of', 'csv=p=0'))
+
+def verify_output(output_path, source_path):
+    """完整解码拼接结果：不能有解码错误，帧数和时长与源视频一致"""
+    result = subprocess.run([FFMPEG_BINARY, '-v', 'error', '-i', output_path, '-map', '0:v:0', '-f', 'null', '-'],
+                            capture_output=True, text=True)
+    if result.returncode or result.stderr.strip():
+        raise RuntimeError(f"{output_path} does not decode cleanly: {result.stderr.strip()[:500]}")
+    expected_frames = int(ffprobe(source_path, '-count_packets', '-show_entries', 'stream=nb_read_packets',
+                                  '-of', 'csv=p=0'))
+    frames = int(ffprobe(output_path, '-count_frames', '-show_entries', 'stream=nb_read_frames', '-of', 'csv=p=0'))
+    expected_duration, duration = stream_duration(source_path), stream_duration(output_path)
+    # 时长允许相差一帧多一点（容器时间戳取整）
+    tolerance = 1.5 * expected_duration / max(1, expected_frames)
+    if frames != expected_frames or abs(duration - expected_duration) > tolerance:
+        raise RuntimeError(f"{output_path} has {frames} frames / {duration:.3f}s, "
+                           f"expected {expected_frames} frames / {expected_duration:.3f}s")
+
+def split_evenly(duration, parts):
+    step = duration / max(1, parts)
+    return [(k * step, duration if k == parts - 1 else (k + 1) * step) for k in range(max(1, parts))]
+
+def render_chunked(video_path, audio_path, segments, output_path, workers=RENDER_WORKERS):
+    codec, pix_fmt, duration, keyframes = probe_video(video_path)
+    if codec != 'h264':
+        # 只有与 libx264 输出格式一致时才能直接拼接流复制的区间，否则整段并行重新编码
+        print(f"Source codec {codec} is not h264, re-encoding every span")
+        keyframes = []
+        timeline = [(start, end, True) for start, end in split_evenly(duration, workers)]
+    else:
+        # 每个进程至少分到 duration / workers 的编码量，连续的长片段不会只由一个进程编码
+        timeline = plan_spans(segments, duration, keyframes, duration / max(1, workers))
+
+    work_dir = tempfile.mkdtemp(prefix='combine_sgmt_', dir=os.path.dirname(output_path))
+    try:
+        chunk_paths = []
+        futures = []
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for k, (start, end, annotate) in enumerate(timeline):
+                chunk_path = os.path.join(work_dir, f"chunk_{k:05d}.ts")
+                chunk_paths.append(chunk_path)
+                if annotate:
+                    futures.append(executor.submit(encode_span, video_path, segments, start, end, pix_fmt, chunk_path))
+                else:
+                    copy_span(video_path, start, end, chunk_path)
+            for future in futures:
+                future.result()
+
+        copied = sum(end - start for start, end, annotate in timeline if not annotate)
+        print(f"{len(timeline)} spans: {copied:.1f}s stream-copied, {duration - copied:.1f}s re-encoded")
+
+        # 拼接所有区间并合成外部音频，检查通过后才替换目标文件
+        list_path = os.path.join(work_dir, 'chunks.txt')
+        with open(list_path, 'w') as f:
+            for chunk_path in chunk_paths:
+                f.write(concat_list_entry(chunk_path))
+        combined_path = os.path.join(work_dir, 'combined.mp4')
+        subprocess.run([FFMPEG_BINARY, '-v', 'error', '-y', '-f', 'concat', '-safe', '0', '-i', list_path,
+                        '-i', audio_path, '-map', '0:v:0', '-map', '1:a:0', '-c:v', 'copy', '-c:a', 'aac',
+                        '-t', f"{duration:.6f}", combined_path], check=True)
+        verify_output(combined_path, video_path)
+        os.replace(combined_path, output_path)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def run(base_dir):
+    """在 -bbox.mp4 上叠加片段高亮和标题，并合成外部音频，结果保存到 {VIDEO_NAME}-combine.mp4"""
+    video_name = os.path.basename(base_dir)
+
+    # 定义图片文件夹路径和其他路径
+    video_path = os.path.join(base_dir, f'{video_name}-bbox.mp4')
+    audio_path = os.path.join(base_dir, f'{video_name}.wav')
+    segment_path = os.path.join(base_dir, f'{video_name}_gpt.json')
+    output_path = os.path.join(base_dir, f'{video_name}-combine.mp4')
+
+    # 从 key-event.json 读取片段信息
+    with open(segment_path, 'r') as f:
+        segments = json.load(f)
+
+    if RENDER_MODE == 'chunked':
+        render_chunked(video_path, audio_path, segments, output_path)
+        print(f"Annotated video saved to {output_path}")
+        return
+
+    # 加载原始视频
+    video = VideoFileClip(video_path)
+
+    # 加载外部音频
+    audio = AudioFileClip(audio_path)
+
+    # 片段区间只解析一次，标题只渲染一次（并缓存到磁盘）
+    annotator = FrameAnnotator(segments)
+
+    # 对整个视频逐帧叠加高亮蒙版和当前标题，保留音频
+    annotated_video = video.fl(lambda gf, t: annotator(gf(t), t))
+
+    # 将外部音频与视频结合
+    final_video = annotated_video.set_audio(audio)
+
+    # 输出视频，确保音频保留
+    final_video.write_videofile(output_path, codec="libx264", audio_codec="aac")
+
+    print(f"Annotated video saved to {output_path}")
+
+
+if __name__ == "__main__":
+    run(BASE_DIR)
@@ -0,0 +1,188 @@
+import hashlib
+import os
+
+import numpy as np
+
+from inference_backend import INFERENCE_BACKEND, load_backend
+from mask_store import decode_crop, encode_mask
+from tracing import span
+
+# 检测模型及其权重的标识，作为缓存键的一部分
+MODEL_NAME = 'maskrcnn_resnet50_fpn'
+WEIGHTS_NAME = 'coco-bf2d0c1e'
+SCORE_THRESHOLD = 0.5
+
+# 检测结果缓存目录，可在多个脚本、多次运行之间共享
+CACHE_DIR = os.getenv('DETECTION_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'segment', 'detections'))
+# 设置 DETECTION_CACHE=0 可以关闭缓存
+CACHE_ENABLED = os.getenv('DETECTION_CACHE', '1') == '1'
+# 缓存目录的大小上限（GB），超出后按最近使用时间淘汰最旧的条目
+CACHE_MAX_GB = float(os.getenv('DETECTION_CACHE_MAX_GB', '5'))
+# 缓存条目格式版本（掩码只保存紧致包围盒内的部分），作为缓存键的一部分，旧格式的条目不再被读取
+CACHE_FORMAT = 2
+# 非 eager 后端的结果与 eager 略有差异，缓存键中加上后端名称（eager 保持原来的键）
+CACHE_MODEL_NAME = MODEL_NAME if INFERENCE_BACKEND == 'eager' else f"{MODEL_NAME}+{INFERENCE_BACKEND}"
+
+_models = {}
+
+
+def load_model(backend=INFERENCE_BACKEND):
+    """加载指定后端的 Mask R-CNN 模型（每个后端只在第一次需要推理时加载）"""
+    if backend not in _models:
+        _models[backend] = load_backend(backend, WEIGHTS_NAME)
+    return _models[backend]
+
+
+def run_model(tensors, threshold=SCORE_THRESHOLD, native_size=False, backend=INFERENCE_BACKEND):
+    """对一批图像张量进行检测，返回 NumPy 格式的检测结果列表。
+
+    native_size=True 时按输入的原始分辨率推理（不缩放到最短边 800），用于同尺寸的小裁剪区域；
+    不支持的后端（torchscript、onnx）按默认大小推理。
+    """
+    model = load_model(backend)
+    tensors = list(tensors)
+    with span('model forward', backend=backend, batch=len(tensors)):
+        predictions = model(tensors, native_size=native_size and model.supports_native_size)
+    with span('postprocess', batch=len(tensors)):
+        return [predictions_to_detections(prediction, threshold) for prediction in predictions]
+
+
+def predictions_to_detections(prediction, threshold=SCORE_THRESHOLD):
+    """只保留置信度高于阈值的结果，掩码按原脚本的方式二值化 (>128)"""
+    keep = prediction['scores'] > threshold
+    return {
+        'boxes': prediction['boxes'][keep].cpu().numpy().astype(np.float32),
+        'labels': prediction['labels'][keep].cpu().numpy().astype(np.int64),
+        'scores': prediction['scores'][keep].cpu().numpy().astype(np.float32),
+        'masks': (prediction['masks'][keep, 0].mul(255).byte().cpu().numpy() > 128),
+    }
+
+
+def frame_hash(image):
+    """按帧内容计算哈希"""
+    h = hashlib.blake2b(digest_size=20)
+    h.update(str(image.shape).encode())
+    h.update(np.ascontiguousarray(image).data)
+    return h.hexdigest()
+
+
+class DetectionCache:
+    """以帧内容哈希 + 模型 + 权重 + 阈值为键的检测结果缓存"""
+
+    def __init__(self, cache_dir=CACHE_DIR, model_name=CACHE_MODEL_NAME, weights_name=WEIGHTS_NAME,
+                 threshold=SCORE_THRESHOLD, enabled=CACHE_ENABLED, max_bytes=int(CACHE_MAX_GB * 1e9)):
+        self.cache_dir = cache_dir
+        self.model_name = model_name
+        self.weights_name = weights_name
+        self.threshold = threshold
+        self.enabled = enabled
+        self.max_bytes = max_bytes
+        self.size = None  # 缓存目录当前大小，第一次写入时统计
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, image, extra=''):
+        h = hashlib.blake2b(digest_size=20)
+        h.update(f"{frame_hash(image)}|{self.model_name}|{self.weights_name}|{self.threshold}|{extra}|"
+                 f"v{CACHE_FORMAT}".encode())
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.npz")
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path) as data:
+                height, width = data['image_size'].tolist()
+                crops, offsets, packed = data['mask_crops'], data['mask_offsets'], data['masks']
+                masks = np.zeros((len(crops), height, width), dtype=bool)
+                for mask, (x0, y0, w, h), start, end in zip(masks, crops.tolist(), offsets[:-1], offsets[1:]):
+                    mask[y0:y0 + h, x0:x0 + w] = decode_crop(packed[start:end], w, h)
+                result = {
+                    'boxes': data['boxes'],
+                    'labels': data['labels'],
+                    'scores': data['scores'],
+                    'masks': masks,
+                }
+        except (OSError, KeyError, ValueError) as e:
+            print(f"Ignoring corrupt detection cache entry {path}: {e}")
+            return None
+        # 更新修改时间，淘汰时按最近使用排序
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return result
+
+    def put(self, key, detections):
+        if not self.enabled:
+            return
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        # 每个掩码只保存紧致包围盒内按位压缩的数据，与 mask_store 的格式相同
+        encoded = [encode_mask(mask) for mask in detections['masks']]
+        offsets = np.cumsum([0] + [len(data) for *_, data in encoded], dtype=np.int64)
+        with open(tmp_path, 'wb') as f:
+            np.savez_compressed(
+                f,
+                boxes=detections['boxes'],
+                labels=detections['labels'],
+                scores=detections['scores'],
+                masks=np.frombuffer(b''.join(data for *_, data in encoded), dtype=np.uint8),
+                mask_crops=np.array([crop for *crop, _ in encoded], dtype=np.int64).reshape(-1, 4),
+                mask_offsets=offsets,
+                image_size=np.array(detections['masks'].shape[1:], dtype=np.int64),
+            )
+        os.replace(tmp_path, path)
+        self._account(os.path.getsize(path))
+
+    def _entries(self):
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith('.npz'):
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    yield stat.st_mtime, stat.st_size, path
+
+    def _account(self, nbytes):
+        """累计写入的大小，超过上限时删除最久未使用的条目，直到降到上限的 90%"""
+        if self.size is None:
+            self.size = sum(size for _, size, _ in self._entries())
+        else:
+            self.size += nbytes
+        if self.size <= self.max_bytes:
+            return
+        # 其他进程也可能在写入，淘汰前重新统计
+        entries = sorted(self._entries())
+        self.size = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if self.size <= 0.9 * self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                self.size -= size
+            except OSError:
+                pass
+
+    def detect(self, keys, compute):
+        """先查缓存，只对未命中的帧调用 compute(indices) 进行推理"""
+        with span('cache read', frames=len(keys)):
+            results = [self.get(key) for key in keys]
+        missing = [i for i, result in enumerate(results) if result is None]
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+        if missing:
+            for i, detections in zip(missing, compute(missing)):
+                with span('cache write'):
+                    self.put(keys[i], detections)
+                results[i] = detections
+        return results
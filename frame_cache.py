@@ -0,0 +1,133 @@
+import os
+import threading
+from collections import OrderedDict
+
+import cv2
+
+from tracing import span
+
+# 标注工具的帧缓存：最多缓存的帧数，以及光标前后预先解码的帧数（按跳帧步长计）
+CACHE_FRAMES = int(os.getenv('LABEL_CACHE_FRAMES', '32'))
+PREFETCH_AHEAD = int(os.getenv('LABEL_PREFETCH_AHEAD', '16'))
+PREFETCH_BEHIND = int(os.getenv('LABEL_PREFETCH_BEHIND', '8'))
+# 目标帧在当前解码位置之后不超过该帧数时顺序解码过去，否则直接 seek
+MAX_SEQUENTIAL_GAP = int(os.getenv('LABEL_MAX_SEQUENTIAL_GAP', '120'))
+
+
+class FrameCache:
+    """在后台线程中解码光标前后的帧，放入有界的 LRU 缓存。
+
+    只缓存与光标相差 step 整数倍的帧（标注工具每次前进/后退 step 帧）；
+    解码尽量顺序进行，跳过的帧只 grab，只有向后跳或间隔太远时才 seek。
+    get() 返回 BGR 图像，超出视频末尾时返回 None。
+    """
+
+    def __init__(self, video_path, step=1, capacity=CACHE_FRAMES, ahead=PREFETCH_AHEAD, behind=PREFETCH_BEHIND,
+                 max_gap=MAX_SEQUENTIAL_GAP):
+        self.cap = cv2.VideoCapture(video_path)
+        if not self.cap.isOpened():
+            raise ValueError(f"Unable to open video file {video_path}")
+        total = int(self.cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        # 帧数未知时为 None，读到末尾后再确定
+        self.end = total if total > 0 else None
+        self.step = max(1, step)
+        self.capacity = max(1, capacity)
+        # 预取窗口不超过缓存容量，避免预取的帧互相挤出缓存
+        self.ahead = max(0, min(ahead, self.capacity - 1))
+        self.behind = max(0, min(behind, self.capacity - 1 - self.ahead))
+        self.max_gap = max_gap
+
+        self.frames = OrderedDict()
+        self.cursor = 0
+        self.position = 0  # 下一次 read/grab 得到的帧号
+        self.error = None
+        self.closed = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._decode_loop, name='frame-cache', daemon=True)
+        self.thread.start()
+
+    def _past_end(self, index):
+        return self.end is not None and index >= self.end
+
+    def _window(self):
+        """按优先级排列的预取帧号：光标、光标之后（由近到远）、光标之前（由远到近，便于一次 seek 后顺序解码）"""
+        cursor, step = self.cursor, self.step
+        behind = [cursor - k * step for k in range(self.behind, 0, -1) if cursor - k * step >= 0]
+        ahead = [cursor + k * step for k in range(1, self.ahead + 1)]
+        return [index for index in [cursor] + ahead + behind if not self._past_end(index)]
+
+    def _next_target(self):
+        for index in self._window():
+            if index not in self.frames:
+                return index
+        return None
+
+    def _store(self, index, frame):
+        self.frames[index] = frame
+        self.frames.move_to_end(index)
+        if len(self.frames) > self.capacity:
+            wanted = set(self._window())
+            # 优先淘汰窗口之外最久未使用的帧
+            victim = next((key for key in self.frames if key not in wanted), None)
+            if victim is None:
+                victim = next(iter(self.frames))
+            del self.frames[victim]
+
+    def _decode_loop(self):
+        try:
+            while True:
+                with self.condition:
+                    while not self.closed and self._next_target() is None:
+                        self.condition.wait()
+                    if self.closed:
+                        return
+                    target = self._next_target()
+                    position = self.position
+
+                # 解码在锁外进行，光标可以随时移动；每次只处理一帧，以便及时响应新的光标位置
+                if target < position or target - position > self.max_gap:
+                    self.cap.set(cv2.CAP_PROP_POS_FRAMES, target)
+                    position = target
+                if position == target:
+                    with span('decode', frame=position):
+                        ret, frame = self.cap.read()
+                else:
+                    ret, frame = self.cap.grab(), None
+
+                with self.condition:
+                    if ret:
+                        self.position = position + 1
+                        if frame is not None:
+                            self._store(position, frame)
+                    else:
+                        # 实际帧数可能少于容器中记录的帧数
+                        self.end = position if self.end is None else min(self.end, position)
+                        self.position = position
+                    self.condition.notify_all()
+        except Exception as e:
+            with self.condition:
+                self.error = e
+                self.condition.notify_all()
+
+    def get(self, index):
+        """将光标移到 index 并返回该帧，未缓存时等待后台线程解码"""
+        with self.condition:
+            self.cursor = index
+            self.condition.notify_all()
+            while index not in self.frames and not self._past_end(index):
+                if self.error is not None:
+                    raise self.error
+                if self.closed:
+                    return None
+                self.condition.wait()
+            frame = self.frames.get(index)
+            if frame is not None:
+                self.frames.move_to_end(index)
+            return frame
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join()
+        self.cap.release()
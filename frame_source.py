@@ -0,0 +1,169 @@
+import os
+import queue
+import threading
+from collections import namedtuple
+
+import cv2
+import numpy as np
+
+from gaze_store import first_frame_number
+from tracing import span
+
+# 抽帧参数：步长、起止时间（秒），均可通过环境变量设置
+FRAME_STRIDE = int(os.getenv('FRAME_STRIDE', '1'))
+START_TIME = float(os.getenv('START_TIME')) if os.getenv('START_TIME') else None
+END_TIME = float(os.getenv('END_TIME')) if os.getenv('END_TIME') else None
+# 视频中第一帧对应的帧号（与 -gaze.json 中的帧号保持一致）；
+# 未设置时取 -gaze.json 中最小的帧号，没有 gaze 数据时为 0。不依赖 frames/ 目录，删除 frames/ 后编号不变
+FRAME_START_NUMBER = int(os.getenv('FRAME_START_NUMBER')) if os.getenv('FRAME_START_NUMBER') else None
+# 没有视频文件时（只有 frames/ 目录）使用的帧率
+DEFAULT_FPS = float(os.getenv('DEFAULT_FPS', '30'))
+
+# number: 帧号, time: 时间戳（秒）, name: 兼容 frames/ 目录的文件名, image: RGB 的 NumPy 数组
+Frame = namedtuple('Frame', ['number', 'time', 'name', 'image'])
+
+
+class FrameSource:
+    """按需从 {VIDEO_NAME}.mp4 解码帧；没有视频时回退到 frames/ 目录"""
+
+    def __init__(self, base_dir, stride=FRAME_STRIDE, start_time=START_TIME, end_time=END_TIME,
+                 start_frame=None, end_frame=None, start_number=FRAME_START_NUMBER):
+        video_name = os.path.basename(base_dir)
+        self.video_path = os.path.join(base_dir, f'{video_name}.mp4')
+        self.frames_dir = os.path.join(base_dir, 'frames')
+        self.stride = max(1, stride)
+        self.start_time = start_time
+        self.end_time = end_time
+        self.start_frame = start_frame
+        self.end_frame = end_frame
+        # frames/ 目录中实际存在的帧号（升序）
+        self.numbers = self._frame_numbers() if os.path.exists(self.frames_dir) else []
+        if start_number is None:
+            start_number = first_frame_number(base_dir)
+        self.start_number = 0 if start_number is None else start_number
+
+        if os.path.exists(self.video_path):
+            self.from_video = True
+            cap = cv2.VideoCapture(self.video_path)
+            self.fps = cap.get(cv2.CAP_PROP_FPS) or DEFAULT_FPS
+            self.total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+            cap.release()
+        elif os.path.exists(self.frames_dir):
+            self.from_video = False
+            self.fps = DEFAULT_FPS
+            self.total_frames = len(self.numbers)
+        else:
+            raise ValueError(f"Neither video {self.video_path} nor frames folder {self.frames_dir} found")
+
+    # 将时间范围与帧范围统一换算成帧号范围 [first, last)；frames/ 目录按实际存在的帧号计算
+    def frame_range(self):
+        if self.from_video:
+            first = self.start_number
+            last = self.start_number + self.total_frames
+        elif self.numbers:
+            first, last = self.numbers[0], self.numbers[-1] + 1
+        else:
+            first = last = self.start_number
+        if self.start_time is not None:
+            first = max(first, self.start_number + int(round(self.start_time * self.fps)))
+        if self.end_time is not None:
+            last = min(last, self.start_number + int(round(self.end_time * self.fps)) + 1)
+        if self.start_frame is not None:
+            first = max(first, self.start_frame)
+        if self.end_frame is not None:
+            last = min(last, self.end_frame)
+        return first, last
+
+    def __len__(self):
+        if not self.from_video:
+            return len(self._selected_numbers())
+        first, last = self.frame_range()
+        return max(0, (last - first + self.stride - 1) // self.stride)
+
+    def __iter__(self):
+        if self.from_video:
+            return self._iter_video()
+        return self._iter_frames_dir()
+
+    def _make_frame(self, number, image):
+        return Frame(number, (number - self.start_number) / self.fps, f"{number}.jpg", image)
+
+    def _iter_video(self):
+        first, last = self.frame_range()
+        cap = cv2.VideoCapture(self.video_path)
+        try:
+            if first > self.start_number:
+                cap.set(cv2.CAP_PROP_POS_FRAMES, first - self.start_number)
+            number = first
+            while number < last:
+                if (number - first) % self.stride:
+                    # 跳过的帧只 grab，不做颜色转换
+                    if not cap.grab():
+                        break
+                    number += 1
+                    continue
+                with span('decode', frame=number):
+                    ret, frame = cap.read()
+                    if not ret:
+                        break
+                    image = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+                yield self._make_frame(number, image)
+                number += 1
+        finally:
+            cap.release()
+
+    def _frame_numbers(self):
+        files = [f for f in os.listdir(self.frames_dir) if f.endswith(('.jpg', '.png'))]
+        self.frame_files = {int(os.path.splitext(f)[0]): f for f in files}
+        return sorted(self.frame_files)
+
+    def _selected_numbers(self):
+        """frames/ 目录中位于帧号范围内、且符合步长的帧号"""
+        first, last = self.frame_range()
+        return [number for number in self.numbers if first <= number < last and not (number - first) % self.stride]
+
+    def _iter_frames_dir(self):
+        from PIL import Image
+        for number in self._selected_numbers():
+            frame_file = self.frame_files[number]
+            with span('decode', frame=number):
+                image = np.array(Image.open(os.path.join(self.frames_dir, frame_file)).convert("RGB"))
+            yield Frame(number, (number - self.start_number) / self.fps, frame_file, image)
+
+
+_END = object()
+
+
+def prefetch(iterable, depth=4):
+    """在后台线程中提前迭代 iterable，最多缓存 depth 个元素"""
+    buffer = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def producer():
+        try:
+            for item in iterable:
+                if stop.is_set():
+                    return
+                buffer.put(item)
+            buffer.put(_END)
+        except BaseException as e:
+            buffer.put(e)
+
+    thread = threading.Thread(target=producer, name='prefetch', daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = buffer.get()
+            if item is _END:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        # 释放可能阻塞在 put 上的生产线程
+        while thread.is_alive():
+            try:
+                buffer.get_nowait()
+            except queue.Empty:
+                thread.join(timeout=0.1)
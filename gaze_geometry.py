@@ -0,0 +1,100 @@
+import numpy as np
+
+from tracing import traced
+
+
+def gaze_rays(head_bboxes, gazes, gaze_len):
+    """按脚本中的方式计算视线线段：起点为头部框中心，终点为 center - gaze_len * gaze。
+
+    head_bboxes: (..., P, 4)，gazes: (..., P, 2)；返回整数坐标的 starts, ends，形状均为 (..., P, 2)
+    """
+    head_bboxes = np.asarray(head_bboxes, dtype=np.float64)
+    gazes = np.asarray(gazes, dtype=np.float64)
+    if head_bboxes.size == 0:
+        head_bboxes, gazes = head_bboxes.reshape(0, 4), gazes.reshape(0, 2)
+    starts = np.stack([
+        (head_bboxes[..., 0] + head_bboxes[..., 2]) // 2,
+        (head_bboxes[..., 1] + head_bboxes[..., 3]) // 2,
+    ], axis=-1).astype(np.int64)
+    ends = np.trunc(starts - gaze_len * gazes).astype(np.int64)
+    return starts, ends
+
+
+def corridor_tiles(start, end, width, tile_size, image_size, max_length=None):
+    """沿视线线段放置边长为 tile_size 的正方形区域，覆盖线段两侧总宽为 width 的走廊。
+
+    相邻区域中心沿线段间隔 tile_size - width，区域平移到图像内部（图像比 tile_size 小时取图像大小），
+    走廊完全在图像外的部分不放置。image_size 为 (height, width)；返回去重后的 (K, 4) 整数数组 (x0, y0, x1, y1)。
+    """
+    height, image_width = image_size
+    start = np.asarray(start, dtype=np.float64)
+    end = np.asarray(end, dtype=np.float64)
+    length = np.hypot(*(end - start))
+    if max_length is not None and length > max_length:
+        end = start + (end - start) * (max_length / length)
+        length = max_length
+
+    step = max(1.0, tile_size - width)
+    t = np.linspace(0.0, 1.0, int(np.ceil(length / step)) + 1)
+    centers = start + t[:, None] * (end - start)
+    margin = width / 2
+    inside = ((centers[:, 0] >= -margin) & (centers[:, 0] < image_width + margin)
+              & (centers[:, 1] >= -margin) & (centers[:, 1] < height + margin))
+    centers = centers[inside]
+
+    size_x, size_y = min(tile_size, image_width), min(tile_size, height)
+    x0 = np.clip(np.round(centers[:, 0] - size_x / 2), 0, image_width - size_x).astype(np.int64)
+    y0 = np.clip(np.round(centers[:, 1] - size_y / 2), 0, height - size_y).astype(np.int64)
+    return np.unique(np.stack([x0, y0, x0 + size_x, y0 + size_y], axis=1).reshape(-1, 4), axis=0)
+
+
+@traced('ray tests')
+def segment_box_hits(starts, ends, boxes):
+    """一次性判断所有视线线段与所有边界框是否相交（向量化的 Liang-Barsky 裁剪）。
+
+    starts, ends: (..., P, 2)；boxes: (..., B, 4)，格式为 (xmin, ymin, xmax, ymax)。
+    与 cv2.clipLine((xmin, ymin, xmax - xmin, ymax - ymin), start, end) 的判定一致，
+    即矩形覆盖的像素范围为 [xmin, xmax - 1] x [ymin, ymax - 1]。
+    返回 hits (..., P, B) 布尔矩阵，以及 distances (..., P, B)：起点到进入框的距离，未命中为 inf。
+    """
+    starts = np.asarray(starts, dtype=np.float64)[..., :, None, :]
+    ends = np.asarray(ends, dtype=np.float64)[..., :, None, :]
+    boxes = np.asarray(boxes, dtype=np.float64)[..., None, :, :]
+
+    x0, y0 = starts[..., 0], starts[..., 1]
+    dx, dy = ends[..., 0] - x0, ends[..., 1] - y0
+    left, top = boxes[..., 0], boxes[..., 1]
+    right, bottom = boxes[..., 2] - 1, boxes[..., 3] - 1
+
+    # 四条边的 p、q：p * t <= q
+    p = np.stack(np.broadcast_arrays(-dx, dx, -dy, dy))
+    q = np.stack(np.broadcast_arrays(x0 - left, right - x0, y0 - top, bottom - y0))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = q / p
+    entering = np.where(p < 0, ratio, -np.inf).max(axis=0)
+    leaving = np.where(p > 0, ratio, np.inf).min(axis=0)
+    t_enter = np.maximum(entering, 0.0)
+    t_leave = np.minimum(leaving, 1.0)
+
+    parallel_outside = ((p == 0) & (q < 0)).any(axis=0)
+    empty_box = (right < left) | (bottom < top)
+    hits = (t_enter <= t_leave) & ~parallel_outside & ~empty_box
+
+    distances = np.where(hits, t_enter * np.hypot(dx, dy), np.inf)
+    return hits, distances
+
+
+def nearest_hits(hits, distances):
+    """为每条视线选出最近的命中框编号，没有命中时为 -1"""
+    nearest = np.argmin(distances, axis=-1)
+    return np.where(hits.any(axis=-1), nearest, -1)
+
+
+def person_gaze_hits(starts, ends, head_bboxes):
+    """人与人之间的视线命中矩阵，hits[i, j] 表示第 i 个人的视线打在第 j 个人的头上（不含自身）"""
+    hits, distances = segment_box_hits(starts, ends, head_bboxes)
+    eye = np.eye(hits.shape[-1], dtype=bool)
+    hits = hits & ~eye
+    distances = np.where(eye, np.inf, distances)
+    return hits, distances
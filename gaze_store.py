@@ -0,0 +1,144 @@
+import json
+import os
+
+import numpy as np
+
+# 列式存储的各个数组文件，均可以 mmap 方式打开
+COLUMNS = ('frame', 'person', 'gaze', 'head_bbox')
+INDEX_COLUMNS = ('index_frame', 'index_start', 'index_end')
+
+
+def store_dir(base_dir):
+    video_name = os.path.basename(base_dir)
+    return os.path.join(base_dir, f'{video_name}-gaze')
+
+
+def json_path(base_dir):
+    video_name = os.path.basename(base_dir)
+    return os.path.join(base_dir, f'{video_name}-gaze.json')
+
+
+def is_current(base_dir):
+    """列式数据已转换完成且不比 -gaze.json 旧"""
+    persons_path = os.path.join(store_dir(base_dir), 'persons.json')
+    meta_path = os.path.join(store_dir(base_dir), 'meta.json')
+    if not os.path.exists(persons_path) or not os.path.exists(meta_path):
+        return False
+    source = json_path(base_dir)
+    return not os.path.exists(source) or os.path.getmtime(source) <= os.path.getmtime(persons_path)
+
+
+def first_frame_number(base_dir):
+    """-gaze.json 中最小的帧号（包括没有人的帧），没有 gaze 数据时返回 None"""
+    if is_current(base_dir):
+        with open(os.path.join(store_dir(base_dir), 'meta.json'), 'r') as f:
+            return json.load(f)['first_frame']
+    if not os.path.exists(json_path(base_dir)):
+        return None
+    with open(json_path(base_dir), 'r') as f:
+        return min((int(frame_number) for frame_number in json.load(f)), default=None)
+
+
+def convert_gaze_json(json_path, out_dir):
+    """将 {frame: {person_id: {gaze, head_bbox}}} 格式的 -gaze.json 转换为列式数组"""
+    with open(json_path, 'r') as f:
+        gaze_data = json.load(f)
+    first_frame = min((int(frame_number) for frame_number in gaze_data), default=None)
+
+    person_names = []
+    person_index = {}
+    frames, persons, gazes, bboxes = [], [], [], []
+    for frame_number in sorted(gaze_data, key=int):
+        gaze_info = gaze_data[frame_number]
+        if not gaze_info:
+            continue
+        for person_id, data in gaze_info.items():
+            if person_id not in person_index:
+                person_index[person_id] = len(person_names)
+                person_names.append(person_id)
+            frames.append(int(frame_number))
+            persons.append(person_index[person_id])
+            gazes.append(data['gaze'][:2])
+            bboxes.append(data['head_bbox'][:4])
+
+    frame = np.array(frames, dtype=np.int64)
+    # 帧号 -> 行范围 [start, end)
+    index_frame, index_start = np.unique(frame, return_index=True)
+    index_end = np.append(index_start[1:], len(frame))
+
+    os.makedirs(out_dir, exist_ok=True)
+    arrays = {
+        'frame': frame,
+        'person': np.array(persons, dtype=np.int32),
+        'gaze': np.array(gazes, dtype=np.float64).reshape(-1, 2),
+        'head_bbox': np.array(bboxes, dtype=np.float64).reshape(-1, 4),
+        'index_frame': index_frame,
+        'index_start': index_start.astype(np.int64),
+        'index_end': index_end.astype(np.int64),
+    }
+    for name, array in arrays.items():
+        np.save(os.path.join(out_dir, f'{name}.npy'), array)
+    with open(os.path.join(out_dir, 'meta.json'), 'w') as f:
+        json.dump({'first_frame': first_frame}, f)
+    # persons.json 最后写入，作为转换完成的标志
+    with open(os.path.join(out_dir, 'persons.json'), 'w') as f:
+        json.dump(person_names, f)
+
+
+class GazeStore:
+    """内存映射的列式 gaze 数据：frame, person, gaze (x, y), head_bbox，以及帧号到行范围的索引"""
+
+    def __init__(self, base_dir):
+        self.path = store_dir(base_dir)
+
+        # 列式数据不存在或比 JSON 旧时重新转换
+        if not is_current(base_dir):
+            print(f"Converting {json_path(base_dir)} to columnar store {self.path}")
+            convert_gaze_json(json_path(base_dir), self.path)
+
+        with open(os.path.join(self.path, 'persons.json'), 'r') as f:
+            self.person_names = json.load(f)
+        with open(os.path.join(self.path, 'meta.json'), 'r') as f:
+            self.first_frame = json.load(f)['first_frame']
+        for name in COLUMNS + INDEX_COLUMNS:
+            setattr(self, name, np.load(os.path.join(self.path, f'{name}.npy'), mmap_mode='r'))
+
+    def __len__(self):
+        return len(self.index_frame)
+
+    def rows(self, frame_number):
+        """返回该帧的行范围 (start, end)，没有数据时返回 None"""
+        frame_number = int(frame_number)
+        i = np.searchsorted(self.index_frame, frame_number)
+        if i >= len(self.index_frame) or self.index_frame[i] != frame_number:
+            return None
+        return int(self.index_start[i]), int(self.index_end[i])
+
+    def get(self, frame_number):
+        """返回该帧的 (person_ids, gaze (P, 2), head_bbox (P, 4))，没有数据时返回 None"""
+        rows = self.rows(frame_number)
+        if rows is None:
+            return None
+        start, end = rows
+        person_ids = [self.person_names[p] for p in self.person[start:end]]
+        return person_ids, self.gaze[start:end], self.head_bbox[start:end]
+
+    def padded(self):
+        """按帧补齐成 (F, P, ...) 数组，便于整段视频一次性做向量化视线计算。
+
+        返回 frames (F,), person (F, P), gaze (F, P, 2), head_bbox (F, P, 4), valid (F, P)
+        """
+        counts = np.asarray(self.index_end) - np.asarray(self.index_start)
+        width = int(counts.max()) if len(counts) else 0
+        row_frame = np.repeat(np.arange(len(counts)), counts)
+        slot = np.arange(len(self.frame)) - np.repeat(np.asarray(self.index_start), counts)
+
+        valid = np.zeros((len(counts), width), dtype=bool)
+        person = np.full((len(counts), width), -1, dtype=np.int32)
+        gaze = np.zeros((len(counts), width, 2), dtype=np.float64)
+        head_bbox = np.zeros((len(counts), width, 4), dtype=np.float64)
+        valid[row_frame, slot] = True
+        person[row_frame, slot] = self.person
+        gaze[row_frame, slot] = self.gaze
+        head_bbox[row_frame, slot] = self.head_bbox
+        return np.asarray(self.index_frame), person, gaze, head_bbox, valid
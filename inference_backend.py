@@ -0,0 +1,271 @@
+import os
+import time
+
+import numpy as np
+
+# 推理后端：eager（torchvision 原始模型）、torchscript、onnx（ONNX Runtime）、
+# int8-dynamic（Linear 层动态量化）、int8-static（主干网络静态量化，需要校准帧）
+INFERENCE_BACKEND = os.getenv('INFERENCE_BACKEND', 'eager')
+BACKENDS = ('eager', 'torchscript', 'onnx', 'int8-dynamic', 'int8-static')
+# 导出/量化后的模型缓存目录
+ARTIFACT_DIR = os.getenv('INFERENCE_ARTIFACT_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'segment', 'models'))
+# int8-static 的校准视频，以及从中均匀抽取的帧数
+CALIBRATION_VIDEO = os.getenv('CALIBRATION_VIDEO')
+CALIBRATION_FRAMES = int(os.getenv('CALIBRATION_FRAMES', '32'))
+# 对比模式：参与比较的后端与抽取的帧数
+COMPARE_BACKENDS = [name for name in os.getenv('COMPARE_BACKENDS', ','.join(BACKENDS)).split(',') if name]
+COMPARE_FRAMES = int(os.getenv('COMPARE_FRAMES', '16'))
+# ONNX 导出时使用的输入大小（导出后高宽仍可变化）
+EXPORT_SIZE = (800, 800)
+
+
+def build_eager_model():
+    import torchvision
+    model = torchvision.models.detection.maskrcnn_resnet50_fpn(pretrained=True)
+    model.eval()
+    return model
+
+
+def artifact_path(backend, weights_name, extension):
+    import torch
+    version = torch.__version__.split('+')[0]
+    return os.path.join(ARTIFACT_DIR, f"maskrcnn_resnet50_fpn-{weights_name}-{backend}-torch{version}.{extension}")
+
+
+def save_artifact(path, save):
+    """先写到临时文件再替换，避免并行任务读到写了一半的文件"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    save(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def calibration_tensors(video_path=CALIBRATION_VIDEO, count=CALIBRATION_FRAMES):
+    """从校准视频中均匀抽取若干帧，转换为模型输入张量"""
+    import cv2
+    import torchvision.transforms.functional as F
+    if not video_path or not os.path.exists(video_path):
+        raise ValueError("int8-static needs calibration frames: set CALIBRATION_VIDEO to a representative clip")
+    cap = cv2.VideoCapture(video_path)
+    total = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    tensors = []
+    for index in np.linspace(0, max(0, total - 1), count).astype(int):
+        cap.set(cv2.CAP_PROP_POS_FRAMES, int(index))
+        ret, frame = cap.read()
+        if ret:
+            tensors.append(F.to_tensor(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)))
+    cap.release()
+    return tensors
+
+
+class EagerBackend:
+    """torchvision 模型（也用于量化后的模型），支持按原始分辨率推理"""
+
+    supports_native_size = True
+
+    def __init__(self, model):
+        self.model = model
+
+    def __call__(self, tensors, native_size=False):
+        import torch
+        transform = self.model.transform
+        saved_sizes = transform.min_size, transform.max_size
+        if native_size:
+            height, width = tensors[0].shape[-2:]
+            if any(tuple(t.shape[-2:]) != (height, width) for t in tensors):
+                raise ValueError("native_size requires all tensors in a batch to have the same size")
+            transform.min_size, transform.max_size = (min(height, width),), max(height, width)
+        try:
+            with torch.no_grad():
+                return self.model(list(tensors))
+        finally:
+            transform.min_size, transform.max_size = saved_sizes
+
+
+class TorchScriptBackend:
+    # 脚本化模型的预处理参数无法在运行时修改
+    supports_native_size = False
+
+    def __init__(self, module):
+        self.module = module
+
+    def __call__(self, tensors, native_size=False):
+        import torch
+        with torch.no_grad():
+            # 脚本化的检测模型返回 (losses, detections)
+            _, predictions = self.module(list(tensors))
+        return predictions
+
+
+class OnnxBackend:
+    supports_native_size = False
+
+    def __init__(self, session):
+        self.session = session
+        self.input_name = session.get_inputs()[0].name
+
+    def __call__(self, tensors, native_size=False):
+        import torch
+        predictions = []
+        # 导出的模型每次处理一张图像
+        for tensor in tensors:
+            boxes, labels, scores, masks = self.session.run(None, {self.input_name: tensor.cpu().numpy()})
+            predictions.append({
+                'boxes': torch.from_numpy(boxes),
+                'labels': torch.from_numpy(labels),
+                'scores': torch.from_numpy(scores),
+                'masks': torch.from_numpy(masks),
+            })
+        return predictions
+
+
+def load_torchscript(weights_name):
+    import torch
+    path = artifact_path('torchscript', weights_name, 'pt')
+    if not os.path.exists(path):
+        scripted = torch.jit.script(build_eager_model())
+        save_artifact(path, scripted.save)
+    return TorchScriptBackend(torch.jit.load(path, map_location='cpu'))
+
+
+def load_onnx(weights_name):
+    import onnxruntime
+    import torch
+    path = artifact_path('onnx', weights_name, 'onnx')
+    if not os.path.exists(path):
+        model = build_eager_model()
+        dummy = [torch.rand(3, *EXPORT_SIZE)]
+
+        def export(tmp_path):
+            torch.onnx.export(
+                model, (dummy,), tmp_path, opset_version=11,
+                input_names=['image'], output_names=['boxes', 'labels', 'scores', 'masks'],
+                dynamic_axes={'image': [1, 2], 'boxes': [0], 'labels': [0], 'scores': [0], 'masks': [0, 1, 2, 3]},
+            )
+        save_artifact(path, export)
+    options = onnxruntime.SessionOptions()
+    options.intra_op_num_threads = int(os.getenv('OMP_NUM_THREADS', '0'))
+    return OnnxBackend(onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider']))
+
+
+def load_int8_dynamic(weights_name):
+    """所有全连接层（box head 的 fc6/fc7 以及 box predictor 的分类/回归层）按 int8 动态量化，卷积部分保持 fp32"""
+    import torch
+    path = artifact_path('int8-dynamic', weights_name, 'pt')
+    if not os.path.exists(path):
+        model = torch.ao.quantization.quantize_dynamic(build_eager_model(), {torch.nn.Linear}, dtype=torch.qint8)
+        save_artifact(path, lambda tmp_path: torch.save(model, tmp_path))
+    return EagerBackend(torch.load(path, map_location='cpu', weights_only=False))
+
+
+def load_int8_static(weights_name):
+    """ResNet 主干按 int8 静态量化（FX 模式，用校准帧统计激活范围），FPN、RPN 和各个 head 保持 fp32"""
+    import torch
+    path = artifact_path('int8-static', weights_name, 'pt')
+    if not os.path.exists(path):
+        from torch.ao.quantization import get_default_qconfig_mapping
+        from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+        model = build_eager_model()
+        body = model.backbone.body
+        prepared = prepare_fx(body, get_default_qconfig_mapping('fbgemm'), (torch.rand(1, 3, *EXPORT_SIZE),))
+        model.backbone.body = prepared
+        with torch.no_grad():
+            for tensor in calibration_tensors():
+                model([tensor])
+        model.backbone.body = convert_fx(prepared)
+        save_artifact(path, lambda tmp_path: torch.save(model, tmp_path))
+    return EagerBackend(torch.load(path, map_location='cpu', weights_only=False))
+
+
+def load_backend(backend, weights_name):
+    """按名称加载推理后端，导出或量化的结果缓存在 ARTIFACT_DIR 中"""
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown INFERENCE_BACKEND {backend!r}, expected one of {', '.join(BACKENDS)}")
+    if backend == 'eager':
+        return EagerBackend(build_eager_model())
+    loaders = {
+        'torchscript': load_torchscript,
+        'onnx': load_onnx,
+        'int8-dynamic': load_int8_dynamic,
+        'int8-static': load_int8_static,
+    }
+    return loaders[backend](weights_name)
+
+
+def match_detections(reference, candidate, iou_threshold=0.5):
+    """按同类别、IoU 从大到小贪心匹配两组检测结果，返回匹配对的 IoU 列表"""
+    from tracker import box_iou
+    if not len(reference['boxes']) or not len(candidate['boxes']):
+        return []
+    iou = box_iou(reference['boxes'], candidate['boxes'])
+    iou[reference['labels'][:, None] != candidate['labels'][None, :]] = 0
+    used_reference, used_candidate, matched = set(), set(), []
+    for flat in np.argsort(-iou, axis=None):
+        i, j = np.unravel_index(flat, iou.shape)
+        if iou[i, j] < iou_threshold:
+            break
+        if i not in used_reference and j not in used_candidate:
+            used_reference.add(i)
+            used_candidate.add(j)
+            matched.append(float(iou[i, j]))
+    return matched
+
+
+def compare_backends(tensors, backends):
+    """以 eager 为基准，比较各后端的延迟以及检测框/类别的一致性，返回每个后端一行的结果"""
+    from detection import run_model
+    rows = []
+    baseline = baseline_latency = None
+    for backend in ('eager',) + tuple(b for b in backends if b != 'eager'):
+        run_model(tensors[:1], backend=backend)  # 预热（以及首次导出/量化）
+        latencies, results = [], []
+        for tensor in tensors:
+            start = time.perf_counter()
+            results.extend(run_model([tensor], backend=backend))
+            latencies.append(time.perf_counter() - start)
+        mean_latency = float(np.mean(latencies))
+        if baseline is None:
+            baseline, baseline_latency = results, mean_latency
+        reference_count = sum(len(r['boxes']) for r in baseline)
+        candidate_count = sum(len(r['boxes']) for r in results)
+        matched = [iou for reference, candidate in zip(baseline, results)
+                   for iou in match_detections(reference, candidate)]
+        rows.append({
+            'backend': backend,
+            'mean_ms': 1000 * mean_latency,
+            'p50_ms': 1000 * float(np.percentile(latencies, 50)),
+            'p90_ms': 1000 * float(np.percentile(latencies, 90)),
+            # 相对 eager 的加速比
+            'speedup': baseline_latency / mean_latency,
+            'detections': candidate_count,
+            # 基准中的框被找回的比例、该后端的框与基准一致的比例、匹配框的平均 IoU
+            'recall': len(matched) / reference_count if reference_count else 1.0,
+            'precision': len(matched) / candidate_count if candidate_count else 1.0,
+            'mean_iou': float(np.mean(matched)) if matched else 0.0,
+        })
+    return rows
+
+
+def print_comparison(rows):
+    print(f"{'backend':<14} {'mean ms':>9} {'p50 ms':>9} {'p90 ms':>9} {'speedup':>8} "
+          f"{'dets':>6} {'recall':>7} {'precision':>9} {'mean IoU':>9}")
+    for row in rows:
+        print(f"{row['backend']:<14} {row['mean_ms']:9.1f} {row['p50_ms']:9.1f} {row['p90_ms']:9.1f} "
+              f"{row['speedup']:7.2f}x {row['detections']:6d} {row['recall']:7.1%} {row['precision']:9.1%} "
+              f"{row['mean_iou']:9.3f}")
+
+
+def compare_clip(base_dir, backends, num_frames=COMPARE_FRAMES):
+    """从片段中均匀抽取 num_frames 帧，比较各后端并打印结果"""
+    import torchvision.transforms.functional as F
+    from frame_source import FrameSource
+    source = FrameSource(base_dir)
+    source.stride = max(1, len(source) // max(1, num_frames))
+    tensors = [F.to_tensor(frame.image) for frame, _ in zip(source, range(num_frames))]
+    rows = compare_backends(tensors, backends)
+    print_comparison(rows)
+    return rows
+
+
+if __name__ == "__main__":
+    compare_clip(os.getenv('BASE_DIR', '.'), COMPARE_BACKENDS)
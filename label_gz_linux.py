@@ -1,6 +1,7 @@
 import os
 import cv2
 import pandas as pd
+from frame_cache import FrameCache
 from tkinter import Tk, Button, Label
 
 # Load annotations or initialize if file does not exist
@@ -15,9 +16,9 @@ def load_annotations():
 def update_frame():
     global frame_index, child_label, parent_label
 
-    cap.set(cv2.CAP_PROP_POS_FRAMES, frame_index)
-    ret, frame = cap.read()
-    if not ret:
+    # Frames are decoded ahead of time by a background thread, no seek per click
+    frame = frames.get(frame_index)
+    if frame is None:
         print("End of video.")
         return False  # Signal that video has ended
 
@@ -81,22 +82,31 @@ def update_status_text():
     frame_index_label.config(text=f"Current Frame: {frame_index}")
 
 def on_closing():
-    cap.release()
+    frames.close()
     cv2.destroyAllWindows()
     root.destroy()
 
-def main():
-    global cap, frame_index, child_label, parent_label, annotations, csv_path
+def main(video_path=None, annotations_csv=None):
+    global frames, frame_index, child_label, parent_label, annotations, csv_path
     global child_status_label, parent_status_label, frame_index_label, root
 
-    video_path = "/home/weiyan/Desktop/Dataset_mp4/Piaget - Object permanence failure (Sensorimotor Stage)/Piaget - Object permanence failure (Sensorimotor Stage).mp4"
-    video_name = os.path.splitext(os.path.basename(video_path))[0]
-    csv_path = f"/home/weiyan/Desktop/Dataset_mp4/{video_name}/{video_name}_annotations.csv"
-    video_path = "/home/weiyan/Desktop/Dataset_mp4/Piaget - Object permanence failure (Sensorimotor Stage)/Piaget - Object permanence failure (Sensorimotor Stage)-gaze.mp4"
+    if video_path is None:
+        video_path = "/home/weiyan/Desktop/Dataset_mp4/Piaget - Object permanence failure (Sensorimotor Stage)/Piaget - Object permanence failure (Sensorimotor Stage).mp4"
+        video_name = os.path.splitext(os.path.basename(video_path))[0]
+        csv_path = f"/home/weiyan/Desktop/Dataset_mp4/{video_name}/{video_name}_annotations.csv"
+        video_path = "/home/weiyan/Desktop/Dataset_mp4/Piaget - Object permanence failure (Sensorimotor Stage)/Piaget - Object permanence failure (Sensorimotor Stage)-gaze.mp4"
+    else:
+        # Save annotations next to the video by default
+        video_name = os.path.splitext(os.path.basename(video_path))[0]
+        csv_path = os.path.join(os.path.dirname(video_path), f"{video_name}_annotations.csv")
+    if annotations_csv is not None:
+        csv_path = annotations_csv
     
     load_annotations()
-    cap = cv2.VideoCapture(video_path)
-    if not cap.isOpened():
+    try:
+        # Next/Previous move 8 frames, so prefetch every 8th frame around the cursor
+        frames = FrameCache(video_path, step=8)
+    except ValueError:
         print("Error: Unable to open video file.")
         return
 
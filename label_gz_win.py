@@ -1,6 +1,7 @@
 import os
 import cv2
 import pandas as pd
+from frame_cache import FrameCache
 from tkinter import Tk, Button, Label, StringVar
 from PIL import Image, ImageTk
 
@@ -16,10 +17,9 @@ def update_frame():
     """显示current frame并更新界面"""
     global frame_index, child_label, parent_label
 
-    # 设置current frame位置
-    cap.set(cv2.CAP_PROP_POS_FRAMES, frame_index)
-    ret, frame = cap.read()
-    if not ret:
+    # 读取current frame（由后台线程提前解码到缓存中，不再每次 seek）
+    frame = frames.get(frame_index)
+    if frame is None:
         frame_text.set("video end")
         return
 
@@ -126,23 +126,31 @@ def previous_frame():
     update_frame()
 
 def on_closing():
-    cap.release()
+    frames.close()
     root.destroy()
 
-def main():
-    global cap, frame_index, child_label, parent_label
+def main(video_path=None, annotations_csv=None):
+    global frames, frame_index, child_label, parent_label
     global btn_child_true, btn_child_false, btn_parent_true, btn_parent_false
     global frame_label, frame_text, child_status_text, parent_status_text
     global annotations, csv_path, root
 
     # 视频和标注初始化
-    video_path = "/home/weiyan/Desktop/Dataset_mp4/Piaget - Object permanence failure (Sensorimotor Stage).mp4"
-    video_name = os.path.splitext(os.path.basename(video_path))[0]
-    csv_path = f"/home/weiyan/Desktop/Dataset_mp4/{video_name}/{video_name}_annotations.csv"
+    if video_path is None:
+        video_path = "/home/weiyan/Desktop/Dataset_mp4/Piaget - Object permanence failure (Sensorimotor Stage).mp4"
+        video_name = os.path.splitext(os.path.basename(video_path))[0]
+        csv_path = f"/home/weiyan/Desktop/Dataset_mp4/{video_name}/{video_name}_annotations.csv"
+    else:
+        # 标注文件默认保存在视频旁边
+        video_name = os.path.splitext(os.path.basename(video_path))[0]
+        csv_path = os.path.join(os.path.dirname(video_path), f"{video_name}_annotations.csv")
+    if annotations_csv is not None:
+        csv_path = annotations_csv
     video_name = os.path.splitext(os.path.basename(video_path))[0]+'-gaze'
     load_annotations()
     
-    cap = cv2.VideoCapture(video_path)
+    # 每次跳 8 帧，后台预先解码光标前后相隔 8 帧的帧
+    frames = FrameCache(video_path, step=8)
     frame_index = 0
     child_label, parent_label = None, None
 
@@ -1,39 +1,377 @@
 import subprocess
 import os
+import sys
+import json
+import hashlib
+import importlib
+import threading
+import time
+import traceback
+from collections import deque
+from contextlib import redirect_stdout
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 
 # 定义 ROOT_DIR
-ROOT_DIR = '/app/Desktop/dataset-weiyan-latest-gaze-26'
+ROOT_DIR = os.getenv('ROOT_DIR', '/app/Desktop/dataset-weiyan-latest-gaze-26')
 
-# 定义脚本执行顺序
-scripts = [
-    '/app/Desktop/segment/plot_head_gaze.py',
+# 脚本所在目录
+SCRIPT_DIR = os.getenv('SCRIPT_DIR', '/app/Desktop/segment')
+
+# 影响抽帧结果的参数，参数变化时相关阶段需要重新运行
+FRAME_PARAMS = ['FRAME_STRIDE', 'START_TIME', 'END_TIME', 'FRAME_START_NUMBER']
+# 关键帧检测与跟踪参数（与 tracker.py 一致）
+TRACKING_PARAMS = ['DETECTION_MODE', 'KEYFRAME_POLICY', 'KEYFRAME_INTERVAL', 'KEYFRAME_MAX_INTERVAL',
+                   'SCENE_CHANGE_THRESHOLD', 'TRACK_IOU_THRESHOLD']
+
+# 叠加结果的输出方式（与 video_sink.py 一致）：video、frames 或 both，决定各阶段的输出文件
+OUTPUT_MODE = os.getenv('OUTPUT_MODE', 'video')
+VIDEO_OUTPUTS = OUTPUT_MODE in ('video', 'both')
+FRAME_OUTPUTS = OUTPUT_MODE in ('frames', 'both')
+
+
+# 叠加视频的编码参数（与 video_sink.py 一致），变化时重新编码叠加结果，下游的 combine_sgmt 随之重新渲染
+VIDEO_PARAMS = ['OUTPUT_MODE', 'VIDEO_ENCODER', 'VIDEO_CODEC', 'VIDEO_CRF', 'VIDEO_PRESET']
+
+
+def overlay_outputs(video, frames_dir):
+    """叠加结果对应的输出：视频文件和/或逐帧图片目录"""
+    return ([video] if VIDEO_OUTPUTS else []) + ([frames_dir] if FRAME_OUTPUTS else [])
+
+
+# 流水线各阶段：输入/输出文件（相对于片段目录，{name} 为片段名，? 开头表示可选输入）、
+# 参数（环境变量名）以及依赖的上游阶段。列表顺序即拓扑顺序
+STAGES = [
+    {
+        "name": "maskrcnn",
+        "script": "maskrcnn.py",
+        "inputs": ["?{name}.mp4", "?frames"],
+        "outputs": ["segment/all_frames_output_data.json", "segment/all_frames_masks.bin"]
+                   + overlay_outputs("{name}-segmented.mp4", "segment"),
+        "params": FRAME_PARAMS + TRACKING_PARAMS + VIDEO_PARAMS + ['INFERENCE_BACKEND'],
+        "deps": [],
+    },
+    {
+        "name": "plot_obj_gaze",
+        "script": "plot_obj_gaze.py",
+        "inputs": ["?{name}.mp4", "?frames", "{name}-gaze.json"],
+        "outputs": overlay_outputs("{name}-bbox.mp4", "segment"),
+        "params": FRAME_PARAMS + TRACKING_PARAMS + VIDEO_PARAMS + ['INFERENCE_BACKEND', 'DETECTION_REGION', 'ROI_WIDTH',
+                                                                  'ROI_MAX_LENGTH', 'ROI_TILE_SIZE', 'ROI_EXPAND_MARGIN',
+                                                                  'ROI_EXPAND_ROUNDS', 'ROI_NMS_IOU'],
+        # 与 maskrcnn 共享检测缓存，放在其后运行
+        "deps": ["maskrcnn"],
+    },
+    {
+        "name": "plot_head_gaze",
+        "script": "plot_head_gaze.py",
+        "inputs": ["?{name}.mp4", "?frames", "{name}-gaze.json"],
+        "outputs": ["{name}_gaze_events.json"] + overlay_outputs("{name}-onlyhead.mp4", "onlyhead-segment"),
+        "params": FRAME_PARAMS + VIDEO_PARAMS + ['GAZE_EVENTS_MODE', 'EPISODE_GAP_TOLERANCE', 'EPISODE_MIN_DURATION'],
+        "deps": [],
+    },
+    {
+        "name": "combine",
+        "script": "combine.py",
+        "inputs": ["{name}.srt", "{name}_gaze_events.json"],
+        "outputs": ["{name}_result.json", "{name}_unmatched_gaze_events.json"],
+        "params": [],
+        "deps": ["plot_head_gaze"],
+    },
+    {
+        "name": "combine_sgmt",
+        "script": "combine_sgmt.py",
+        "inputs": ["{name}-bbox.mp4", "{name}.wav", "{name}_gpt.json"],
+        "outputs": ["{name}-combine.mp4"],
+        "params": ['HIGHLIGHT_OPACITY', 'RENDER_MODE'],
+        # {name}-bbox.mp4 由 plot_obj_gaze 直接编码输出
+        "deps": ["plot_obj_gaze"],
+    },
 ]
 
-# 遍历 ROOT_DIR 下的一级子目录
-for subdir in os.listdir(ROOT_DIR):
-    BASE_DIR = os.path.join(ROOT_DIR, subdir)
-    
-    # 只处理文件夹，跳过非目录项
-    if not os.path.isdir(BASE_DIR):
-        continue
-
-    # 获取子文件夹中的所有文件
-    files = os.listdir(BASE_DIR)
-
-    # 检查子文件夹中是否存在 _gaze_events.json 文件
-    new_mp4_exists = any(file.endswith('_gaze_events.json') for file in files)
-
-    # 如果不存在 _gaze_events.json 文件，则运行脚本
-    if not new_mp4_exists:
-        print(f"No _gaze_events.json file found in {BASE_DIR}. Executing scripts...")
-        os.environ['BASE_DIR'] = BASE_DIR  # 设置 BASE_DIR 环境变量
-        # 挨个执行脚本
-        for script in scripts:
-            print(f"Executing {script} with BASE_DIR = {BASE_DIR}")
-            result = subprocess.run(['python3', script], capture_output=True, text=True)
-            if result.returncode == 0:
-                print(f"{script} executed successfully.")
-            else:
-                print(f"Error executing {script}. Error: {result.stderr}")
+# 需要运行的阶段（逗号分隔），默认全部
+TARGET_STAGES = [name for name in os.getenv('TARGET_STAGES', ','.join(stage["name"] for stage in STAGES)).split(',') if name]
+
+# 输入指纹方式：stat（大小 + 修改时间）或 hash（文件内容）
+FINGERPRINT = os.getenv('FINGERPRINT', 'stat')
+
+# 每个片段目录下记录各阶段上次成功运行时的输入指纹和参数
+STATE_FILE = '.pipeline_state.json'
+
+# 同时处理的片段数，以及每个任务可用的 CPU 线程数（避免 torch 线程互相抢占 CPU）
+CLIP_WORKERS = int(os.getenv('CLIP_WORKERS', '4'))
+THREADS_PER_JOB = int(os.getenv('THREADS_PER_JOB', str(max(1, (os.cpu_count() or 1) // CLIP_WORKERS))))
+
+# 运行方式：subprocess 为每个脚本启动一个新的 python3 进程；
+# inprocess 在常驻的工作进程中直接调用各阶段的 run(base_dir)，模型只加载一次并在片段之间复用
+RUNNER = os.getenv('RUNNER', 'subprocess')
+# inprocess 模式下工作进程启动时预先加载模型
+WARM_MODELS = os.getenv('WARM_MODELS', '1') == '1'
+
+# 汇总报告路径
+REPORT_PATH = os.getenv('REPORT_PATH', os.path.join(ROOT_DIR, 'main_report.json'))
+
+print_lock = threading.Lock()
+stdout = sys.stdout
+
+
+def log(clip, message):
+    """多个任务并行时逐行输出，行首标明片段名"""
+    with print_lock:
+        print(f"[{clip}] {message}", file=stdout, flush=True)
+
+
+def job_env(base_dir):
+    """子进程环境：设置 BASE_DIR，并限制 torch / BLAS 的线程数"""
+    env = dict(os.environ)
+    env['BASE_DIR'] = base_dir
+    env['PYTHONUNBUFFERED'] = '1'  # 子进程输出不缓冲，便于实时显示进度
+    for name in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'NUMEXPR_NUM_THREADS'):
+        env[name] = str(THREADS_PER_JOB)
+    if env.get('TRACE') == '1':
+        # TRACE=1 时各阶段的 trace 默认写到片段目录下的 traces/
+        env.setdefault('TRACE_DIR', os.path.join(base_dir, 'traces'))
+    return env
+
+
+def run_script(script, base_dir, clip):
+    """运行一个脚本并实时转发其输出，返回 (returncode, 耗时, 最后几行输出)"""
+    start = time.perf_counter()
+    tail = deque(maxlen=20)
+    process = subprocess.Popen(['python3', script], stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                               text=True, env=job_env(base_dir))
+    for line in process.stdout:
+        line = line.rstrip()
+        tail.append(line)
+        log(clip, line)
+    returncode = process.wait()
+    return returncode, time.perf_counter() - start, list(tail)
+
+
+def resolve(base_dir, template):
+    """返回 (绝对路径, 是否可选)"""
+    optional = template.startswith('?')
+    path = template.lstrip('?').format(name=os.path.basename(base_dir))
+    return os.path.join(base_dir, path), optional
+
+
+def file_fingerprint(path):
+    stat = os.stat(path)
+    if FINGERPRINT == 'hash':
+        h = hashlib.blake2b(digest_size=16)
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        return f"{stat.st_size}:{h.hexdigest()}"
+    return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def fingerprint(path):
+    """文件按大小/修改时间（或内容哈希）计算指纹；目录按其中所有条目的指纹计算"""
+    if not os.path.exists(path):
+        return None
+    if not os.path.isdir(path):
+        return file_fingerprint(path)
+    h = hashlib.blake2b(digest_size=16)
+    for entry in sorted(os.scandir(path), key=lambda e: e.name):
+        if entry.is_file():
+            h.update(f"{entry.name}={file_fingerprint(entry.path)};".encode())
+    return h.hexdigest()
+
+
+def load_state(base_dir):
+    try:
+        with open(os.path.join(base_dir, STATE_FILE), 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def save_state(base_dir, state):
+    path = os.path.join(base_dir, STATE_FILE)
+    with open(f"{path}.tmp", 'w') as f:
+        json.dump(state, f, indent=4, ensure_ascii=False)
+    os.replace(f"{path}.tmp", path)
+
+
+def stage_plan(stage, base_dir, state):
+    """判断阶段是否需要运行，返回 (动作, 原因, 输入指纹, 参数)"""
+    inputs = {}
+    for template in stage["inputs"]:
+        path, optional = resolve(base_dir, template)
+        inputs[template] = fingerprint(path)
+        if inputs[template] is None and not optional:
+            return "missing-inputs", f"missing {os.path.basename(path)}", inputs, {}
+    if all(value is None for value in inputs.values()):
+        return "missing-inputs", "no input found", inputs, {}
+
+    params = {name: os.environ.get(name) for name in stage["params"]}
+    previous = state.get(stage["name"])
+    for template in stage["outputs"]:
+        if not os.path.exists(resolve(base_dir, template)[0]):
+            return "run", f"missing output {template}", inputs, params
+    if previous is None:
+        return "run", "no previous run recorded", inputs, params
+    if previous.get("inputs") != inputs:
+        changed = [name for name in inputs if previous.get("inputs", {}).get(name) != inputs[name]]
+        return "run", f"inputs changed: {', '.join(changed)}", inputs, params
+    if previous.get("params") != params:
+        return "run", "parameters changed", inputs, params
+    return "up-to-date", "", inputs, params
+
+
+class ClipOutput:
+    """inprocess 模式下接管阶段函数的 print 输出，逐行加上片段名前缀"""
+
+    def __init__(self, clip):
+        self.clip = clip
+        self.buffer = ''
+        self.tail = deque(maxlen=20)
+
+    def write(self, text):
+        self.buffer += text
+        *lines, self.buffer = self.buffer.split('\n')
+        for line in lines:
+            self.tail.append(line)
+            log(self.clip, line)
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+def init_worker():
+    """inprocess 工作进程初始化：限制线程数，导入各阶段模块，并预先加载模型"""
+    for name in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'NUMEXPR_NUM_THREADS'):
+        os.environ[name] = str(THREADS_PER_JOB)
+    sys.path.insert(0, SCRIPT_DIR)
+    if WARM_MODELS and any(stage["name"] in ('maskrcnn', 'plot_obj_gaze') for stage in STAGES
+                           if stage["name"] in TARGET_STAGES):
+        import torch
+        import detection
+        torch.set_num_threads(THREADS_PER_JOB)
+        detection.load_model()
+
+
+def run_stage_inprocess(stage, base_dir, clip):
+    """在当前进程中调用阶段模块的 run(base_dir)，返回值与 run_script 相同"""
+    import tracing
+    start = time.perf_counter()
+    output = ClipOutput(clip)
+    returncode = 0
+    # 工作进程退出时不执行 atexit，每个阶段单独导出 trace，与 subprocess 模式一样写到片段目录下的 traces/
+    tracing.reset()
+    with redirect_stdout(output):
+        try:
+            module = importlib.import_module(os.path.splitext(stage["script"])[0])
+            module.run(base_dir)
+        except Exception:
+            traceback.print_exc(file=output)
+            returncode = 1
+        except SystemExit as e:
+            returncode = e.code if isinstance(e.code, int) else 1
+        finally:
+            tracing.export(stage["name"], os.getenv('TRACE_DIR') or os.path.join(base_dir, 'traces'))
+    output.write('\n' if output.buffer else '')
+    return returncode, time.perf_counter() - start, list(output.tail)
+
+
+def process_clip(base_dir):
+    clip = os.path.basename(base_dir)
+    record = {"clip": clip, "base_dir": base_dir, "status": "success", "stages": []}
+    start = time.perf_counter()
+    state = load_state(base_dir)
+    failed = set()
+
+    # 按拓扑顺序检查每个阶段，只重新运行输入或参数发生变化的阶段
+    for stage in STAGES:
+        if stage["name"] not in TARGET_STAGES:
+            continue
+        entry = {"stage": stage["name"]}
+        record["stages"].append(entry)
+
+        if failed.intersection(stage["deps"]):
+            entry["status"] = "upstream-failed"
+            failed.add(stage["name"])
+            log(clip, f"{stage['name']}: skipped, upstream stage failed")
+            continue
+
+        action, reason, inputs, params = stage_plan(stage, base_dir, state)
+        if action != "run":
+            entry["status"] = action
+            log(clip, f"{stage['name']}: {action}" + (f" ({reason})" if reason else ""))
+            continue
+
+        log(clip, f"{stage['name']}: running ({reason})")
+        if RUNNER == 'inprocess':
+            returncode, seconds, tail = run_stage_inprocess(stage, base_dir, clip)
+        else:
+            returncode, seconds, tail = run_script(os.path.join(SCRIPT_DIR, stage["script"]), base_dir, clip)
+        entry.update({"returncode": returncode, "seconds": round(seconds, 2)})
+        if returncode == 0:
+            entry["status"] = "ran"
+            state[stage["name"]] = {"inputs": inputs, "params": params}
+            save_state(base_dir, state)
+            log(clip, f"{stage['name']}: executed successfully in {seconds:.1f}s.")
+        else:
+            entry["status"] = "failed"
+            entry["error"] = "\n".join(tail)
+            failed.add(stage["name"])
+            record["status"] = "failed"
+            log(clip, f"{stage['name']}: error (exit code {returncode}).")
+
+    if record["status"] == "success" and not any(entry["status"] == "ran" for entry in record["stages"]):
+        record["status"] = "up-to-date"
+    record["seconds"] = round(time.perf_counter() - start, 2)
+    return record
+
+
+def write_report(records, seconds):
+    summary = {
+        "root_dir": ROOT_DIR,
+        "runner": RUNNER,
+        "clip_workers": CLIP_WORKERS,
+        "threads_per_job": THREADS_PER_JOB,
+        "seconds": round(seconds, 2),
+        "succeeded": sum(r["status"] == "success" for r in records),
+        "failed": sum(r["status"] == "failed" for r in records),
+        "up_to_date": sum(r["status"] == "up-to-date" for r in records),
+        "clips": sorted(records, key=lambda r: r["clip"]),
+    }
+    with open(REPORT_PATH, 'w') as f:
+        json.dump(summary, f, indent=4, ensure_ascii=False)
+    return summary
+
+
+def main():
+    start = time.perf_counter()
+
+    # 遍历 ROOT_DIR 下的一级子目录，只处理文件夹，跳过非目录项
+    clip_dirs = [os.path.join(ROOT_DIR, subdir) for subdir in sorted(os.listdir(ROOT_DIR))]
+    clip_dirs = [base_dir for base_dir in clip_dirs if os.path.isdir(base_dir)]
+
+    print(f"Processing {len(clip_dirs)} clips with {CLIP_WORKERS} {RUNNER} workers, {THREADS_PER_JOB} threads per job")
+    records = []
+    if RUNNER == 'inprocess':
+        executor = ProcessPoolExecutor(max_workers=CLIP_WORKERS, initializer=init_worker)
     else:
-        print(f"_gaze_events.json file found in {BASE_DIR}, skipping execution.")
+        executor = ThreadPoolExecutor(max_workers=CLIP_WORKERS)
+    with executor:
+        futures = {executor.submit(process_clip, base_dir): base_dir for base_dir in clip_dirs}
+        for future in as_completed(futures):
+            base_dir = futures[future]
+            try:
+                record = future.result()
+            except Exception as e:
+                record = {"clip": os.path.basename(base_dir), "base_dir": base_dir, "status": "failed",
+                          "stages": [], "error": str(e)}
+            records.append(record)
+            with print_lock:
+                print(f"[{len(records)}/{len(clip_dirs)}] {record['clip']}: {record['status']}", flush=True)
+
+    summary = write_report(records, time.perf_counter() - start)
+    print(f"Done in {summary['seconds']:.1f}s: {summary['succeeded']} succeeded, {summary['failed']} failed, "
+          f"{summary['up_to_date']} up to date. Report saved to {REPORT_PATH}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+import os
+
+import numpy as np
+
+# 每个物体一行：所属帧的行号范围由帧索引给出，offset/nbytes 指向 .bin 中的位压缩数据，
+# x0/y0/w/h 是掩码紧致包围盒（只保存包围盒内的像素）
+INDEX_DTYPE = np.dtype([
+    ('frame', np.int64), ('object', np.int32), ('offset', np.int64), ('nbytes', np.int64),
+    ('x0', np.int32), ('y0', np.int32), ('w', np.int32), ('h', np.int32),
+])
+FRAME_DTYPE = np.dtype([('frame', np.int64), ('start', np.int64), ('end', np.int64)])
+
+DEFAULT_PREFIX = 'all_frames_masks'
+
+
+def store_paths(directory, prefix=DEFAULT_PREFIX):
+    """返回掩码数据、物体索引、帧索引、图像大小四个文件的路径"""
+    return (
+        os.path.join(directory, f'{prefix}.bin'),
+        os.path.join(directory, f'{prefix}_index.npy'),
+        os.path.join(directory, f'{prefix}_frames.npy'),
+        os.path.join(directory, f'{prefix}_size.npy'),
+    )
+
+
+def frame_number_of(frame):
+    """帧号既可以是整数，也可以是 "12.jpg" 这样的帧文件名"""
+    if isinstance(frame, str):
+        return int(os.path.splitext(frame)[0])
+    return int(frame)
+
+
+def encode_mask(mask):
+    """裁剪到掩码的紧致包围盒并按位压缩，返回 (x0, y0, w, h, bytes)"""
+    rows = np.flatnonzero(mask.any(axis=1))
+    if rows.size == 0:
+        return 0, 0, 0, 0, b''
+    cols = np.flatnonzero(mask.any(axis=0))
+    y0, y1 = rows[0], rows[-1] + 1
+    x0, x1 = cols[0], cols[-1] + 1
+    crop = mask[y0:y1, x0:x1]
+    return int(x0), int(y0), int(x1 - x0), int(y1 - y0), np.packbits(crop, axis=None).tobytes()
+
+
+def decode_crop(data, w, h):
+    return np.unpackbits(np.asarray(data), count=w * h).reshape(h, w).astype(bool)
+
+
+class MaskStoreWriter:
+    """逐帧追加掩码，关闭时写出索引文件"""
+
+    def __init__(self, directory, image_size, prefix=DEFAULT_PREFIX):
+        self.bin_path, self.index_path, self.frames_path, self.size_path = store_paths(directory, prefix)
+        self.image_size = image_size  # (height, width)
+        self._file = open(self.bin_path, 'wb')
+        self._offset = 0
+        self._rows = []
+        self._frames = []
+
+    def add_frame(self, frame, masks, object_ids=None):
+        """masks: 形状为 (N, H, W) 的布尔数组；object_ids 默认是 0..N-1"""
+        frame = frame_number_of(frame)
+        if object_ids is None:
+            object_ids = range(len(masks))
+        start = len(self._rows)
+        for object_id, mask in zip(object_ids, masks):
+            x0, y0, w, h, data = encode_mask(mask)
+            self._file.write(data)
+            self._rows.append((frame, object_id, self._offset, len(data), x0, y0, w, h))
+            self._offset += len(data)
+        self._frames.append((frame, start, len(self._rows)))
+
+    def append_store(self, store):
+        """追加另一个掩码存储中的所有帧（按位压缩的数据直接复制，不重新编码）"""
+        index = np.asarray(store.index)
+        self._file.write(np.asarray(store.data).tobytes())
+        start = len(self._rows)
+        for row in index.tolist():
+            frame, object_id, offset, nbytes, x0, y0, w, h = row
+            self._rows.append((frame, object_id, self._offset + offset, nbytes, x0, y0, w, h))
+        for frame, frame_start, frame_end in np.asarray(store.frames).tolist():
+            self._frames.append((frame, start + frame_start, start + frame_end))
+        self._offset += len(store.data)
+
+    def close(self):
+        self._file.close()
+        index = np.array(self._rows, dtype=INDEX_DTYPE)
+        frames = np.array(sorted(self._frames), dtype=FRAME_DTYPE)
+        np.save(self.index_path, index)
+        np.save(self.frames_path, frames)
+        np.save(self.size_path, np.array(self.image_size, dtype=np.int64))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class MaskStore:
+    """以内存映射方式按帧、按物体随机读取掩码，不需要解析整个片段"""
+
+    def __init__(self, directory, prefix=DEFAULT_PREFIX):
+        bin_path, index_path, frames_path, size_path = store_paths(directory, prefix)
+        self.index = np.load(index_path, mmap_mode='r')
+        self.frames = np.load(frames_path, mmap_mode='r')
+        self.image_size = tuple(int(v) for v in np.load(size_path))
+        if os.path.getsize(bin_path):
+            self.data = np.memmap(bin_path, dtype=np.uint8, mode='r')
+        else:
+            self.data = np.zeros(0, dtype=np.uint8)
+
+    def _rows(self, frame):
+        frame = frame_number_of(frame)
+        i = np.searchsorted(self.frames['frame'], frame)
+        if i >= len(self.frames) or self.frames['frame'][i] != frame:
+            raise KeyError(f"Frame {frame} not found in mask store")
+        return self.index[self.frames['start'][i]:self.frames['end'][i]]
+
+    def object_ids(self, frame):
+        return [int(object_id) for object_id in self._rows(frame)['object']]
+
+    def crop(self, frame, object_id):
+        """返回 (x0, y0, 包围盒内的布尔掩码)"""
+        for row in self._rows(frame):
+            if row['object'] == object_id:
+                data = self.data[row['offset']:row['offset'] + row['nbytes']]
+                return int(row['x0']), int(row['y0']), decode_crop(data, int(row['w']), int(row['h']))
+        raise KeyError(f"Object {object_id} not found in frame {frame}")
+
+    def mask(self, frame, object_id):
+        """返回原始图像大小的布尔掩码"""
+        x0, y0, crop = self.crop(frame, object_id)
+        mask = np.zeros(self.image_size, dtype=bool)
+        mask[y0:y0 + crop.shape[0], x0:x0 + crop.shape[1]] = crop
+        return mask
+
+    def frame_masks(self, frame):
+        """返回 {object_id: 原始图像大小的布尔掩码}"""
+        return {object_id: self.mask(frame, object_id) for object_id in self.object_ids(frame)}
@@ -1,14 +1,37 @@
-import torch
-import torchvision
-from PIL import Image, ImageDraw
 import torchvision.transforms as T
 import json
 import os
+import time
+import shutil
+import tempfile
+import itertools
+import multiprocessing
 import numpy as np
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from frame_source import FrameSource, prefetch
+from detection import DetectionCache, load_model, run_model
+from mask_store import MaskStore, MaskStoreWriter
+from overlay import composite_masks, category_color_lut
+from video_sink import OUTPUT_MODE, VideoSink, concat_videos
+from tracker import DETECTION_MODE, TRACK_IOU_THRESHOLD, KeyframeDetector, ObjectTracker, box_iou
+import tracing
+from tracing import span
 
 BASE_DIR = os.getenv('BASE_DIR', '/app/Desktop/Dataset/pcit1')
 VIDEO_NAME = os.path.basename(BASE_DIR)
 
+# 批量推理参数：每批帧数、解码线程数、预取的批次数
+BATCH_SIZE = int(os.getenv('BATCH_SIZE', '4'))
+NUM_WORKERS = int(os.getenv('NUM_WORKERS', '2'))
+PREFETCH_BATCHES = int(os.getenv('PREFETCH_BATCHES', '2'))
+# 设置 BENCHMARK=1 时只测量不同批大小的吞吐量 (frames/sec)，不写出结果
+BENCHMARK = os.getenv('BENCHMARK', '0') == '1'
+BENCHMARK_FRAMES = int(os.getenv('BENCHMARK_FRAMES', '32'))
+BENCHMARK_BATCH_SIZES = (1, 4, 8)
+# 分片数：大于 1 时将一个片段的帧均分给多个 fork 出的工作进程，模型权重只加载一份并在进程间共享
+NUM_SHARDS = int(os.getenv('NUM_SHARDS', '1'))
+
 # COCO 数据集类别标签
 COCO_CLASSES = [
     "person", "bicycle", "car", "motorcycle", "airplane", "bus", "train", "truck", "boat", "traffic light",
@@ -30,104 +53,320 @@ CATEGORY_COLORS = [
     # 可以根据需要添加更多颜色
 ]
 
-# 加载预训练的 Mask R-CNN 模型
-model = torchvision.models.detection.maskrcnn_resnet50_fpn(pretrained=True)
-model.eval()
+# 检测结果缓存：命中时无需加载模型，也无需推理
+cache = DetectionCache()
 
 # 预处理变换
 transform = T.Compose([T.ToTensor()])
 
-# 创建总输出字典
-all_output_data = {}
-
-# 获取frames文件夹路径
-frames_dir = os.path.join(BASE_DIR, 'frames')
-
-# 检查frames文件夹是否存在
-if not os.path.exists(frames_dir):
-    raise ValueError(f"Frames folder not found at {frames_dir}")
-
-# 获取frames文件夹中的所有图像文件
-frame_files = [f for f in os.listdir(frames_dir) if f.endswith(('.jpg', '.png'))]
-
-# 创建分割结果保存目录
-segment_dir = os.path.join(BASE_DIR, 'segment')
-os.makedirs(segment_dir, exist_ok=True)
-
-# 遍历每一帧图像
-for frame_file in frame_files:
-    image_path = os.path.join(frames_dir, frame_file)
-    
-    # 加载和预处理输入图像
-    image = Image.open(image_path).convert("RGB")
-    image_tensor = transform(image).unsqueeze(0)  # 增加批次维度
-    
-    # 进行物体检测和分割
-    with torch.no_grad():
-        predictions = model(image_tensor)
-    
+# 在后台线程中计算缓存键，并将解码后的帧转换为张量
+def load_frame(frame):
+    return frame, cache.key(frame.image), transform(frame.image)
+
+# 按批次产出帧，转换线程提前准备后续 prefetch 个批次，模型无需等待解码
+def prefetch_batches(frames, batch_size, num_workers, prefetch_count):
+    max_pending = batch_size * (prefetch_count + 1)
+    frames = iter(frames)
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        pending = deque()
+        for frame in frames:
+            pending.append(executor.submit(load_frame, frame))
+            if len(pending) >= max_pending:
+                break
+
+        batch = []
+        while pending:
+            batch.append(pending.popleft().result())
+            next_frame = next(frames, None)
+            if next_frame is not None:
+                pending.append(executor.submit(load_frame, next_frame))
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+# 每帧都运行检测器：按批次推理（先查缓存），并用 IoU 匹配为物体分配 track_id
+def detect_every_frame(source, tracker):
+    for batch in prefetch_batches(prefetch(source), BATCH_SIZE, NUM_WORKERS, PREFETCH_BATCHES):
+        # 进行物体检测和分割：先查缓存，未命中的帧整批一次前向
+        detections_list = cache.detect(
+            [key for _, key, _ in batch],
+            lambda missing: run_model([batch[i][2] for i in missing]),
+        )
+        for (frame, _, _), detections in zip(batch, detections_list):
+            yield frame, tracker.update_keyframe(frame.image, detections)
+
+# 只对关键帧运行检测器（先查缓存）
+def detect_keyframes(frames):
+    return cache.detect(
+        [cache.key(frame.image) for frame in frames],
+        lambda missing: run_model([transform(frames[i].image) for i in missing]),
+    )
+
+# 处理单帧的检测结果：叠加掩码并返回该帧的边界框信息
+def process_detections(np_image, detections):
     # 初始化一个字典用于存储当前帧的边界框和其他信息
     frame_data = {}
 
-    # 获取原始图像大小
-    image_width, image_height = image.size
-
-    # 转换 PIL 图像为 NumPy 数组以便处理掩码
-    np_image = np.array(image)
-
-    # 遍历检测结果
-    for i, box in enumerate(predictions[0]['boxes']):
-        score = predictions[0]['scores'][i].item()
-        if score > 0.5:  # 设置置信度阈值
-            # 提取边界框值
-            xmin, ymin, xmax, ymax = box.int().tolist()
-
-            # 获取类别标签编号并转换为类别名称
-            label_idx = predictions[0]['labels'][i].item() - 1  # COCO 类别从1开始，而索引从0开始
-            label_name = COCO_CLASSES[label_idx] if label_idx < len(COCO_CLASSES) else "unknown"
-
-            # 提取掩码并转换为二值化掩码
-            mask = predictions[0]['masks'][i, 0].mul(255).byte().cpu().numpy()
-            mask = Image.fromarray(mask)
-
-            # 将掩码调整到原始图像大小并应用不同颜色
-            mask_resized = mask.resize((image_width, image_height), resample=Image.BILINEAR)
-            mask_np = np.array(mask_resized) > 128  # 将掩码转换为二值
-            colored_mask = np.zeros_like(np_image, dtype=np.uint8)
-
-            # 根据类别选择颜色
-            color = CATEGORY_COLORS[label_idx % len(CATEGORY_COLORS)]
-            colored_mask[mask_np] = color
-
-            # 将掩码叠加到原始图像上
-            np_image[mask_np] = np_image[mask_np] * 0.5 + colored_mask[mask_np] * 0.5
-
-            # 将边界框和类别信息存储到当前帧的 JSON 中
-            frame_data[f"object_{i}"] = {
-                "box": {
-                    "xmin": xmin,
-                    "ymin": ymin,
-                    "xmax": xmax,
-                    "ymax": ymax
-                },
-                "score": score,
-                "label": label_idx + 1,  # 类别编号
-                "label_name": label_name  # 类别名称
-            }
-
-    # 将 NumPy 数组转换回 PIL 图像
-    segmented_image = Image.fromarray(np_image)
-
-    # 保存分割结果图像
-    segment_output_path = os.path.join(segment_dir, f"segmented_{frame_file}")
-    segmented_image.save(segment_output_path)
-
-    # 将当前帧的检测结果添加到总输出字典中
-    all_output_data[frame_file] = frame_data
-
-# 保存所有帧的边界框信息到一个 JSON 文件中
-output_json_path = os.path.join(segment_dir, "all_frames_output_data.json")
-with open(output_json_path, "w") as json_file:
-    json.dump(all_output_data, json_file, indent=4)
-
-print(f"所有帧的分割图像已保存到 {segment_dir}，边界框和类别信息已保存到 {output_json_path} 文件中。")
+    # 复制一份图像用于叠加掩码
+    np_image = np_image.copy()
+
+    # 遍历检测结果（缓存中只保存了高于置信度阈值的结果，顺序与模型输出一致）
+    for i, box in enumerate(detections['boxes']):
+        score = float(detections['scores'][i])
+
+        # 提取边界框值
+        xmin, ymin, xmax, ymax = box.astype(int).tolist()
+
+        # 获取类别标签编号并转换为类别名称
+        label_idx = int(detections['labels'][i]) - 1  # COCO 类别从1开始，而索引从0开始
+        label_name = COCO_CLASSES[label_idx] if label_idx < len(COCO_CLASSES) else "unknown"
+
+        # 将边界框和类别信息存储到当前帧的 JSON 中
+        frame_data[f"object_{i}"] = {
+            "box": {
+                "xmin": xmin,
+                "ymin": ymin,
+                "xmax": xmax,
+                "ymax": ymax
+            },
+            "score": score,
+            "track_id": int(detections['track_ids'][i]),  # 跨帧稳定的物体编号
+            "label": label_idx + 1,  # 类别编号
+            "label_name": label_name  # 类别名称
+        }
+
+    # 按类别颜色将所有掩码一次性叠加到原始图像上
+    composite_masks(np_image, detections['masks'], category_color_lut(detections['labels'], CATEGORY_COLORS))
+
+    return np_image, frame_data
+
+# 测量不同批大小下纯推理的吞吐量：模型加载、预热、解码、张量转换和缓存键计算都不计入
+def benchmark_batch_sizes(source, batch_sizes):
+    tensors = [transform(frame.image) for frame in itertools.islice(source, BENCHMARK_FRAMES)]
+    if not tensors:
+        return
+    load_model()
+    run_model(tensors[:max(batch_sizes)])  # 预热，不计时
+    for batch_size in batch_sizes:
+        start = time.perf_counter()
+        for i in range(0, len(tensors), batch_size):
+            run_model(tensors[i:i + batch_size])
+        elapsed = time.perf_counter() - start
+        print(f"batch_size={batch_size}: {len(tensors) / elapsed:.2f} frames/sec ({len(tensors)} frames, {elapsed:.1f}s)")
+
+# 对 source 中的帧进行检测：叠加结果写入 video_path / frames_dir，掩码写入 mask_dir，返回每帧的边界框信息
+def segment_frames(source, frames_dir, video_path, mask_dir):
+    # 创建总输出字典
+    all_output_data = {}
+
+    # 叠加结果直接编码为视频（OUTPUT_MODE=frames/both 时逐帧保存 segmented_*.jpg）
+    with VideoSink(video_path, frames_dir, source.fps / source.stride) as sink:
+        # 掩码与 JSON 一起保存：按位压缩、可内存映射、按帧随机读取
+        mask_writer = None
+
+        start_time = time.perf_counter()
+        num_frames = 0
+        hits, misses = cache.hits, cache.misses
+
+        # 遍历视频帧，解码和张量转换都在后台线程中进行；
+        # DETECTION_MODE=keyframes 时只检测关键帧，中间帧由跟踪器传播
+        if DETECTION_MODE == 'keyframes':
+            keyframe_detector = KeyframeDetector(detect_keyframes, BATCH_SIZE)
+            stream = keyframe_detector(prefetch(source))
+        else:
+            keyframe_detector = None
+            stream = detect_every_frame(source, ObjectTracker(flow=False))
+
+        for frame, detections in stream:
+            frame_file = frame.name
+            segmented_image, frame_data = process_detections(frame.image, detections)
+
+            # 写入分割结果（编码和写盘在后台线程中进行）
+            sink.write(segmented_image, f"segmented_{frame_file}")
+
+            # 保存当前帧所有物体的掩码，物体编号与 JSON 中的 object_{i} 对应
+            if mask_writer is None:
+                mask_writer = MaskStoreWriter(mask_dir, frame.image.shape[:2])
+            with span('write masks', frame=frame.number):
+                mask_writer.add_frame(frame.number, detections['masks'])
+
+            # 将当前帧的检测结果添加到总输出字典中
+            all_output_data[frame_file] = frame_data
+            num_frames += 1
+
+        elapsed = time.perf_counter() - start_time
+        if num_frames:
+            print(f"处理 {num_frames} 帧用时 {elapsed:.1f}s，{num_frames / elapsed:.2f} frames/sec (batch_size={BATCH_SIZE})")
+            print(f"检测缓存命中 {cache.hits - hits} 帧，推理 {cache.misses - misses} 帧")
+            if keyframe_detector is not None:
+                print(f"关键帧 {keyframe_detector.keyframes}/{keyframe_detector.frames} 帧，其余帧由跟踪器传播")
+
+    # 一帧都没有处理时也写出空的掩码存储，保证阶段声明的输出存在
+    if mask_writer is None:
+        mask_writer = MaskStoreWriter(mask_dir, (0, 0))
+    mask_writer.close()
+    return all_output_data
+
+# 分片工作进程：处理帧号范围 [start_frame, end_frame)，结果写入 shard_dir
+def run_shard(base_dir, start_frame, end_frame, shard_dir, frames_dir, threads):
+    import torch
+    torch.set_num_threads(threads)
+    # fork 出的子进程继承了父进程已记录的区间，且退出时不会执行 atexit，这里自行清空和导出
+    tracing.reset()
+    source = FrameSource(base_dir, start_frame=start_frame, end_frame=end_frame)
+    all_output_data = segment_frames(source, frames_dir, os.path.join(shard_dir, 'segmented.mp4'), shard_dir)
+    with span('write json'), open(os.path.join(shard_dir, 'all_frames_output_data.json'), 'w') as json_file:
+        json.dump(all_output_data, json_file)
+    tracing.export(f"maskrcnn-shard{start_frame}")
+
+# 将片段的帧号范围按步长对齐后均分为 num_shards 段
+def shard_ranges(source, num_shards):
+    # 按帧号范围计算步数（frames/ 目录的帧号可能不连续，不能用 len(source) 推算帧号）
+    first, last = source.frame_range()
+    total = max(0, (last - first + source.stride - 1) // source.stride)
+    bounds = [total * k // num_shards for k in range(num_shards + 1)]
+    return [(first + bounds[k] * source.stride, first + bounds[k + 1] * source.stride)
+            for k in range(num_shards) if bounds[k + 1] > bounds[k]]
+
+# 分片边界处：用 IoU 将后一分片第一帧的物体与前一分片最后一帧的物体对应，返回 {旧 track_id: 前一分片的 track_id}
+def link_tracks(previous_objects, objects):
+    def as_arrays(frame_objects):
+        objects = list(frame_objects.values())
+        boxes = np.array([[o['box']['xmin'], o['box']['ymin'], o['box']['xmax'], o['box']['ymax']] for o in objects],
+                         dtype=np.float32).reshape(-1, 4)
+        return boxes, np.array([o['label'] for o in objects]), [o['track_id'] for o in objects]
+
+    previous_boxes, previous_labels, previous_ids = as_arrays(previous_objects)
+    boxes, labels, ids = as_arrays(objects)
+    links = {}
+    if not len(boxes) or not len(previous_boxes):
+        return links
+    iou = box_iou(boxes, previous_boxes)
+    iou[labels[:, None] != previous_labels[None, :]] = 0
+    used = set()
+    for flat in np.argsort(-iou, axis=None):
+        i, j = np.unravel_index(flat, iou.shape)
+        if iou[i, j] < TRACK_IOU_THRESHOLD:
+            break
+        if ids[i] not in links and j not in used:
+            links[ids[i]] = previous_ids[j]
+            used.add(j)
+    return links
+
+# 按分片顺序合并各分片的 JSON、掩码存储和视频；track_id 按分片依次偏移，边界处相同的物体沿用前一分片的编号
+def merge_shards(shard_dirs, segment_dir, video_path, fps):
+    all_output_data = {}
+    next_id = 0
+    previous_frame = None
+    mask_writer = None
+    videos = []
+    for shard_dir in shard_dirs:
+        with open(os.path.join(shard_dir, 'all_frames_output_data.json'), 'r') as json_file:
+            shard_data = json.load(json_file)
+        if not shard_data:
+            continue
+
+        links = link_tracks(previous_frame, next(iter(shard_data.values()))) if previous_frame else {}
+        shard_ids = sorted({o['track_id'] for frame_data in shard_data.values() for o in frame_data.values()})
+        mapping = {}
+        for track_id in shard_ids:
+            if track_id in links:
+                mapping[track_id] = links[track_id]
+            else:
+                mapping[track_id] = next_id
+                next_id += 1
+        for frame_file, frame_data in shard_data.items():
+            for o in frame_data.values():
+                o['track_id'] = mapping[o['track_id']]
+            all_output_data[frame_file] = frame_data
+        previous_frame = frame_data
+
+        store = MaskStore(shard_dir)
+        if mask_writer is None:
+            mask_writer = MaskStoreWriter(segment_dir, store.image_size)
+        mask_writer.append_store(store)
+        del store
+
+        if os.path.exists(os.path.join(shard_dir, 'segmented.mp4')):
+            videos.append(os.path.join(shard_dir, 'segmented.mp4'))
+
+    # 所有分片都没有帧时同样写出空的掩码存储
+    if mask_writer is None:
+        mask_writer = MaskStoreWriter(segment_dir, (0, 0))
+    mask_writer.close()
+    if video_path and videos:
+        concat_videos(videos, video_path, fps)
+    return all_output_data
+
+# 分片模式：模型在 fork 之前加载（fork 之前不做任何推理），工作进程通过共享内存使用同一份权重
+def run_sharded(source, base_dir, segment_dir, video_path, num_shards):
+    backend = load_model()
+    module = getattr(backend, 'model', None) or getattr(backend, 'module', None)
+    if module is not None:
+        module.share_memory()
+
+    import torch
+    ranges = shard_ranges(source, num_shards)
+    # 在本任务的线程预算内均分（main.py 通过 OMP_NUM_THREADS 为每个片段任务限定线程数）
+    threads = max(1, torch.get_num_threads() // max(1, len(ranges)))
+    shards_root = tempfile.mkdtemp(prefix='shards_', dir=segment_dir)
+    context = multiprocessing.get_context('fork')
+    try:
+        shard_dirs, processes = [], []
+        for k, (start_frame, end_frame) in enumerate(ranges):
+            shard_dir = os.path.join(shards_root, f'shard_{k:03d}')
+            os.makedirs(shard_dir)
+            shard_dirs.append(shard_dir)
+            process = context.Process(target=run_shard,
+                                      args=(base_dir, start_frame, end_frame, shard_dir, segment_dir, threads))
+            process.start()
+            processes.append(process)
+            print(f"分片 {k}: 帧 [{start_frame}, {end_frame})，{threads} 个线程")
+        for process in processes:
+            process.join()
+        failed = [k for k, process in enumerate(processes) if process.exitcode != 0]
+        if failed:
+            raise RuntimeError(f"Shards {failed} failed")
+        return merge_shards(shard_dirs, segment_dir, video_path, source.fps / source.stride)
+    finally:
+        shutil.rmtree(shards_root, ignore_errors=True)
+
+def run(base_dir, benchmark=BENCHMARK):
+    """对一个片段目录进行分割，结果保存到 segment/ 目录，叠加结果编码为 {VIDEO_NAME}-segmented.mp4"""
+    # 从源视频按需解码帧（没有视频时回退到 frames/ 目录）
+    source = FrameSource(base_dir)
+
+    if benchmark:
+        benchmark_batch_sizes(source, BENCHMARK_BATCH_SIZES)
+        return
+
+    # 创建分割结果保存目录
+    segment_dir = os.path.join(base_dir, 'segment')
+    os.makedirs(segment_dir, exist_ok=True)
+
+    video_name = os.path.basename(base_dir)
+    video_path = os.path.join(base_dir, f'{video_name}-segmented.mp4')
+
+    if NUM_SHARDS > 1:
+        # 多个工作进程分别处理连续的一段帧，按帧顺序合并结果
+        start_time = time.perf_counter()
+        all_output_data = run_sharded(source, base_dir, segment_dir, video_path, NUM_SHARDS)
+        elapsed = time.perf_counter() - start_time
+        print(f"{NUM_SHARDS} 个分片共处理 {len(all_output_data)} 帧用时 {elapsed:.1f}s，"
+              f"{len(all_output_data) / max(elapsed, 1e-9):.2f} frames/sec")
+    else:
+        all_output_data = segment_frames(source, segment_dir, video_path, segment_dir)
+
+    # 保存所有帧的边界框信息到一个 JSON 文件中
+    output_json_path = os.path.join(segment_dir, "all_frames_output_data.json")
+    with span('write json'), open(output_json_path, "w") as json_file:
+        json.dump(all_output_data, json_file, indent=4)
+
+    written = video_path if OUTPUT_MODE in ('video', 'both') else segment_dir
+    print(f"所有帧的分割结果已写入 {written}，边界框和类别信息已保存到 {output_json_path} 文件中，掩码已保存到 {segment_dir}/all_frames_masks.bin。")
+
+
+if __name__ == "__main__":
+    run(BASE_DIR)
@@ -0,0 +1,80 @@
+import numpy as np
+
+from tracing import traced
+
+
+def category_color_lut(labels, category_colors):
+    """按 COCO 类别编号（从 1 开始）为每个物体取颜色，返回 (N, 3) 的 uint16 数组"""
+    palette = np.asarray(category_colors, dtype=np.uint16)
+    labels = np.asarray(labels, dtype=np.int64)
+    return palette[(labels - 1) % len(palette)]
+
+
+@traced('composite masks')
+def composite_masks(image, masks, colors):
+    """将一帧中的所有掩码以 50% 透明度一次性叠加到 image 上（原地修改）。
+
+    结果与逐个物体执行 image[m] = image[m] * 0.5 + color * 0.5 完全一致：
+    只被一个物体覆盖的像素通过标签图 + 颜色查找表一次完成整数混合，
+    被多个物体覆盖的少量像素按原来的顺序依次混合。
+    """
+    masks = np.asarray(masks, dtype=bool)
+    if len(masks) == 0:
+        return image
+    colors = np.asarray(colors, dtype=np.uint16)
+
+    count = masks.sum(axis=0, dtype=np.uint16)
+
+    # 标签图：覆盖该像素的最后一个物体编号 + 1，0 表示背景
+    label_map = (len(masks) - np.argmax(masks[::-1], axis=0)).astype(np.uint16)
+    lut = np.zeros((len(masks) + 1, 3), dtype=np.uint16)
+    lut[1:] = colors
+
+    # x * 0.5 + c * 0.5 转回 uint8 时截断，等价于 (x + c) >> 1
+    single = count == 1
+    image[single] = (image[single] + lut[label_map[single]]) >> 1
+
+    overlap = np.nonzero(count > 1)
+    if overlap[0].size:
+        pixels = image[overlap].astype(np.uint16)
+        overlap_masks = masks[:, overlap[0], overlap[1]]
+        for object_mask, color in zip(overlap_masks, colors):
+            pixels[object_mask] = (pixels[object_mask] + color) >> 1
+        image[overlap] = pixels
+    return image
+
+
+class TintBlender:
+    """整数定点混合：out = (frame * (256 - w) + color * w) >> 8，w = round(opacity * 256)。
+
+    每种颜色的 color * w 只计算一次；中间结果和输出都写入按帧大小复用的缓冲区，
+    不再为每帧分配完整大小的浮点数组。与原来的浮点计算相比每个通道最多相差 1~2。
+    """
+
+    def __init__(self, colors, opacity):
+        """colors: {标签: RGB 颜色}，blend() 按标签取颜色"""
+        self.weight = int(round(min(max(opacity, 0.0), 1.0) * 256))
+        self.tints = {
+            label: np.array(color, dtype=np.uint16) * self.weight for label, color in colors.items()
+        }
+        self.shape = None
+
+    def _buffers(self, shape):
+        if shape != self.shape:
+            self.shape = shape
+            self.work = np.empty(shape, dtype=np.uint16)
+            self.out = np.empty(shape, dtype=np.uint8)
+
+    def blend(self, frame, label):
+        self._buffers(frame.shape)
+        np.multiply(frame, np.uint16(256 - self.weight), out=self.work)
+        np.add(self.work, self.tints[label], out=self.work)
+        np.right_shift(self.work, 8, out=self.work)
+        np.copyto(self.out, self.work, casting='unsafe')
+        return self.out
+
+    def copy(self, frame):
+        """将帧复制到复用的输出缓冲区"""
+        self._buffers(frame.shape)
+        np.copyto(self.out, frame)
+        return self.out
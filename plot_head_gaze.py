@@ -1,150 +1,194 @@
-import torch
-import torchvision
-from PIL import Image
-import torchvision.transforms as T
 import json
 import os
-import numpy as np
 import cv2
-import random
+import numpy as np
+from frame_source import FrameSource, prefetch
+from gaze_geometry import gaze_rays, person_gaze_hits
+from gaze_store import GazeStore
+from tracing import span
+from video_sink import VideoSink
 
 BASE_DIR = os.getenv('BASE_DIR', '/app/Desktop/dataset-weiyan-latest-gaze-26/Clip 5 A not B error')
 VIDEO_NAME = os.path.basename(BASE_DIR)
 
-# 定义线段与矩形相交的函数
-def line_intersects_bbox(start_point, end_point, bbox):
-    xmin, ymin, xmax, ymax = bbox
-    width = xmax - xmin
-    height = ymax - ymin
-    rect = (xmin, ymin, width, height)
-    intersects, pt1, pt2 = cv2.clipLine(rect, start_point, end_point)
-    return intersects
-
-# 加载 gaze 数据
-gaze_json_path = os.path.join(BASE_DIR, f'{VIDEO_NAME}-gaze.json')
-with open(gaze_json_path, 'r') as f:
-    gaze_data = json.load(f)
-
-# 从视频中获取帧率
-video_path = os.path.join(BASE_DIR, f'{VIDEO_NAME}.mp4')
-cap = cv2.VideoCapture(video_path)
-fps = cap.get(cv2.CAP_PROP_FPS)
-
-# 创建分割结果保存目录
-segment_dir = os.path.join(BASE_DIR, 'onlyhead-segment')
-os.makedirs(segment_dir, exist_ok=True)
-
-# 记录注视事件的结果
-gaze_events = []
-
-# 获取 frames 文件夹路径
-frames_dir = os.path.join(BASE_DIR, 'frames')
-if not os.path.exists(frames_dir):
-    raise ValueError(f"Frames folder not found at {frames_dir}")
-
-# 获取所有帧图像文件
-frame_files = [f for f in os.listdir(frames_dir) if f.endswith(('.jpg', '.png'))]
-
-# 遍历每一帧图像
-for frame_idx, frame_file in enumerate(frame_files):
-    try:
-        image_path = os.path.join(frames_dir, frame_file)
-        frame_number = os.path.splitext(frame_file)[0]  # 去掉扩展名，得到 "2"
-
-        # 计算时间戳
-        frame_time = int(frame_number) / fps
-
-        # 加载图像并预处理
-        image = Image.open(image_path).convert("RGB")
-        np_image = np.array(image)
-
-        # 获取当前帧的 gaze 信息
-        gaze_info = gaze_data.get(frame_number, None)
-        print(frame_number)
-        if gaze_info is None:
-            continue  # 如果没有 gaze 数据，则跳过该帧
-
-        persons = list(gaze_info.keys())  # 获取所有人
-
-        person0_looking_at_person1 = False
-        person1_looking_at_person0 = False
-
-        # 遍历该帧中的每个个体（person_0, person_1等）
-        for person_id, data in gaze_info.items():
+# 注视事件的输出方式：frames 为每帧每个方向一条记录；episodes 将连续的帧合并为 [start_time, end_time] 区间
+GAZE_EVENTS_MODE = os.getenv('GAZE_EVENTS_MODE', 'frames')
+# 同一事件中断不超过该时长（秒）时视为同一段
+EPISODE_GAP_TOLERANCE = float(os.getenv('EPISODE_GAP_TOLERANCE', '0.2'))
+# 短于该时长（秒）的片段被丢弃
+EPISODE_MIN_DURATION = float(os.getenv('EPISODE_MIN_DURATION', '0.1'))
+
+
+class EpisodeTracker:
+    """逐帧合并注视事件：每种事件维护一个未结束的片段，中断超过容忍时长时结束并输出。
+
+    confidence 为片段内出现该事件的帧数占片段覆盖的已处理帧数的比例。
+    """
+
+    def __init__(self, frame_interval, gap_tolerance=EPISODE_GAP_TOLERANCE, min_duration=EPISODE_MIN_DURATION):
+        self.frame_interval = frame_interval
+        self.gap_tolerance = gap_tolerance
+        self.min_duration = min_duration
+        self.frame_index = 0  # 已处理的帧数
+        self.open = {}
+        self.episodes = []
+
+    def update(self, frame_number, frame_time, events):
+        """处理一帧：events 为该帧出现的事件名"""
+        for event in dict.fromkeys(events):
+            episode = self.open.get(event)
+            if episode is None:
+                self.open[event] = {
+                    "event": event,
+                    "start_time": frame_time,
+                    "end_time": frame_time,
+                    "start_frame": frame_number,
+                    "end_frame": frame_number,
+                    "first_index": self.frame_index,
+                    "last_index": self.frame_index,
+                    "frame_count": 1,
+                }
+            else:
+                episode["end_time"] = frame_time
+                episode["end_frame"] = frame_number
+                episode["last_index"] = self.frame_index
+                episode["frame_count"] += 1
+        self.frame_index += 1
+
+        # 中断已超过容忍时长的片段不会再延续，立即结束
+        for event in [e for e, episode in self.open.items()
+                      if frame_time - episode["end_time"] > self.gap_tolerance + 1e-9]:
+            self._close(self.open.pop(event))
+
+    def _close(self, episode):
+        duration = episode["end_time"] - episode["start_time"] + self.frame_interval
+        if duration + 1e-9 < self.min_duration:
+            return
+        spanned = episode.pop("last_index") - episode.pop("first_index") + 1
+        episode["duration"] = duration
+        episode["confidence"] = round(episode["frame_count"] / spanned, 4)
+        self.episodes.append(episode)
+
+    def finish(self):
+        for episode in self.open.values():
+            self._close(episode)
+        self.open = {}
+        return sorted(self.episodes, key=lambda x: (x["start_time"], x["event"]))
+
+def run(base_dir):
+    """检测人与人之间的注视事件，结果保存到 {VIDEO_NAME}_gaze_events.json，叠加结果编码为 {VIDEO_NAME}-onlyhead.mp4"""
+    video_name = os.path.basename(base_dir)
+
+    # 加载 gaze 数据（列式内存映射存储，首次运行时由 -gaze.json 转换）
+    gaze_store = GazeStore(base_dir)
+
+    # 从源视频按需解码帧，帧率也从同一视频中获取
+    source = FrameSource(base_dir)
+    fps = source.fps
+
+    # 创建分割结果保存目录
+    segment_dir = os.path.join(base_dir, 'onlyhead-segment')
+    with VideoSink(os.path.join(base_dir, f'{video_name}-onlyhead.mp4'), segment_dir, fps / source.stride) as sink:
+        # 记录注视事件的结果
+        gaze_events = []
+        tracker = EpisodeTracker(source.stride / fps) if GAZE_EVENTS_MODE == 'episodes' else None
+
+        def record(frame_number, frame_time, events):
+            if tracker is not None:
+                tracker.update(frame_number, frame_time, events)
+            else:
+                gaze_events.extend({"frame_time": frame_time, "event": event} for event in events)
+
+        # 遍历每一帧图像，解码在后台线程中进行
+        for frame in prefetch(source):
+            frame_file = frame.name
             try:
-                gaze = data['gaze']
-                head_bbox = data['head_bbox']
+                frame_number = str(frame.number)
+
+                # 时间戳
+                frame_time = frame.time
+
+                np_image = frame.image
 
-                # 计算头部中心点
-                head_center = [
-                    int((head_bbox[0] + head_bbox[2]) // 2),   # X 坐标
-                    int((head_bbox[1] + head_bbox[3]) // 2),  # Y 坐标
-                ]
+                # 获取当前帧的 gaze 信息
+                gaze_info = gaze_store.get(frame_number)
+                print(frame_number)
+                if gaze_info is None:
+                    # 如果没有 gaze 数据，则跳过该帧（视频中保留原始帧，时间线保持连续）
+                    record(frame.number, frame_time, [])
+                    sink.write(np_image, frame_file, save_frame=False)
+                    continue
 
-                # 计算视线的终点
+                persons, gazes, head_bboxes = gaze_info  # 所有人及其视线方向、头部框
+
+                person0_looking_at_person1 = False
+                person1_looking_at_person0 = False
+                frame_events = []
+
+                # 一次性计算所有人的视线，以及每条视线与其他人头部框的相交矩阵
                 gaze_len = 10000 * 1.0  # 视线长度，可调
-                end_point = (
-                    int(head_center[0] - gaze_len * gaze[0]),  # 计算 X 方向的终点
-                    int(head_center[1] - gaze_len * gaze[1])   # 计算 Y 方向的终点
-                )
-
-                # 绘制视线
-                cv2.arrowedLine(np_image, (head_center[0], head_center[1]), end_point, (230, 253, 11), thickness=10)
-
-                # 检查该人的视线是否打在其他人的头部
-                for other_person_id, other_data in gaze_info.items():
-                    if person_id == other_person_id:
-                        continue  # 跳过自身
-
-                    other_head_bbox = other_data['head_bbox']
-
-                    # 检查视线是否与其他人的头部相交
-                    if line_intersects_bbox((head_center[0], head_center[1]), end_point, other_head_bbox):
-                        # 绘制其他人头部的矩形框
-                        cv2.rectangle(np_image, 
-                                      (other_head_bbox[0], other_head_bbox[1]), 
-                                      (other_head_bbox[2], other_head_bbox[3]), 
-                                      (0, 0, 255), thickness=5)  # 用红色标出矩形框
-                        print(f"{person_id} 的视线打在了 {other_person_id} 的头上！")
-
-                        # 检查是否 person_0 看 person_1 或 person_1 看 person_0
-                        if person_id == 'person_1' and other_person_id == 'person_2':
-                            person0_looking_at_person1 = True
-                            gaze_events.append({
-                            "frame_time": frame_time,
-                            "event": "person_1_looking_at_person_2"
-                            })
-                        elif person_id == 'person_2' and other_person_id == 'person_1':
-                            person1_looking_at_person0 = True
-                            gaze_events.append({
-                            "frame_time": frame_time,
-                            "event": "person_2_looking_at_person_1"
-                            })
+                starts, end_points = gaze_rays(head_bboxes, gazes, gaze_len)
+                hits, _ = person_gaze_hits(starts, end_points, head_bboxes)
+
+                # 遍历该帧中的每个个体（person_0, person_1等）
+                for p, person_id in enumerate(persons):
+                    try:
+                        head_center = starts[p].tolist()
+                        end_point = tuple(end_points[p].tolist())
+
+                        # 绘制视线
+                        with span('draw'):
+                            cv2.arrowedLine(np_image, (head_center[0], head_center[1]), end_point, (230, 253, 11), thickness=10)
+
+                        # 该人的视线打在了哪些人的头部
+                        for o in np.flatnonzero(hits[p]):
+                            other_person_id = persons[o]
+                            other_head_bbox = head_bboxes[o].astype(int).tolist()
+
+                            # 绘制其他人头部的矩形框
+                            with span('draw'):
+                                cv2.rectangle(np_image, 
+                                              (other_head_bbox[0], other_head_bbox[1]), 
+                                              (other_head_bbox[2], other_head_bbox[3]), 
+                                              (0, 0, 255), thickness=5)  # 用红色标出矩形框
+                            print(f"{person_id} 的视线打在了 {other_person_id} 的头上！")
+
+                            # 检查是否 person_0 看 person_1 或 person_1 看 person_0
+                            if person_id == 'person_1' and other_person_id == 'person_2':
+                                person0_looking_at_person1 = True
+                                frame_events.append("person_1_looking_at_person_2")
+                            elif person_id == 'person_2' and other_person_id == 'person_1':
+                                person1_looking_at_person0 = True
+                                frame_events.append("person_2_looking_at_person_1")
+
+                    except Exception as e:
+                        print(f"Error processing person {person_id} in frame {frame_number}: {e}")
+
+                # 检查是否有相互注视事件
+                if person0_looking_at_person1 and person1_looking_at_person0:
+                    frame_events.append("mutual_gaze")
+                record(frame.number, frame_time, frame_events)
+
+                # 写入修改后的图像
+                sink.write(np_image, frame_file)
 
             except Exception as e:
-                print(f"Error processing person {person_id} in frame {frame_number}: {e}")
-
-        # 检查是否有相互注视事件
-        if person0_looking_at_person1 and person1_looking_at_person0:
-            gaze_events.append({
-                "frame_time": frame_time,
-                "event": "mutual_gaze"
-            })
+                print(f"Error processing frame {frame_file}: {e}")
 
+    if tracker is not None:
+        # 片段模式：每段连续注视一条记录，包含起止时间、帧数和置信度
+        gaze_events = tracker.finish()
+    else:
+        gaze_events = sorted(gaze_events, key=lambda x: x["frame_time"])
 
-        # 保存修改后的图像
-        output_path = os.path.join(segment_dir, frame_file)
-        cv2.imwrite(output_path, cv2.cvtColor(np_image, cv2.COLOR_RGB2BGR))
-    
-    except Exception as e:
-        print(f"Error processing frame {frame_file}: {e}")
+    # 保存注视事件到JSON文件
+    gaze_events_json_path = os.path.join(base_dir, f'{video_name}_gaze_events.json')
+    with span('write json'), open(gaze_events_json_path, 'w') as json_file:
+        json.dump(gaze_events, json_file, indent=4)
 
-gaze_events = sorted(gaze_events, key=lambda x: x["frame_time"])
+    print(f"所有帧的分割图像已写入 {sink.video_path or segment_dir}。")
+    print(f"注视事件已保存到 {gaze_events_json_path} 文件中。")
 
-# 保存注视事件到JSON文件
-gaze_events_json_path = os.path.join(BASE_DIR, f'{VIDEO_NAME}_gaze_events.json')
-with open(gaze_events_json_path, 'w') as json_file:
-    json.dump(gaze_events, json_file, indent=4)
 
-print(f"所有帧的分割图像已保存到 {segment_dir} 文件夹中。")
-print(f"注视事件已保存到 {gaze_events_json_path} 文件中。")
+if __name__ == "__main__":
+    run(BASE_DIR)
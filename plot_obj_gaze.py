@@ -1,17 +1,33 @@
-import torch
-import torchvision
-from PIL import Image
-import torchvision.transforms as T
-import json
 import os
 import numpy as np
 import cv2
 import random
+from frame_source import FrameSource, prefetch
+from detection import DetectionCache, run_model
+from overlay import composite_masks, category_color_lut
+from gaze_geometry import gaze_rays, segment_box_hits, corridor_tiles
+from gaze_store import GazeStore
+from video_sink import VideoSink
+from tracker import DETECTION_MODE, KeyframeDetector, ObjectTracker, box_iou
+from tracing import span
 
 
 BASE_DIR = os.getenv('BASE_DIR', '/app/Desktop/Dataset/4')
 VIDEO_NAME = os.path.basename(BASE_DIR)
 
+# 检测区域：frame 对整帧检测；gaze 只检测沿每条视线的走廊区域（按原始分辨率整批推理后映射回整帧坐标）
+DETECTION_REGION = os.getenv('DETECTION_REGION', 'frame')
+# 走廊宽度、沿视线的最大长度（像素），以及每个裁剪区域的边长
+ROI_WIDTH = int(os.getenv('ROI_WIDTH', '200'))
+ROI_MAX_LENGTH = float(os.getenv('ROI_MAX_LENGTH', '1000'))
+ROI_TILE_SIZE = int(os.getenv('ROI_TILE_SIZE', '512'))
+# 物体被裁剪区域边缘截断时，以其边界框外扩该距离重新检测
+ROI_EXPAND_MARGIN = int(os.getenv('ROI_EXPAND_MARGIN', '64'))
+# 最多外扩的次数；之后仍被截断的物体改用整帧检测的结果
+ROI_EXPAND_ROUNDS = int(os.getenv('ROI_EXPAND_ROUNDS', '2'))
+# 相邻区域重复检测到的同类物体 IoU 超过该值时只保留得分最高的一个
+ROI_NMS_IOU = float(os.getenv('ROI_NMS_IOU', '0.5'))
+
 # COCO 数据集类别标签
 COCO_CLASSES = [
     "person", "bicycle", "car", "motorcycle", "airplane", "bus", "train", "truck", "boat", "traffic light",
@@ -34,129 +50,234 @@ def generate_unique_colors(num_colors):
         colors.append(tuple(color))
     return colors
 
-# 定义线段与矩形相交的函数
-def line_intersects_bbox(start_point, end_point, bbox):
+# 为 COCO 数据集每个类别生成颜色
+CATEGORY_COLORS = generate_unique_colors(len(COCO_CLASSES))
 
-    xmin, ymin, xmax, ymax = bbox
+# 与 maskrcnn.py 共享的检测结果缓存，只有未命中时才加载模型推理
+cache = DetectionCache()
 
-    # 检查线段是否与 bbox 的四条边相交
-    width = xmax - xmin
-    height = ymax - ymin
+# 预处理变换：torchvision 只在缓存未命中、真正需要推理时才导入，避免拖慢启动
+def to_tensor(image):
+    import torchvision.transforms.functional as F
+    return F.to_tensor(image)
 
-    # 得到 rect: (左上角坐标 x, 左上角坐标 y, 宽度, 高度)
-    rect = (xmin, ymin, width, height)
+# 对一组图像进行整帧的物体检测和分割（先查缓存，在绘制任何内容之前计算缓存键）
+def detect_images(images):
+    return cache.detect(
+        [cache.key(image) for image in images],
+        lambda missing: run_model([to_tensor(images[i]) for i in missing]),
+    )
 
-    intersects, pt1, pt2 = cv2.clipLine(rect, start_point, end_point)
-    # print(intersects)
+def detect_frames(frames):
+    return detect_images([frame.image for frame in frames])
 
-    return intersects
+# 逐帧产出 (frame, detections)；DETECTION_MODE=keyframes 时只检测关键帧，中间帧由跟踪器传播
+def detection_stream(frames):
+    if DETECTION_MODE == 'keyframes':
+        yield from KeyframeDetector(detect_frames)(frames)
+        return
+    tracker = ObjectTracker(flow=False)
+    for frame in frames:
+        yield frame, tracker.update_keyframe(frame.image, detect_frames([frame])[0])
 
-# 为 COCO 数据集每个类别生成颜色
-CATEGORY_COLORS = generate_unique_colors(len(COCO_CLASSES))
+# 空的检测结果
+def empty_detections(image_size):
+    return {
+        'boxes': np.zeros((0, 4), dtype=np.float32),
+        'labels': np.zeros(0, dtype=np.int64),
+        'scores': np.zeros(0, dtype=np.float32),
+        'masks': np.zeros((0,) + tuple(image_size), dtype=bool),
+    }
 
-# 加载预训练的 Mask R-CNN 模型
-model = torchvision.models.detection.maskrcnn_resnet50_fpn(pretrained=True)
-model.eval()
-
-# 预处理变换
-transform = T.Compose([T.ToTensor()])
-
-# 加载 gaze 数据
-gaze_json_path = os.path.join(BASE_DIR, f'{VIDEO_NAME}-gaze.json')
-with open(gaze_json_path, 'r') as f:
-    gaze_data = json.load(f)
-
-# 创建分割结果保存目录
-segment_dir = os.path.join(BASE_DIR, 'segment')
-os.makedirs(segment_dir, exist_ok=True)
-
-# 获取 frames 文件夹路径
-frames_dir = os.path.join(BASE_DIR, 'frames')
-if not os.path.exists(frames_dir):
-    raise ValueError(f"Frames folder not found at {frames_dir}")
-
-# 获取所有帧图像文件
-frame_files = [f for f in os.listdir(frames_dir) if f.endswith(('.jpg', '.png'))]
-
-# 遍历每一帧图像
-for frame_idx, frame_file in enumerate(frame_files):
-    image_path = os.path.join(frames_dir, frame_file)
-    frame_number = os.path.splitext(frame_file)[0]  # 去掉扩展名，得到 "2"
-
-    # 加载图像并预处理
-    image = Image.open(image_path).convert("RGB")
-    image_tensor = transform(image).unsqueeze(0)  # 增加批次维度
-    
-    # 获取原始图像尺寸
-    image_width, image_height = image.size
-    np_image = np.array(image)
-
-    # 进行物体检测和分割
-    with torch.no_grad():
-        predictions = model(image_tensor)
-    
-    # 获取当前帧的 gaze 信息
-    gaze_info = gaze_data[frame_number]
-    print(frame_number)
-    if gaze_info is None:
-        continue  # 如果没有 gaze 数据，则跳过该帧
-
-    # 遍历该帧中的每个个体（person_0, person_1等）
-    for person_id, data in gaze_info.items():
-        gaze = data['gaze']
-        head_bboxes = data['head_bbox']
-
-        # 计算头部中心点
-        head_center = [
-            int((head_bboxes[0] + head_bboxes[2]) // 2),   # X 坐标
-            int((head_bboxes[1] + head_bboxes[3]) // 2),  # Y 坐标
-        ]
-        
-        # 计算视线的终点
-        gaze_len = 1000 * 1.0  # 视线长度，可调
-        end_point = (
-            int(head_center[0] - gaze_len * gaze[0]),  # 计算 X 方向的终点
-            int(head_center[1] - gaze_len * gaze[1])   # 计算 Y 方向的终点
+# 对若干裁剪区域进行检测：同尺寸的区域整批以原始分辨率推理（先查缓存）
+def detect_regions(np_image, regions):
+    results = [None] * len(regions)
+    by_shape = {}
+    for k, (x0, y0, x1, y1) in enumerate(regions):
+        by_shape.setdefault((y1 - y0, x1 - x0), []).append(k)
+    for indices in by_shape.values():
+        crops = [np.ascontiguousarray(np_image[y0:y1, x0:x1]) for x0, y0, x1, y1 in (regions[k] for k in indices)]
+        detections_list = cache.detect(
+            [cache.key(crop, extra='roi-native') for crop in crops],
+            lambda missing: run_model([to_tensor(crops[i]) for i in missing], native_size=True),
         )
+        for k, detections in zip(indices, detections_list):
+            results[k] = detections
+    return results
+
+# 将裁剪区域内的边界框平移到整帧坐标
+def offset_boxes(boxes, region):
+    x0, y0 = region[:2]
+    return boxes + np.array([x0, y0, x0, y0], dtype=np.float32)
+
+# 与裁剪区域边缘相接（且该边不是图像边缘）的物体可能被截断
+def touches_crop_border(boxes, region, image_size):
+    x0, y0, x1, y1 = region
+    height, width = image_size
+    return (((boxes[:, 0] <= 1) & (x0 > 0)) | ((boxes[:, 1] <= 1) & (y0 > 0))
+            | ((boxes[:, 2] >= x1 - x0 - 1) & (x1 < width)) | ((boxes[:, 3] >= y1 - y0 - 1) & (y1 < height)))
+
+# 合并多个区域的检测结果 [(区域内的检测结果, 区域)]，同类物体重叠时保留得分最高的一个；
+# 只为保留下来的物体构建整帧大小的掩码
+def merge_detections(parts, image_size):
+    parts = [(detections, region) for detections, region in parts if len(detections['boxes'])]
+    if not parts:
+        return empty_detections(image_size)
+    boxes = np.concatenate([offset_boxes(detections['boxes'], region) for detections, region in parts])
+    labels = np.concatenate([detections['labels'] for detections, _ in parts])
+    scores = np.concatenate([detections['scores'] for detections, _ in parts])
+    # 每个物体来自哪个区域的第几个结果
+    sources = [(k, i) for k, (detections, _) in enumerate(parts) for i in range(len(detections['boxes']))]
+
+    order = np.argsort(-scores, kind='stable')
+    iou = box_iou(boxes, boxes)
+    keep = []
+    for i in order:
+        if not any(labels[j] == labels[i] and iou[i, j] > ROI_NMS_IOU for j in keep):
+            keep.append(i)
+    keep = sorted(keep)
+
+    masks = np.zeros((len(keep),) + tuple(image_size), dtype=bool)
+    for mask, i in zip(masks, keep):
+        k, index = sources[i]
+        x0, y0, x1, y1 = parts[k][1]
+        mask[y0:y1, x0:x1] = parts[k][0]['masks'][index]
+    keep = np.array(keep, dtype=np.int64)
+    return {'boxes': boxes[keep], 'labels': labels[keep], 'scores': scores[keep], 'masks': masks}
+
+# 只在视线走廊内检测：返回整帧坐标的检测结果，以及检测的区域列表
+def detect_gaze_regions(np_image, starts, end_points):
+    image_size = np_image.shape[:2]
+    height, width = image_size
+    tiles = [corridor_tiles(start, end, ROI_WIDTH, ROI_TILE_SIZE, image_size, ROI_MAX_LENGTH)
+             for start, end in zip(starts, end_points)]
+    tiles = np.concatenate(tiles) if tiles else np.zeros((0, 4), dtype=np.int64)
+    regions = [tuple(tile) for tile in np.unique(tiles, axis=0).tolist()]
+
+    parts = []
+    searched = list(regions)
+    pending = regions
+    cut_boxes = []
+    # 被截断的物体以其边界框外扩后重新检测，最多外扩 ROI_EXPAND_ROUNDS 次
+    for round_index in range(ROI_EXPAND_ROUNDS + 1):
+        cut_boxes = []
+        for region, detections in zip(pending, detect_regions(np_image, pending)):
+            cut = touches_crop_border(detections['boxes'], region, image_size)
+            parts.append(({name: values[~cut] for name, values in detections.items()}, region))
+            cut_boxes.extend(offset_boxes(detections['boxes'][cut], region).astype(int).tolist())
+        if not cut_boxes or round_index == ROI_EXPAND_ROUNDS:
+            break
+        expanded = {(max(0, x0 - ROI_EXPAND_MARGIN), max(0, y0 - ROI_EXPAND_MARGIN),
+                     min(width, x1 + ROI_EXPAND_MARGIN), min(height, y1 + ROI_EXPAND_MARGIN))
+                    for x0, y0, x1, y1 in cut_boxes}
+        pending = sorted(expanded - set(searched))
+        searched.extend(pending)
+        if not pending:
+            break
+
+    if cut_boxes:
+        # 外扩后仍被截断的物体：对整帧检测一次（与 DETECTION_REGION=frame 共用缓存），取与这些物体重叠的结果
+        full = detect_images([np_image])[0]
+        overlaps = np.zeros(len(full['boxes']), dtype=bool)
+        if len(full['boxes']):
+            overlaps = box_iou(full['boxes'], np.array(cut_boxes, dtype=np.float32)).max(axis=1) > 0
+        parts.append(({name: values[overlaps] for name, values in full.items()}, (0, 0, width, height)))
+        searched.append((0, 0, width, height))
+    return merge_detections(parts, image_size), searched
+
+def run(base_dir):
+    """在视频帧上绘制视线，并叠加视线命中物体的掩码，结果编码为 {VIDEO_NAME}-bbox.mp4（或保存到 segment/ 目录）"""
+    # 加载 gaze 数据（列式内存映射存储，首次运行时由 -gaze.json 转换）
+    gaze_store = GazeStore(base_dir)
 
-        # 绘制视线
-        cv2.arrowedLine(np_image, (head_center[0], head_center[1]), end_point, (230, 253, 11), thickness=10)
-
-        # 遍历物体检测结果
-        for i, box in enumerate(predictions[0]['boxes']):
-            score = predictions[0]['scores'][i].item()
-            if score > 0.5:  # 置信度阈值
-                xmin, ymin, xmax, ymax = box.int().tolist()
-                bbox = (xmin, ymin, xmax, ymax)
-
-                # 判断视线是否与物体边界框相交
-                if line_intersects_bbox((head_center[0], head_center[1]), end_point, bbox):
-                    # 匹配成功，画出物体的 Mask
-                    mask = predictions[0]['masks'][i, 0].mul(255).byte().cpu().numpy()
-                    mask_resized = Image.fromarray(mask).resize((image_width, image_height), resample=Image.BILINEAR)
-                    mask_np = np.array(mask_resized) > 128  # 二值化
-
-                    # 生成颜色的 Mask
-                    colored_mask = np.zeros_like(np_image, dtype=np.uint8)
-                    label_idx = predictions[0]['labels'][i].item() - 1
-                    color = CATEGORY_COLORS[label_idx % len(CATEGORY_COLORS)]
-                    colored_mask[mask_np] = color
-
-                    # 叠加 Mask 到原图
-                    np_image[mask_np] = np_image[mask_np] * 0.5 + colored_mask[mask_np] * 0.5
-
-                    cv2.rectangle(np_image, (xmin, ymin), (xmax, ymax), color, thickness=2)
-                    label_index = predictions[0]['labels'][i].item() - 1  # COCO class indices are 1-based, so subtract 1 for 0-based indexing
+    # 创建分割结果保存目录
+    segment_dir = os.path.join(base_dir, 'segment')
+    os.makedirs(segment_dir, exist_ok=True)
+
+    # 从源视频按需解码帧（没有视频时回退到 frames/ 目录）
+    source = FrameSource(base_dir)
+
+    # 叠加结果直接编码为视频，逐帧图片仅在 OUTPUT_MODE=frames/both 时保存
+    video_name = os.path.basename(base_dir)
+    with VideoSink(os.path.join(base_dir, f'{video_name}-bbox.mp4'), segment_dir, source.fps / source.stride) as sink:
+        # DETECTION_REGION=gaze 时先取得视线再只检测走廊区域（不使用关键帧跟踪），每帧单独分配 track_id
+        if DETECTION_REGION == 'gaze':
+            stream = ((frame, None) for frame in prefetch(source))
+            roi_tracker = ObjectTracker(flow=False)
+        else:
+            stream = detection_stream(prefetch(source))
+        roi_pixels = roi_frames = 0
+
+        # 遍历每一帧图像及其检测结果，解码在后台线程中进行
+        for frame, detections in stream:
+            frame_file = frame.name
+            frame_number = str(frame.number)
+
+            np_image = frame.image
+
+            # 获取当前帧的 gaze 信息
+            gaze_info = gaze_store.get(frame_number)
+            print(frame_number)
+            if gaze_info is None:
+                # 如果没有 gaze 数据，则跳过该帧（视频中保留原始帧，时间线保持连续）
+                sink.write(np_image, frame_file, save_frame=False)
+                continue
+
+            # 一次性计算该帧所有人的视线，并判断与所有物体边界框是否相交
+            gaze_len = 1000 * 1.0  # 视线长度，可调
+            person_ids, gazes, head_bboxes = gaze_info
+            starts, end_points = gaze_rays(head_bboxes, gazes, gaze_len)
+            if detections is None:
+                # 在绘制任何内容之前检测视线走廊区域
+                detections, regions = detect_gaze_regions(np_image, starts, end_points)
+                detections = roi_tracker.update_keyframe(np_image, detections)
+                frame_pixels = np_image.shape[0] * np_image.shape[1]
+                roi_pixels += sum((x1 - x0) * (y1 - y0) for x0, y0, x1, y1 in regions) / frame_pixels
+                roi_frames += 1
+            # 缓存中只保存了高于置信度阈值 0.5 的结果
+            object_boxes = detections['boxes'].astype(int).reshape(-1, 4)
+            hits, _ = segment_box_hits(starts, end_points, object_boxes)
+
+            # 遍历该帧中的每个个体（person_0, person_1等）
+            for p, person_id in enumerate(person_ids):
+                head_center = starts[p].tolist()
+                end_point = tuple(end_points[p].tolist())
+
+                # 绘制视线
+                with span('draw'):
+                    cv2.arrowedLine(np_image, (head_center[0], head_center[1]), end_point, (230, 253, 11), thickness=10)
+
+                # 视线命中的物体
+                hit_indices = np.flatnonzero(hits[p])
+                if not hit_indices.size:
+                    continue
+
+                # 匹配成功，一次性叠加所有命中物体的 Mask（掩码已是原始图像大小的二值掩码）
+                hit_labels = detections['labels'][hit_indices]
+                hit_colors = category_color_lut(hit_labels, CATEGORY_COLORS)
+                composite_masks(np_image, detections['masks'][hit_indices], hit_colors)
+
+                for i, color in zip(hit_indices, hit_colors.tolist()):
+                    xmin, ymin, xmax, ymax = object_boxes[i].tolist()
+                    with span('draw'):
+                        cv2.rectangle(np_image, (xmin, ymin), (xmax, ymax), tuple(color), thickness=2)
+                    label_index = int(detections['labels'][i]) - 1  # COCO class indices are 1-based, so subtract 1 for 0-based indexing
                     if label_index >= 0 and label_index < len(COCO_CLASSES):  # Ensure the index is valid
                         label = COCO_CLASSES[label_index]
                     else:
                         label = "Unknown"  # Handle cases where the label index is out of bounds
+                    label = f"{label} #{int(detections['track_ids'][i])}"  # 附上跨帧稳定的物体编号
                     print(label)
-                    cv2.putText(np_image, label, (xmin, ymin - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.9, color, 2)
+                    with span('draw'):
+                        cv2.putText(np_image, label, (xmin, ymin - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.9, tuple(color), 2)
+
+            # 写入带有视线和掩码的结果图像
+            sink.write(np_image, frame_file)
+
+    if roi_frames:
+        print(f"视线区域检测：平均每帧检测的像素为整帧的 {roi_pixels / roi_frames:.1%}")
+    print(f"所有帧的分割图像已写入 {sink.video_path or segment_dir}。")
 
-    # 保存带有视线和掩码的结果图像
-    segmented_image = Image.fromarray(np_image)
-    segment_output_path = os.path.join(segment_dir, f"{frame_file}")
-    segmented_image.save(segment_output_path)
 
-print(f"所有帧的分割图像已保存到 {segment_dir} 文件夹中。")
+if __name__ == "__main__":
+    run(BASE_DIR)
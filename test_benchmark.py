@@ -0,0 +1,22 @@
+import sys
+
+import numpy as np
+
+from benchmark import measure_process
+
+
+def test_peak_rss_excludes_parent_memory(tmp_path):
+    # 基准进程占用约 300 MB 时，一个空的子进程报告的峰值内存应远小于它
+    ballast = np.ones(300 * 1024 * 1024, dtype=np.uint8)
+    returncode, elapsed, peak_rss = measure_process([sys.executable, '-c', 'pass'], str(tmp_path / 'child.log'))
+    assert ballast.sum() == ballast.size
+    assert returncode == 0
+    assert elapsed > 0
+    assert peak_rss < 100
+
+
+def test_returncode_and_peak_rss_of_child(tmp_path):
+    command = [sys.executable, '-c', 'import sys; b = bytearray(200 * 1024 * 1024); sys.exit(3)']
+    returncode, _, peak_rss = measure_process(command, str(tmp_path / 'child.log'))
+    assert returncode == 3
+    assert peak_rss > 200
@@ -0,0 +1,24 @@
+from combine import parse_dialogue_file
+
+SRT = """1
+00:00:01,000 --> 00:00:02,500
+Hello there
+2
+00:00:03,000 --> 00:00:04,000
+First line
+second line
+
+3
+00:00:05,000 --> 00:00:06,000 X1:10 X2:20
+42
+"""
+
+
+def test_block_without_blank_line(tmp_path):
+    path = tmp_path / 'clip.srt'
+    path.write_text(SRT, encoding='utf-8')
+    lines = parse_dialogue_file(str(path))
+    assert [line['id'] for line in lines] == ['1', '2', '3']
+    assert [line['text'] for line in lines] == ['Hello there', 'First line second line', '42']
+    assert [(line['start_time'], line['end_time']) for line in lines] == [
+        ('00:00:01,000', '00:00:02,500'), ('00:00:03,000', '00:00:04,000'), ('00:00:05,000', '00:00:06,000')]
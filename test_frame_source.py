@@ -0,0 +1,52 @@
+import json
+import os
+import shutil
+
+import cv2
+import numpy as np
+
+from frame_source import FrameSource
+
+
+def make_clip(base_dir, num_frames=6, first_number=1, fps=10):
+    """写出 {name}.mp4、与之对应的 frames/（ffmpeg 风格从 first_number 编号）以及同样编号的 -gaze.json"""
+    name = os.path.basename(base_dir)
+    os.makedirs(os.path.join(base_dir, 'frames'))
+    writer = cv2.VideoWriter(os.path.join(base_dir, f'{name}.mp4'), cv2.VideoWriter_fourcc(*'mp4v'), fps, (64, 48))
+    gaze_data = {}
+    for k in range(num_frames):
+        image = np.full((48, 64, 3), 40 * k, dtype=np.uint8)
+        writer.write(image)
+        cv2.imwrite(os.path.join(base_dir, 'frames', f'{first_number + k}.jpg'), image)
+        # 第一帧没有人，最小帧号仍应取自它
+        gaze_data[str(first_number + k)] = {} if k == 0 else {
+            'person_1': {'gaze': [1.0, 0.0], 'head_bbox': [0, 0, 10, 10]}}
+    writer.release()
+    with open(os.path.join(base_dir, f'{name}-gaze.json'), 'w') as f:
+        json.dump(gaze_data, f)
+
+
+def numbering(base_dir):
+    return [(frame.number, round(frame.time, 6)) for frame in FrameSource(base_dir, start_number=None)]
+
+
+def test_numbering_does_not_depend_on_frames_dir(tmp_path):
+    base_dir = str(tmp_path / 'clip')
+    make_clip(base_dir)
+    with_frames = numbering(base_dir)
+    shutil.rmtree(os.path.join(base_dir, 'frames'))
+    without_frames = numbering(base_dir)
+    assert with_frames == without_frames
+    assert with_frames[0] == (1, 0.0)
+    assert [number for number, _ in with_frames] == [1, 2, 3, 4, 5, 6]
+
+
+def test_frames_dir_only_matches_video(tmp_path):
+    base_dir = str(tmp_path / 'clip')
+    # 只有 frames/ 时帧率取 DEFAULT_FPS（默认 30）
+    make_clip(base_dir, first_number=0, fps=30)
+    from_video = numbering(base_dir)
+    os.remove(os.path.join(base_dir, 'clip.mp4'))
+    source = FrameSource(base_dir, start_number=None)
+    assert not source.from_video
+    assert [(frame.number, round(frame.time, 6)) for frame in source] == from_video
@@ -0,0 +1,137 @@
+import atexit
+import json
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+
+# 设置 TRACE=1 时记录各阶段的耗时区间，进程退出时导出 Chrome trace（可在 chrome://tracing 或 Perfetto 中打开）
+# 以及每种区间的耗时分位数汇总；未设置时 span() 只返回一个空的上下文管理器
+ENABLED = os.getenv('TRACE', '0') == '1'
+TRACE_DIR = os.getenv('TRACE_DIR', '.')
+
+_events = []
+_thread_names = {}
+_t0 = time.perf_counter_ns()
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    __slots__ = ('name', 'args', 'start')
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter_ns()
+        thread = threading.current_thread()
+        _thread_names.setdefault(thread.ident, thread.name)
+        # list.append 在 GIL 下是原子操作，多个线程可以同时记录
+        _events.append((self.name, self.start, end - self.start, thread.ident, self.args))
+        return False
+
+
+def span(name, **args):
+    """记录一个耗时区间：with span('forward', batch=4): ..."""
+    if not ENABLED:
+        return _NULL_SPAN
+    return _Span(name, args)
+
+
+def traced(name):
+    """函数装饰器版本的 span；关闭时直接返回原函数"""
+    def decorator(fn):
+        if not ENABLED:
+            return fn
+
+        def wrapper(*args, **kwargs):
+            with _Span(name, {}):
+                return fn(*args, **kwargs)
+        wrapper.__name__ = fn.__name__
+        wrapper.__doc__ = fn.__doc__
+        return wrapper
+    return decorator
+
+
+def reset():
+    """清空已记录的区间（fork 出的子进程开始工作前调用，避免重复导出父进程的记录）"""
+    del _events[:]
+
+
+def summarize(events=None):
+    """按区间名称汇总：次数、总耗时以及 p50/p90/p99/最大值（毫秒）"""
+    durations = {}
+    for name, _, duration, _, _ in (_events if events is None else events):
+        durations.setdefault(name, []).append(duration / 1e6)
+    summary = {}
+    for name, values in durations.items():
+        values = np.array(values)
+        summary[name] = {
+            'count': int(values.size),
+            'total_ms': round(float(values.sum()), 3),
+            'mean_ms': round(float(values.mean()), 3),
+            'p50_ms': round(float(np.percentile(values, 50)), 3),
+            'p90_ms': round(float(np.percentile(values, 90)), 3),
+            'p99_ms': round(float(np.percentile(values, 99)), 3),
+            'max_ms': round(float(values.max()), 3),
+        }
+    return dict(sorted(summary.items(), key=lambda item: -item[1]['total_ms']))
+
+
+def print_summary(summary, file=sys.stderr):
+    print(f"{'span':<24} {'count':>7} {'total ms':>10} {'mean':>8} {'p50':>8} {'p90':>8} {'p99':>8} {'max':>8}",
+          file=file)
+    for name, row in summary.items():
+        print(f"{name:<24} {row['count']:7d} {row['total_ms']:10.1f} {row['mean_ms']:8.2f} {row['p50_ms']:8.2f} "
+              f"{row['p90_ms']:8.2f} {row['p99_ms']:8.2f} {row['max_ms']:8.2f}", file=file)
+
+
+def export(name=None, trace_dir=None):
+    """写出 {trace_dir}/{脚本名}-{pid}.trace.json 和对应的 .summary.json（默认写到 TRACE_DIR），并打印汇总"""
+    if not ENABLED or not _events:
+        return None
+    events = list(_events)
+    pid = os.getpid()
+    name = name or os.path.splitext(os.path.basename(sys.argv[0] or 'python'))[0] or 'python'
+    trace_events = [{'name': 'process_name', 'ph': 'M', 'pid': pid, 'args': {'name': name}}]
+    trace_events += [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': thread_name}}
+                     for tid, thread_name in _thread_names.items()]
+    trace_events += [
+        {'name': span_name, 'ph': 'X', 'pid': pid, 'tid': tid, 'ts': (start - _t0) / 1000, 'dur': duration / 1000,
+         'args': args}
+        for span_name, start, duration, tid, args in events
+    ]
+    trace_dir = trace_dir or TRACE_DIR
+    os.makedirs(trace_dir, exist_ok=True)
+    trace_path = os.path.join(trace_dir, f"{name}-{pid}.trace.json")
+    with open(trace_path, 'w') as f:
+        json.dump({'traceEvents': trace_events, 'displayTimeUnit': 'ms'}, f)
+    summary = summarize(events)
+    with open(os.path.join(trace_dir, f"{name}-{pid}.summary.json"), 'w') as f:
+        json.dump(summary, f, indent=4)
+    print_summary(summary)
+    print(f"Trace saved to {trace_path}", file=sys.stderr)
+    return trace_path
+
+
+if ENABLED:
+    atexit.register(export)
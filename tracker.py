@@ -0,0 +1,202 @@
+import os
+
+import cv2
+import numpy as np
+
+from tracing import traced
+
+# 检测方式：every-frame 每帧都运行检测器；keyframes 只在关键帧上检测，中间帧用光流跟踪传播
+DETECTION_MODE = os.getenv('DETECTION_MODE', 'every-frame')
+# 关键帧策略：interval 每隔 KEYFRAME_INTERVAL 帧；adaptive 在画面变化超过阈值或达到最大间隔时
+KEYFRAME_POLICY = os.getenv('KEYFRAME_POLICY', 'interval')
+KEYFRAME_INTERVAL = int(os.getenv('KEYFRAME_INTERVAL', '5'))
+KEYFRAME_MAX_INTERVAL = int(os.getenv('KEYFRAME_MAX_INTERVAL', '30'))
+# 缩小后的灰度图与上一关键帧的平均绝对差（0-255）
+SCENE_CHANGE_THRESHOLD = float(os.getenv('SCENE_CHANGE_THRESHOLD', '12'))
+# 关键帧检测结果与跟踪中的物体 IoU 不低于该值（且类别相同）时沿用原来的 track_id
+TRACK_IOU_THRESHOLD = float(os.getenv('TRACK_IOU_THRESHOLD', '0.3'))
+
+# 等待凑齐一批关键帧时最多缓存的帧数（含中间帧），达到上限时以不满的批次提前检测
+KEYFRAME_MAX_PENDING = int(os.getenv('KEYFRAME_MAX_PENDING', '64'))
+
+# 画面变化检测用的缩略图大小
+THUMBNAIL_SIZE = (64, 36)
+
+
+def to_gray(image):
+    return cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+
+
+def box_iou(a, b):
+    """a: (N, 4), b: (M, 4)，返回 (N, M) 的 IoU 矩阵"""
+    a = np.asarray(a, dtype=np.float32).reshape(-1, 4)
+    b = np.asarray(b, dtype=np.float32).reshape(-1, 4)
+    x0 = np.maximum(a[:, None, 0], b[None, :, 0])
+    y0 = np.maximum(a[:, None, 1], b[None, :, 1])
+    x1 = np.minimum(a[:, None, 2], b[None, :, 2])
+    y1 = np.minimum(a[:, None, 3], b[None, :, 3])
+    intersection = np.clip(x1 - x0, 0, None) * np.clip(y1 - y0, 0, None)
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    union = area_a[:, None] + area_b[None, :] - intersection
+    return np.where(union > 0, intersection / np.maximum(union, 1e-6), 0.0)
+
+
+def shift_mask(mask, dx, dy):
+    """将掩码平移 (dx, dy) 个像素，移出画面的部分丢弃"""
+    if dx == 0 and dy == 0:
+        return mask
+    h, w = mask.shape
+    shifted = np.zeros_like(mask)
+    if abs(dx) >= w or abs(dy) >= h:
+        return shifted
+    shifted[max(0, dy):h + min(0, dy), max(0, dx):w + min(0, dx)] = \
+        mask[max(0, -dy):h + min(0, -dy), max(0, -dx):w + min(0, -dx)]
+    return shifted
+
+
+class KeyframeSelector:
+    """判断一帧是否需要运行完整的检测器，第一帧总是关键帧"""
+
+    def __init__(self, policy=KEYFRAME_POLICY, interval=KEYFRAME_INTERVAL, max_interval=KEYFRAME_MAX_INTERVAL,
+                 threshold=SCENE_CHANGE_THRESHOLD):
+        if policy not in ('interval', 'adaptive'):
+            raise ValueError(f"Unknown KEYFRAME_POLICY {policy!r}, expected interval or adaptive")
+        self.policy = policy
+        self.interval = max(1, interval)
+        self.max_interval = max(1, max_interval)
+        self.threshold = threshold
+        self.since_keyframe = None
+        self.reference = None
+
+    def __call__(self, image):
+        if self.policy == 'interval':
+            is_keyframe = self.since_keyframe is None or self.since_keyframe + 1 >= self.interval
+        else:
+            thumbnail = cv2.resize(to_gray(image), THUMBNAIL_SIZE, interpolation=cv2.INTER_AREA).astype(np.int16)
+            is_keyframe = (self.since_keyframe is None or self.since_keyframe + 1 >= self.max_interval
+                           or np.abs(thumbnail - self.reference).mean() > self.threshold)
+            if is_keyframe:
+                self.reference = thumbnail
+        self.since_keyframe = 0 if is_keyframe else self.since_keyframe + 1
+        return is_keyframe
+
+
+class ObjectTracker:
+    """为检测结果分配稳定的 track_id，并用稀疏光流将上一帧的框和掩码传播到当前帧。
+
+    检测结果字典在 boxes/labels/scores/masks 之外增加 track_ids。
+    flow=False 时只做关键帧之间的 IoU 匹配（每帧都检测时使用）。
+    """
+
+    def __init__(self, iou_threshold=TRACK_IOU_THRESHOLD, flow=True):
+        self.iou_threshold = iou_threshold
+        self.flow = flow
+        self.next_id = 0
+        self.current = None
+        self.prev_gray = None
+
+    def _assign_ids(self, detections):
+        n = len(detections['boxes'])
+        track_ids = np.full(n, -1, dtype=np.int64)
+        previous = self.current
+        if previous is not None and n and len(previous['boxes']):
+            iou = box_iou(detections['boxes'], previous['boxes'])
+            iou[detections['labels'][:, None] != previous['labels'][None, :]] = 0
+            # 按 IoU 从大到小贪心匹配
+            for flat in np.argsort(-iou, axis=None):
+                i, j = np.unravel_index(flat, iou.shape)
+                if iou[i, j] < self.iou_threshold:
+                    break
+                if track_ids[i] < 0 and previous['track_ids'][j] not in track_ids:
+                    track_ids[i] = previous['track_ids'][j]
+        for i in np.flatnonzero(track_ids < 0):
+            track_ids[i] = self.next_id
+            self.next_id += 1
+        return track_ids
+
+    @traced('track keyframe')
+    def update_keyframe(self, image, detections):
+        """关键帧：与当前跟踪的物体匹配 track_id，并以检测结果替换跟踪状态"""
+        detections = dict(detections, track_ids=self._assign_ids(detections))
+        self.current = detections
+        if self.flow:
+            self.prev_gray = to_gray(image)
+        return detections
+
+    @traced('track propagate')
+    def propagate(self, image):
+        """中间帧：按每个物体掩码内特征点的光流中位数平移其框和掩码"""
+        gray = to_gray(image)
+        previous = self.current
+        boxes = previous['boxes'].copy()
+        masks = previous['masks']
+        if len(boxes):
+            points = cv2.goodFeaturesToTrack(self.prev_gray, maxCorners=500, qualityLevel=0.01, minDistance=5,
+                                             mask=masks.any(axis=0).astype(np.uint8))
+            if points is not None:
+                moved, status, _ = cv2.calcOpticalFlowPyrLK(self.prev_gray, gray, points, None)
+                ok = status.ravel() == 1
+                start = points.reshape(-1, 2)[ok]
+                motion = moved.reshape(-1, 2)[ok] - start
+                xs, ys = start[:, 0].astype(int), start[:, 1].astype(int)
+                shifted = []
+                for k in range(len(boxes)):
+                    inside = masks[k][ys, xs]
+                    if inside.sum() < 3:
+                        shifted.append(masks[k])
+                        continue
+                    dx, dy = np.median(motion[inside], axis=0)
+                    boxes[k] += (dx, dy, dx, dy)
+                    shifted.append(shift_mask(masks[k], int(round(dx)), int(round(dy))))
+                masks = np.stack(shifted)
+            height, width = gray.shape
+            boxes[:, [0, 2]] = boxes[:, [0, 2]].clip(0, width)
+            boxes[:, [1, 3]] = boxes[:, [1, 3]].clip(0, height)
+        self.current = dict(previous, boxes=boxes, masks=masks)
+        self.prev_gray = gray
+        return self.current
+
+
+class KeyframeDetector:
+    """只在关键帧上调用 detect(frames)，中间帧由 ObjectTracker 传播。
+
+    为了让检测器整批推理，先缓存帧直到凑够 batch_size 个关键帧（缓存的帧数达到 max_pending 时提前检测不满的批次，
+    避免 adaptive 策略下关键帧稀疏时占用过多内存）；产出 (frame, detections)，
+    每帧的 detections 都在产出该帧之前计算完成，调用方可以直接在 frame.image 上绘制。
+    """
+
+    def __init__(self, detect, batch_size=1, selector=None, tracker=None, max_pending=KEYFRAME_MAX_PENDING):
+        self.detect = detect
+        self.batch_size = max(1, batch_size)
+        self.max_pending = max(1, max_pending)
+        self.selector = selector or KeyframeSelector()
+        self.tracker = tracker or ObjectTracker()
+        self.frames = 0
+        self.keyframes = 0
+
+    def _flush(self, pending, keyframes):
+        results = iter(self.detect(keyframes) if keyframes else ())
+        for frame, is_keyframe in pending:
+            if is_keyframe:
+                detections = self.tracker.update_keyframe(frame.image, next(results))
+            else:
+                detections = self.tracker.propagate(frame.image)
+            yield frame, detections
+
+    def __call__(self, frames):
+        pending, keyframes = [], []
+        for frame in frames:
+            is_keyframe = self.selector(frame.image)
+            if is_keyframe and len(keyframes) == self.batch_size:
+                yield from self._flush(pending, keyframes)
+                pending, keyframes = [], []
+            pending.append((frame, is_keyframe))
+            if is_keyframe:
+                keyframes.append(frame)
+            self.frames += 1
+            self.keyframes += is_keyframe
+            if len(pending) >= self.max_pending:
+                yield from self._flush(pending, keyframes)
+                pending, keyframes = [], []
+        yield from self._flush(pending, keyframes)
@@ -0,0 +1,190 @@
+import os
+import queue
+import shutil
+import subprocess
+import threading
+
+import cv2
+
+from tracing import span
+
+# 叠加结果的输出方式：video 直接编码为视频，frames 每帧保存一张图片，both 两者都输出
+OUTPUT_MODE = os.getenv('OUTPUT_MODE', 'video')
+# 视频编码器：ffmpeg 子进程（找不到时回退到 cv2.VideoWriter），或直接使用 opencv
+VIDEO_ENCODER = os.getenv('VIDEO_ENCODER', 'ffmpeg')
+FFMPEG_BINARY = os.getenv('FFMPEG_BINARY', 'ffmpeg')
+VIDEO_CODEC = os.getenv('VIDEO_CODEC', 'libx264')
+VIDEO_CRF = os.getenv('VIDEO_CRF', '18')
+VIDEO_PRESET = os.getenv('VIDEO_PRESET', 'veryfast')
+# 编码线程前最多排队的帧数，队列满时计算线程等待，内存占用有上限
+SINK_QUEUE_SIZE = int(os.getenv('SINK_QUEUE_SIZE', '8'))
+
+_END = object()
+
+
+class FfmpegWriter:
+    """将 RGB 帧以 rawvideo 格式写入 ffmpeg 的标准输入"""
+
+    def __init__(self, path, fps, size):
+        width, height = size
+        command = [
+            FFMPEG_BINARY, '-v', 'error', '-y',
+            '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', f'{width}x{height}', '-r', f'{fps}', '-i', '-',
+            # yuv420p 要求宽高为偶数
+            '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2',
+            '-c:v', VIDEO_CODEC, '-preset', VIDEO_PRESET, '-crf', VIDEO_CRF, '-pix_fmt', 'yuv420p',
+            path,
+        ]
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE)
+
+    def write(self, image):
+        self.process.stdin.write(image.tobytes())
+
+    def close(self):
+        self.process.stdin.close()
+        if self.process.wait() != 0:
+            raise RuntimeError(f"ffmpeg exited with code {self.process.returncode}")
+
+
+class OpencvWriter:
+    def __init__(self, path, fps, size):
+        self.writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), fps, size)
+        if not self.writer.isOpened():
+            raise RuntimeError(f"cv2.VideoWriter could not open {path}")
+
+    def write(self, image):
+        self.writer.write(cv2.cvtColor(image, cv2.COLOR_RGB2BGR))
+
+    def close(self):
+        self.writer.release()
+
+
+def open_writer(path, fps, size, encoder=VIDEO_ENCODER):
+    if encoder == 'ffmpeg' and shutil.which(FFMPEG_BINARY):
+        return FfmpegWriter(path, fps, size)
+    return OpencvWriter(path, fps, size)
+
+
+def concat_list_entry(path):
+    """ffmpeg concat 列表中的一行；路径中的单引号按 concat 的语法写成 '\\''"""
+    return "file '" + os.path.abspath(path).replace("'", "'\\''") + "'\n"
+
+
+def concat_videos(paths, output_path, fps, encoder=VIDEO_ENCODER):
+    """按顺序拼接编码参数相同的若干视频：有 ffmpeg 时直接复制视频流，否则逐帧解码后重新编码"""
+    root, ext = os.path.splitext(output_path)
+    tmp_path = f"{root}.tmp{ext}"
+    if encoder == 'ffmpeg' and shutil.which(FFMPEG_BINARY):
+        list_path = f"{root}.concat.txt"
+        with open(list_path, 'w') as f:
+            for path in paths:
+                f.write(concat_list_entry(path))
+        try:
+            subprocess.run([FFMPEG_BINARY, '-v', 'error', '-y', '-f', 'concat', '-safe', '0', '-i', list_path,
+                            '-c', 'copy', tmp_path], check=True)
+        finally:
+            os.remove(list_path)
+    else:
+        writer = None
+        for path in paths:
+            cap = cv2.VideoCapture(path)
+            while True:
+                ret, frame = cap.read()
+                if not ret:
+                    break
+                if writer is None:
+                    writer = OpencvWriter(tmp_path, fps, (frame.shape[1], frame.shape[0]))
+                writer.writer.write(frame)
+            cap.release()
+        if writer is None:
+            return
+        writer.close()
+    os.replace(tmp_path, output_path)
+
+
+class VideoSink:
+    """在后台线程中把叠加结果编码为视频和/或逐帧保存为图片。
+
+    write() 只把帧放入有界队列，编码和写盘与计算并行；传入的数组在写入后不能再修改。
+    视频先写到临时文件，close() 成功后才替换为目标文件。
+    """
+
+    def __init__(self, video_path, frames_dir, fps, mode=OUTPUT_MODE, encoder=VIDEO_ENCODER,
+                 queue_size=SINK_QUEUE_SIZE):
+        if mode not in ('video', 'frames', 'both'):
+            raise ValueError(f"Unknown OUTPUT_MODE {mode!r}, expected video, frames or both")
+        self.video_path = video_path if mode in ('video', 'both') else None
+        self.frames_dir = frames_dir if mode in ('frames', 'both') else None
+        self.fps = fps
+        self.encoder = encoder
+        self.frames = 0
+        self.error = None
+        if self.frames_dir:
+            os.makedirs(self.frames_dir, exist_ok=True)
+        if self.video_path:
+            root, ext = os.path.splitext(self.video_path)
+            self.tmp_path = f"{root}.tmp{ext}"
+        self.writer = None
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.thread = threading.Thread(target=self._consume, name='video-sink', daemon=True)
+        self.thread.start()
+
+    def write(self, image, name, save_frame=True):
+        """写入一帧 RGB 图像；save_frame=False 时只写入视频（例如没有叠加内容的帧，保持视频时间线连续）"""
+        if self.error is not None:
+            raise self.error
+        # 队列满时在这里等待编码线程
+        with span('sink wait'):
+            self.queue.put((image, name, save_frame))
+
+    def _consume(self):
+        while True:
+            item = self.queue.get()
+            if item is _END:
+                return
+            if self.error is not None:
+                continue  # 出错后继续取出队列中的帧，避免 write() 阻塞
+            image, name, save_frame = item
+            try:
+                if self.video_path:
+                    if self.writer is None:
+                        height, width = image.shape[:2]
+                        self.writer = open_writer(self.tmp_path, self.fps, (width, height), self.encoder)
+                    with span('encode'):
+                        self.writer.write(image)
+                if self.frames_dir and save_frame:
+                    with span('write frame'):
+                        cv2.imwrite(os.path.join(self.frames_dir, name), cv2.cvtColor(image, cv2.COLOR_RGB2BGR))
+                self.frames += 1
+            except Exception as e:
+                self.error = e
+
+    def close(self, commit=True):
+        """等待队列中的帧写完；commit=False 时丢弃临时视频，不替换目标文件"""
+        self.queue.put(_END)
+        self.thread.join()
+        if self.writer is not None:
+            try:
+                self.writer.close()
+            except Exception as e:
+                self.error = self.error or e
+        if self.writer is not None and (not commit or self.error is not None):
+            if os.path.exists(self.tmp_path):
+                os.remove(self.tmp_path)
+        if self.error is not None:
+            raise self.error
+        if self.writer is not None and commit:
+            os.replace(self.tmp_path, self.video_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+            return
+        # 已经在处理异常时不再抛出编码错误，也不替换目标视频
+        try:
+            self.close(commit=False)
+        except Exception:
+            pass